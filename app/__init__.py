@@ -1,9 +1,103 @@
+"""WeConnect API.
+create_app() builds the Flask application. The module attribute `app`
+is built on first use, so `gunicorn app:app` keeps working while
+importing a part of the package, such as app.records, does not load
+Flask or the databases."""
 import os
-from flask import Flask
 
-app = Flask(__name__)
 
-from app import views
+def create_app(config=None):
+    """Builds the application from the environment.
+    - config: mapping of settings overriding those read from the environment
 
-# app.config.from_object('config')
+    The databases are kept by app.views, one set per process, so the
+    application is built once per process; building another raises
+    ValueError. Under gunicorn --preload it is
+    built in the master and the workers share its memory until they change
+    it; gunicorn.conf.py restarts the parts that cannot be shared."""
+    from flask import Flask
+    app = Flask(__name__)
 
+    # bcrypt cost factor for new password hashes, and the number of
+    # processes hashing them. Logins rehash passwords stored with another cost.
+    app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+    app.config['BCRYPT_WORKERS'] = int(os.environ.get('BCRYPT_WORKERS', os.cpu_count() or 1))
+
+    # Admission control for the register, login and reset-password routes:
+    # requests hashing at once per route, requests allowed to wait, seconds they
+    # wait, and the per-client token bucket (tokens per second and bucket size).
+    app.config['AUTH_MAX_CONCURRENT'] = int(os.environ.get('AUTH_MAX_CONCURRENT', 2 * max(app.config['BCRYPT_WORKERS'], 1)))
+    app.config['AUTH_MAX_QUEUE'] = int(os.environ.get('AUTH_MAX_QUEUE', 32))
+    app.config['AUTH_QUEUE_TIMEOUT'] = float(os.environ.get('AUTH_QUEUE_TIMEOUT', 5))
+    app.config['AUTH_RATE'] = float(os.environ.get('AUTH_RATE', 1))
+    app.config['AUTH_BURST'] = int(os.environ.get('AUTH_BURST', 20))
+    # Number of reverse proxies in front of the server. Clients are then told
+    # apart by X-Forwarded-For rather than by the address of the proxy.
+    app.config['AUTH_TRUSTED_PROXIES'] = int(os.environ.get('AUTH_TRUSTED_PROXIES', 0))
+
+    # Key signing the access tokens. Without it every process makes its own,
+    # so tokens only work with the process that issued them and not after a restart.
+    app.config['JWT_SECRET_KEY'] = os.environ.get('JWT_SECRET_KEY') or os.urandom(20)
+
+    # Folder for the write-ahead log and snapshots. Without it all data is
+    # kept in memory and lost on restart.
+    app.config['DATA_DIR'] = os.environ.get('WECONNECT_DATA_DIR')
+    app.config['SNAPSHOT_EVERY'] = int(os.environ.get('SNAPSHOT_EVERY', 100000))
+    app.config['WAL_SYNC'] = os.environ.get('WAL_SYNC', '1') != '0'
+
+    # Storage backend: 'memory' keeps records in memory (optionally logged to
+    # WECONNECT_DATA_DIR), 'sqlite' keeps them in the SQLITE_PATH database file,
+    # used by a single process.
+    app.config['STORAGE'] = os.environ.get('WECONNECT_STORAGE', 'memory')
+    app.config['SQLITE_PATH'] = os.environ.get('SQLITE_PATH', 'weconnect.db')
+    app.config['SQLITE_POOL_SIZE'] = int(os.environ.get('SQLITE_POOL_SIZE', 8))
+
+    # Number and total size in bytes of the serialized business responses kept for GET requests.
+    app.config['RESPONSE_CACHE_SIZE'] = int(os.environ.get('RESPONSE_CACHE_SIZE', 10000))
+    app.config['RESPONSE_CACHE_BYTES'] = int(os.environ.get('RESPONSE_CACHE_BYTES', 64 * 1024 * 1024))
+
+    # Largest number of businesses accepted by the :batch endpoints.
+    app.config['BATCH_MAX_ITEMS'] = int(os.environ.get('BATCH_MAX_ITEMS', 1000))
+
+    # Unix socket of the state process shared by the worker processes. Unset
+    # gives every process its own databases. WECONNECT_STATE_SERVER is set in
+    # the state process itself; WECONNECT_SHARED_KEY authenticates the workers,
+    # and unset a random key is kept in a file next to the socket.
+    app.config['SHARED_SOCKET'] = os.environ.get('WECONNECT_SHARED_SOCKET')
+    app.config['SHARED_AUTHKEY'] = os.environ['WECONNECT_SHARED_KEY'].encode() if os.environ.get('WECONNECT_SHARED_KEY') else None
+    app.config['STATE_SERVER'] = os.environ.get('WECONNECT_STATE_SERVER') == '1'
+
+    # Worker number (0-1023) put in the ids made by this process. It must differ
+    # between the processes of a deployment. Unset, processes sharing a state
+    # process lease one from a lock file next to its socket, and other
+    # processes take it from their process id.
+    app.config['ID_WORKER'] = int(os.environ['ID_WORKER']) if os.environ.get('ID_WORKER') else None
+
+    # Number of business events kept for GET /api/v1/businesses/changes, and
+    # seconds between the comments keeping idle event streams open.
+    app.config['CHANGE_FEED_SIZE'] = int(os.environ.get('CHANGE_FEED_SIZE', 10000))
+    app.config['CHANGE_FEED_HEARTBEAT'] = float(os.environ.get('CHANGE_FEED_HEARTBEAT', 15))
+
+    # Whether request, Connect and bcrypt latencies are recorded for /metrics.
+    app.config['METRICS_ENABLED'] = os.environ.get('METRICS_ENABLED', '1') != '0'
+
+    # Whether the /api/v1/profiler routes are served. The sampled stacks show
+    # the code of the server and profiling slows it, so they are off unless
+    # the deployment turns them on.
+    app.config['PROFILER_ENABLED'] = os.environ.get('PROFILER_ENABLED') == '1'
+
+    if config:
+        app.config.update(config)
+
+    from app import views
+    views.init_app(app)
+    return app
+
+
+def __getattr__(name):
+    # builds the application the first time app.app is read
+    if name == 'app':
+        global app
+        app = create_app()
+        return app
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
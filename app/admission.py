@@ -0,0 +1,195 @@
+"""Admission control for CPU-heavy endpoints.
+Each limited route admits a fixed number of concurrent requests
+and lets a bounded number wait. Requests beyond that are turned
+away at once with a 503, and every client draws from a token bucket
+so a single client cannot take all of the capacity.
+
+Clients are told apart by their address. Behind a reverse proxy every
+request comes from the proxy's address, so all clients would share one
+bucket; with trusted_proxies set, the address is read from the
+X-Forwarded-For header the proxies add instead."""
+import math
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import jsonify, request
+
+
+class ConcurrencyLimiter():
+    """Admits up to max_concurrent callers at once.
+    - max_queue: number of callers allowed to wait for a free slot
+    - queue_timeout: seconds a caller waits before giving up"""
+
+    def __init__(self, max_concurrent, max_queue, queue_timeout):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.condition = threading.Condition()
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    def acquire(self):
+        """Takes a slot, waiting in the queue if needed.
+        Returns False if the queue is full or the wait timed out."""
+        with self.condition:
+            if self.active >= self.max_concurrent:
+                if self.waiting >= self.max_queue:
+                    self.rejected += 1
+                    return False
+                self.waiting += 1
+                try:
+                    admitted = self.condition.wait_for(
+                        lambda: self.active < self.max_concurrent, self.queue_timeout)
+                finally:
+                    self.waiting -= 1
+                if not admitted:
+                    self.timed_out += 1
+                    return False
+            self.active += 1
+            self.admitted += 1
+            return True
+
+    def release(self):
+        """Gives a slot back and wakes one waiting caller."""
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    def stats(self):
+        """Returns the current load and the counters as a dictionary."""
+        with self.condition:
+            return {
+                'active': self.active,
+                'queued': self.waiting,
+                'max_concurrent': self.max_concurrent,
+                'max_queue': self.max_queue,
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'timed_out': self.timed_out
+            }
+
+
+class ClientRateLimiter():
+    """Token bucket per client.
+    - rate: tokens added to each bucket per second
+    - burst: size of each bucket
+    - max_clients: number of buckets kept. The least recently
+    seen clients are forgotten first."""
+
+    def __init__(self, rate, burst, max_clients=100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self.lock = threading.Lock()
+        self.buckets = OrderedDict()
+        self.rejected = 0
+
+    def allow(self, client):
+        """Takes a token from the client's bucket.
+        Returns a (allowed, seconds until the next token) tuple."""
+        now = time.monotonic()
+        with self.lock:
+            tokens, last = self.buckets.pop(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            else:
+                self.rejected += 1
+            self.buckets[client] = (tokens, now)
+            if len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+        if allowed:
+            return True, 0
+        return False, (1 - tokens) / self.rate if self.rate else None
+
+    def stats(self):
+        """Returns the number of tracked clients and rejections."""
+        with self.lock:
+            return {'clients': len(self.buckets), 'rejected': self.rejected,
+                    'rate': self.rate, 'burst': self.burst}
+
+
+def _reject(status, message, retry_after):
+    """Builds a JSON error response carrying a Retry-After header."""
+    response = jsonify({'message': message})
+    response.status_code = status
+    if retry_after is not None:
+        response.headers['Retry-After'] = str(max(1, int(math.ceil(retry_after))))
+    return response
+
+
+class AdmissionControl():
+    """Hands out route decorators that share one client rate limiter.
+    - max_concurrent, max_queue, queue_timeout: settings of each
+    route's ConcurrencyLimiter
+    - rate, burst: settings of the shared ClientRateLimiter
+    - trusted_proxies: number of reverse proxies in front of the server,
+    each adding the address it got the request from to X-Forwarded-For"""
+
+    def __init__(self, max_concurrent, max_queue, queue_timeout, rate, burst, trusted_proxies=0):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.trusted_proxies = trusted_proxies
+        self.clients = ClientRateLimiter(rate, burst)
+        self.routes = {}
+
+    def configure(self, max_concurrent, max_queue, queue_timeout, rate, burst, trusted_proxies=0):
+        """Changes the settings of every route and of the client buckets."""
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.trusted_proxies = trusted_proxies
+        self.clients.rate = rate
+        self.clients.burst = burst
+        for limiter in self.routes.values():
+            with limiter.condition:
+                limiter.max_concurrent = max_concurrent
+                limiter.max_queue = max_queue
+                limiter.queue_timeout = queue_timeout
+                limiter.condition.notify_all()
+
+    def client(self):
+        """Returns the address of the client making the request. Behind
+        trusted proxies it is the address the outermost trusted proxy got
+        the request from; the entries before it in X-Forwarded-For may
+        have been made up by the client."""
+        if self.trusted_proxies:
+            forwarded = [address.strip() for address in request.headers.get('X-Forwarded-For', '').split(',')]
+            if len(forwarded) >= self.trusted_proxies and forwarded[-self.trusted_proxies]:
+                return forwarded[-self.trusted_proxies]
+        return request.remote_addr
+
+    def limit(self, name):
+        """Returns a decorator limiting a view function.
+        - name: name the route's counters are reported under"""
+        limiter = ConcurrencyLimiter(self.max_concurrent, self.max_queue, self.queue_timeout)
+        self.routes[name] = limiter
+
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                allowed, retry_after = self.clients.allow(self.client())
+                if not allowed:
+                    return _reject(429, 'Too many requests. Try again later.', retry_after)
+                if not limiter.acquire():
+                    return _reject(503, 'Server busy. Try again later.', self.queue_timeout)
+                try:
+                    return view(*args, **kwargs)
+                finally:
+                    limiter.release()
+            return wrapper
+        return decorator
+
+    def stats(self):
+        """Returns the counters of every limited route and of the client buckets."""
+        return {
+            'routes': dict((name, limiter.stats()) for name, limiter in self.routes.items()),
+            'clients': self.clients.stats()
+        }
@@ -1,143 +1,457 @@
-import bcrypt
-"""This contains the WeConnect, User, and Business classes.
-The WeConnect class acts as the main class, handling
-the interactions of the user with the application by
-utilizing the other classes defined here."""
+import threading
+import time
+from .changes import ChangeFeed
+from .denylist import TokenDenylist
+from .encoding import dumps
+from .geo import GridIndex
+from .search import SearchIndex, normalize
+from .hashing import PasswordHasher
+from .locks import ReadWriteLock
+from .metrics import timed_method
+from .records import Business, User
+from .shared import StateClient
+from .stats import TOP_KEYS, TOP_REVIEWED, TopReviewed
+from .storage import MemoryStorage
+"""This contains the WeConnect class, which acts as the main class,
+handling the interactions of the user with the application by
+utilizing the User and Business records of app.records."""
+
+# seconds a replica waits for one of its changes to come back from the primary
+REPLICA_TIMEOUT = 10
 
 
 class Connect():
     """Overall application class.
     Manages the other classes"""
 
-    def __init__(self):
+    def __init__(self, hasher=None, persistence=None, storage=None, primary=None, change_feed=None):
         """
-        - userdb: User database.
-        - business: Businesses' database"""
-
-        self.userdb = []
-
-        self.business = []
-
+        - hasher: PasswordHasher used to hash and check passwords.
+        - persistence: Persistence that every change is logged to, or None
+        to keep the databases in memory only. Existing data is recovered from it.
+        Only used with MemoryStorage; other backends keep their own data.
+        - storage: Storage backend holding the user, business and review
+        records. Defaults to MemoryStorage.
+        - primary: StateClient of a state process holding the databases,
+        or None. With a primary, Connect keeps a replica of its databases in
+        MemoryStorage, forwards changes to it and applies the changes it streams.
+        - replica_timeout: seconds a replica waits for one of its changes to
+        come back from the primary before giving up with IOError.
+        - change_feed: ChangeFeed given an event for every change to a
+        business. Defaults to a ChangeFeed of FEED_SIZE events.
+        - search_index: Inverted index used to search the businesses. It
+        also counts the businesses per category and location.
+        - geo_index: Grid of the businesses with coordinates, used to find nearby businesses.
+        - review_total: Number of reviews of all businesses.
+        - top_reviewed: TopReviewed ranking the most reviewed businesses.
+        - denylist: TokenDenylist of the revoked tokens held by the storage
+        backend, so checking a token does not ask the storage.
+        - versions: Counter per business, bumped whenever the business or its reviews change.
+        - catalogue_version: Counter bumped whenever a business is added, changed or deleted.
+        - listeners: Functions called as listener(business_id, catalogue_changed)
+        after every change to a business.
+        - followers: Functions called as follower(lsn, op, args) with every
+        change applied, in log order.
+        - lock: ReadWriteLock held for writing while a change is applied and
+        for reading while the databases are read, so that Connect can be
+        shared by the threads of a server."""
+
+        self.hasher = hasher if hasher is not None else PasswordHasher()
+
+        self.storage = storage if storage is not None else MemoryStorage()
+        if persistence is not None and not isinstance(self.storage, MemoryStorage):
+            raise ValueError('Persistence is only used with MemoryStorage')
+        if primary is not None and (persistence is not None or not isinstance(self.storage, MemoryStorage)):
+            raise ValueError('Replicas keep their databases in MemoryStorage only')
+
+        self.search_index = SearchIndex()
+        self.geo_index = GridIndex()
+        self.review_total = 0
+        self.top_reviewed = TopReviewed()
+        self.denylist = TokenDenylist()
+        self.change_feed = change_feed if change_feed is not None else ChangeFeed()
+
+        self.versions = {}
+        self.catalogue_version = 0
+        self.listeners = []
+        self.followers = []
+
+        # changes are applied one at a time and numbered with a log sequence number
+        self.lock = ReadWriteLock()
+        self.lsn = 0
+
+        self.persistence = persistence
+        self.primary = primary
+        self.replica = None
+        self.replica_timeout = REPLICA_TIMEOUT
+        if primary is not None:
+            self._follow()
+        elif persistence is not None:
+            self._recover()
+        else:
+            self._build_indexes()
+
+    def _build_indexes(self):
+        """Indexes the businesses already held by the storage backend,
+        counts their reviews and loads the revoked tokens."""
+        for business_record in self.storage.iter_businesses():
+            self.search_index.add(business_record)
+            self.geo_index.add(business_record)
+        review_counts = list(self.storage.review_counts())
+        self.review_total = sum(count for _, count in review_counts)
+        self.top_reviewed.rebuild(review_counts)
+        for jti, expires in self.storage.revoked_tokens():
+            self.denylist.revoke(jti, expires)
+
+    def _recover(self):
+        """Loads the latest snapshot and replays the changes logged after it."""
+        state, self.lsn = self.persistence.load_snapshot()
+        if state is not None:
+            self.storage.load(state)
+        # the changes replayed below are fed to the change feed again
+        self.change_feed.clear(self.lsn)
+        self._build_indexes()
+        for lsn, op, args in self.persistence.replay(self.lsn):
+            self._apply(op, *args)
+            self.lsn = lsn
+        self.persistence.open(self.lsn)
+
+    def _follow(self, after=None):
+        """Loads a copy of the primary's databases and starts applying
+        the changes it streams.
+        - after: lsn of the databases already held, which are kept if the
+        primary can send the changes made since"""
+        state, lsn = self.primary.subscribe(after)
+        if state is not None:
+            if after is not None:
+                self.storage = MemoryStorage()
+                self.search_index = SearchIndex()
+                self.geo_index = GridIndex()
+                self.denylist = TokenDenylist()
+                self.versions = {}
+            self.storage.load(state)
+            self._build_indexes()
+            self.change_feed.clear(lsn)
+            self.lsn = lsn
+        self.replicated = threading.Condition()
+        self.replica = threading.Thread(target=self._replicate, args=(self.primary,), name='replica', daemon=True)
+        self.replica.start()
+
+    def _replicate(self, primary):
+        try:
+            for lsn, op, args in primary.changes():
+                with self.lock.write():
+                    self._apply(op, *args)
+                    self.lsn = lsn
+                with self.replicated:
+                    self.replicated.notify_all()
+                self.change_feed.publish()
+        finally:
+            # writers waiting for their changes find the replica gone
+            with self.replicated:
+                self.replicated.notify_all()
+
+    def _wait_replicated(self, lsn):
+        """Waits for the change with the given lsn to reach the replica.
+        Raises IOError if the replica stops following the primary or the
+        change takes longer than replica_timeout seconds."""
+        deadline = time.monotonic() + self.replica_timeout
+        with self.replicated:
+            while self.lsn < lsn:
+                replica = self.replica
+                if replica is None or not replica.is_alive():
+                    raise IOError('Replica stopped following the state process before change %d' % lsn)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise IOError('Change %d did not reach the replica within %s seconds'
+                                  % (lsn, self.replica_timeout))
+                self.replicated.wait(remaining)
+
+    def _commit(self, op, *args):
+        """Applies a change to the databases and logs it.
+        Returns the result of the change once it is durable.
+        - op: name of the change, one of the _apply_<op> methods
+        - args: arguments of the change. They must be JSON serializable,
+        or User and Business records, which are logged as dictionaries."""
+        return self._commit_change(op, args)[0]
+
+    def _commit_change(self, op, args):
+        """Applies and logs a change like _commit.
+        Returns the result and the lsn of the change, which is None if it failed."""
+        if self.primary is not None:
+            result, lsn = self.primary.commit(op, args)
+            # wait for the change to reach the replica, so the caller reads its own writes
+            if lsn is not None:
+                self._wait_replicated(lsn)
+            return result, lsn
+        snapshot_due = False
+        with self.lock.write():
+            result = self._apply(op, *args)
+            # failed changes leave the databases untouched and are not logged
+            if not result:
+                return result, None
+            self.lsn += 1
+            lsn = self.lsn
+            if self.persistence is not None:
+                snapshot_due = self.persistence.append(lsn, op, args)
+            for follower in self.followers:
+                follower(lsn, op, args)
+        if self.persistence is not None:
+            self.persistence.wait(lsn)
+            if snapshot_due:
+                self.snapshot(background=True)
+        self.change_feed.publish()
+        return result, lsn
+
+    def _apply(self, op, *args):
+        """Applies a change without logging it."""
+        return getattr(self, '_apply_' + op)(*args)
+
+    def _changed(self, business_id, catalogue_changed=True):
+        """Bumps the versions of a changed business and tells the listeners."""
+        self.versions[business_id] = self.versions.get(business_id, 0) + 1
+        if catalogue_changed:
+            self.catalogue_version += 1
+        for listener in self.listeners:
+            listener(business_id, catalogue_changed)
+
+    def _event(self, kind, business_id, fields=b''):
+        """Adds an event to the change feed. The change being applied is
+        logged under the next lsn once it is applied."""
+        self.change_feed.append(self.lsn + 1, kind, business_id, fields)
+
+    def business_version(self, business_id):
+        """Gets the version counter of a business."""
+        return self.versions.get(business_id, 0)
+
+    def _apply_add_user(self, user_record):
+        # records replayed from the log come back as dictionaries
+        if isinstance(user_record, dict):
+            user_record = User.from_dict(user_record)
+        return self.storage.add_user(user_record)
+
+    def _apply_set_password(self, user_id, new_hash, old_hash):
+        # the hash is only replaced if nobody changed it since old_hash was read
+        return self.storage.set_password(user_id, new_hash, old_hash)
+
+    def _apply_add_business(self, business_record):
+        if isinstance(business_record, dict):
+            business_record = Business.from_dict(business_record)
+        if not self.storage.add_business(business_record):
+            return False
+        self.search_index.add(business_record)
+        self.geo_index.add(business_record)
+        self._event('created', business_record.business_id, b',"business":' + business_record.to_json())
+        self._changed(business_record.business_id)
+        return business_record
+
+    def _apply_update_business(self, business_id, changes):
+        business_record = self.storage.update_business(business_id, changes)
+        if business_record is None:
+            return False
+        # re-index the business under its new details
+        self.search_index.add(business_record)
+        self.geo_index.add(business_record)
+        self._event('updated', business_id, b',"business":' + business_record.to_json())
+        self._changed(business_id)
+        return business_record
+
+    def _apply_delete_business(self, business_id):
+        review_count = self.storage.review_count(business_id)
+        if self.storage.delete_business(business_id) is None:
+            return False
+        self.search_index.remove(business_id)
+        self.geo_index.remove(business_id)
+        self.review_total -= review_count
+        # the candidates of the ranking only run out after many deletes of
+        # top businesses; the businesses moving up are then found by counting
+        if self.top_reviewed.remove(business_id):
+            self.top_reviewed.rebuild(self.storage.review_counts())
+        self._event('deleted', business_id)
+        self._changed(business_id)
+        return True
+
+    def _apply_add_review(self, business_id, review_id, text):
+        if self.storage.get_business(business_id) is None:
+            return False
+        self.storage.add_review(business_id, review_id, text)
+        review_count = self.storage.review_count(business_id)
+        self.review_total += 1
+        self.top_reviewed.reviewed(business_id, review_count)
+        self._event('reviewed', business_id, b',"review_count":%d,"review":%s' % (
+            review_count, dumps({'id': review_id, 'review': text})))
+        self._changed(business_id, catalogue_changed=False)
+        return True
+
+    def _apply_revoke_token(self, jti, expires):
+        self.storage.revoke_token(jti, expires)
+        self.denylist.revoke(jti, expires)
+        return True
+
+    def _apply_batch(self, changes):
+        # the changes of a batch share one storage transaction and one log record
+        results = []
+        with self.storage.transaction():
+            for op, args in changes:
+                results.append(self._apply(op, *args))
+        return results
+
+    def snapshot(self, background=False):
+        """Writes the databases to a new snapshot so the log written before
+        it can be deleted. They are copied and written by a forked process,
+        so changes are only held up while the log is rotated and the
+        process forked, not while the databases are copied.
+        Returns False if a snapshot is already being written.
+        - background: take the snapshot from a separate thread and return at once"""
+        if background:
+            threading.Thread(target=self.snapshot, name='snapshot', daemon=True).start()
+            return True
+        with self.lock.write():
+            obsolete = self.persistence.begin_snapshot()
+            if obsolete is None:
+                return False
+            pid = self.persistence.fork_snapshot(self.storage.dump, self.lsn, obsolete)
+        self.persistence.wait_snapshot(pid)
+        return True
+
+    def detach(self):
+        """Stops following the primary, if there is one, leaving the
+        databases as they are. A server preloading the databases calls it
+        before forking its workers, so nothing changes them during the fork."""
+        self._check_forkable()
+        if self.primary is not None and self.replica is not None:
+            self.primary.close()
+            self.replica.join()
+            self.replica = None
+
+    def after_fork(self):
+        """Restarts, in a forked process, what cannot be shared with the
+        process Connect was made in: the threads waiting on its locks
+        and the connection to the primary. The databases loaded before
+        the fork are kept."""
+        self._check_forkable()
+        self.lock = ReadWriteLock()
+        self.change_feed.after_fork()
+        self.storage.after_fork()
+        if self.primary is not None:
+            # the parent's connections are its own; they are closed here
+            # without ending them, and this process makes its own
+            self.primary.close(shutdown=False)
+            self.primary = StateClient(self.primary.address, self.primary.authkey)
+            self._follow(self.lsn)
+
+    def _check_forkable(self):
+        # every forked process would write the same log segment over the others'
+        if self.persistence is not None:
+            raise ValueError('Worker processes cannot share a write-ahead log: '
+                             'set WECONNECT_SHARED_SOCKET so that the state process writes it')
+        # the indexes, versions and caches of each process would miss the others' changes
+        if not isinstance(self.storage, MemoryStorage):
+            raise ValueError('Worker processes cannot share an SQLite database: '
+                             'use the memory backend with WECONNECT_SHARED_SOCKET')
+
+    def close(self):
+        """Flushes and closes the log, if there is one, the connection to
+        the primary, if there is one, and the storage backend."""
+        if self.persistence is not None:
+            self.persistence.close()
+        if self.primary is not None:
+            self.primary.close()
+        self.storage.close()
+
+    @timed_method
     def register_user(self, user_id, first_name, last_name, email, password):
         """Adds a user to the application
         - user_id: uniquely identifies the user record
         - first_name: Holds the user's first name
         - last_name: Holds the user's last name
         - password: Holds the user's password
-        - user_record: a dictionary storing the user details
-        in the following format:
-        {
-            'id': randint,
-            'first_name': 'string',
-            'last_name': 'string',
-            'email': 'string',
-            'password': 'hashed password converted to string format'
-        }
-        Is stored in the self.userdb list
-        - self.userdb: a list of dictionaries, each symbolized by user_record"""
-        for user_record in self.userdb:
-            # check if the email submitted is already in the dictionary
-            # and there is an id in the dictionary. If so do not proceed
-            if user_record['email'] == email and user_record['id'] is not None:
-                return "You're already registered. Try signing in."
+        - new_user: a User storing the user details, with the password
+        hashed. Is kept by the storage backend"""
+        # check if the email submitted is already registered. If so do not proceed
+        with self.lock.read():
+            registered = self.storage.get_user_by_email(email) is not None
+        if registered:
+            return "You're already registered. Try signing in."
 
         if email is not None and password is not None:
-            # make instance of User class with required parameters
-            user = User(user_id, first_name, last_name, email, password)
-            # Hash the user password
-            user_password = user.set_password(password)
-            # create dictionary record of user details
-            new_user = {
-                'id': user.user_id,
-                'first_name': user.first_name,
-                'last_name': user.last_name,
-                'email': user.email,
-                'password': user_password
-            }
-            # add dictionary to self.userdb list
-            self.userdb.append(new_user)
-            return dict(user_id=new_user['id'], first_name=new_user['first_name'],
-                        last_name=new_user['last_name'], email=new_user['email'])
-
+            # Hash the user password in the hashing pool and make
+            # the User record holding the hash
+            new_user = User(user_id, first_name, last_name, email, self.hasher.hash(password))
+            # add the record to the user store, which rejects
+            # an e-mail address or id that is already taken
+            if not self._commit('add_user', new_user):
+                return False
+            return dict(user_id=new_user.user_id, first_name=new_user.first_name,
+                        last_name=new_user.last_name, email=new_user.email)
+
+    @timed_method
+    def revoke_token(self, jti, expires=None):
+        """Revokes a token, as logging out does. The revocation is logged
+        and sent to the replicas like any other change.
+        - jti: unique id of the token
+        - expires: time the token expires at, in seconds, or None if it never does"""
+        self._commit('revoke_token', jti, expires)
+
+    def is_revoked(self, jti):
+        """Checks whether a token was revoked."""
+        return jti in self.denylist
+
+    def _find_user(self, email):
+        """Returns the User record registered with the e-mail address,
+        or None if there is no such record. The record must not be changed.
+        - email: Holds the user's entered e-mail address."""
+        with self.lock.read():
+            user_record = self.storage.get_user_by_email(email)
+        # check that there is an id value in the record
+        if user_record is None or not user_record.user_id:
+            return None
+        return user_record
+
+    @timed_method
     def login_user(self, email, password):
         """Logs in users to the application.
+        Returns the user's id if the e-mail address and password match.
         - email: Holds the user's entered e-mail address.
-        - password: Holds the user's entered password
-        - user_record: a dictionary storing the user details
-        in the following format:
-        {
-            'id': randint,
-            'first_name': 'string',
-            'last_name': 'string',
-            'email': 'string',
-            'password': 'hashed password converted to string format'
-        }
-        Is stored in the self.userdb list
-        - self.userdb: a list of dictionaries, each symbolized by user_record"""
-        for user_record in self.userdb:
-            # assign dictionary values for ease of reference
-            user_id = user_record['id']
-            user_password = user_record['password']
-            user_email = user_record['email']
-            first_name = user_record['first_name']
-            last_name = user_record['last_name']
-            # make instance of User class with required parameters
-            user = User(user_id, first_name, last_name, user_email, user_password)
-            # check that there is an id value in the dictionary
-            if user.user_id:
-                # check that the email in the dictionary is the same as that entered
-                # by the user
-                if user.check_email(email):
-                    # check that the password in the dictionary is the same as that entered
-                    # by the user
-                    if user.check_password(password, user_password):
-                        return user_id
-
+        - password: Holds the user's entered password"""
+        user = self._find_user(email)
+        if user is None:
+            return None
+        user_id, old_hash = user.user_id, user.password
+        # check that the password stored for the e-mail address
+        # is the same as that entered by the user
+        if self.hasher.check(password, old_hash):
+            # hashes made with an outdated cost factor are replaced in the background
+            if self.hasher.needs_rehash(old_hash):
+                self.hasher.rehash(password, lambda new_hash: self._replace_password(
+                    user_id, old_hash, new_hash))
+            return user_id
+
+    def _replace_password(self, user_id, old_hash, new_hash):
+        """Stores a new hash for the user unless the password has
+        been changed since old_hash was read."""
+        self._commit('set_password', user_id, new_hash, old_hash)
+
+    @timed_method
     def reset_password(self, email, password, new_password):
         """Changes the user's password
         - email: Holds the user's entered e-mail address.
         - password: Holds the user's entered password.
-        - user_record: a dictionary storing the user details
-        in the following format:
-        {
-            'id': randint,
-            'first_name': 'string',
-            'last_name': 'string',
-            'email': 'string',
-            'password': 'hashed password converted to string format'
-        }
-        Is stored in the self.userdb list
-        - self.userdb: a list of dictionaries, each symbolized by user_record"""
-        for user_record in self.userdb:
-            # assign dictionary values for ease of reference
-            user_password = user_record['password']
-            user_email = user_record['email']
-            user_id = user_record['id']
-            first_name = user_record['first_name']
-            last_name = user_record['last_name']
-            # make instance of User class with required parameters
-            user = User(user_id, first_name, last_name, user_email, user_password)
-            # check that there is an id for the user
-            if user_id:
-                # check that the email passed to reset_password is the same as that
-                # in the dictionary
-                if user.check_email(email):
-                    # check that the password passed to reset_password
-                    # is the same as that in the dictionary
-                    if user.check_password(password, user_password):
-                        # call the change_password method from the User class to switch the the string password
-                        # passed to reset_password with that stored in new_password
-                        password = user.change_password(new_password)
-                        # update the value of the password in the dictionary
-                        user_password = user.set_password(password)
-                        user_record['password'] = user_password
-                        # check if the password matches the hashed password
-                        # in the dictionary
-                        if user.check_password(password, user_record['password']):
-                            return True
-                        return False
-
-    def create_business(self, user_id, business_id, name, location, category, description):
+        - new_password: Holds the password to switch to."""
+        user = self._find_user(email)
+        if user is None:
+            return None
+        # check that the password passed to reset_password
+        # is the same as that stored for the user
+        old_hash = user.password
+        if not self.hasher.check(password, old_hash):
+            return None
+        # update the value of the password in the stored record
+        return self._commit('set_password', user.user_id, self.hasher.hash(new_password), old_hash)
+
+    @timed_method
+    def create_business(self, user_id, business_id, name, location, category, description,
+                        latitude=None, longitude=None):
         """Creates a business for the user
         - user_id: ID of the user creating the business.
         - business_id: ID of the created business.
@@ -145,49 +459,183 @@ class Connect():
         - location: Holds where the business is located.
         - category: Holds the category which the business falls under.
         - description: Holds the description of the business.
-        - reviews: Holds reviews associated with the business.
-        - user_business: Dictionary holding details of a given business as follows:
+        - latitude, longitude: Coordinates of the business in degrees, if known.
+        - user_business: Business holding details of the business.
+        Is kept by the storage backend, and returned as a dictionary as follows:
         {
             'user_id': integer,
             'business_id': integer,
             'name': 'string',
             'location': 'string',
             'description': 'string',
-            'category': 'string'
-        }
-        Is stored in the self.business list
-        - self.business: Holds a list of businesses, each in dictionary format."""
+            'category': 'string',
+            'latitude': number or None,
+            'longitude': number or None
+        }"""
+        user_business = self._new_business(user_id, business_id, name, location, category, description,
+                                           latitude, longitude)
+        if isinstance(user_business, str):
+            return user_business
+        # add the created business to the storage backend, which rejects
+        # a business id that is already taken
+        if not self._commit('add_business', user_business):
+            return False
+        return user_business.to_dict()
+
+    def _new_business(self, user_id, business_id, name, location, category, description,
+                      latitude=None, longitude=None):
+        """Returns the record of a business to create, or a message
+        if a field is missing."""
         # make sure that no empty fields are entered as part of the business details
         if name is None or location is None or category is None or description is None:
             return "Missing Field: Please provide Name & Description."
 
-        # make an instance of the business class
-        business = Business(business_id, name, location, description, category)
-        # create the user's business
-        user_business = {
-            'user_id': user_id,
-            'business_id': business.business_id,
-            'name': business.name,
-            'location': business.location,
-            'description': business.description,
-            'category': business.category,
-            'reviews': []
-        }
-        #add the created business as a list entry in self.business
-        self.business.append(user_business)
-        return user_business
-
-    def get_businesses(self):
+        # make the Business record kept by the storage backend
+        return Business(business_id, name, location, description, category, user_id, latitude, longitude)
+
+    @timed_method
+    def create_businesses(self, user_id, businesses):
+        """Creates several businesses for the user at once. They are added
+        under a single write lock, in one storage transaction and one log record.
+        Returns a result per business, in order, as create_business would:
+        the created business, a message if a field is missing, or False if
+        the business id is taken.
+        - user_id: ID of the user creating the businesses.
+        - businesses: list of dictionaries holding the business_id, name,
+        location, category and description of each business, and
+        optionally its latitude and longitude."""
+        results = []
+        changes = []
+        for item in businesses:
+            user_business = self._new_business(user_id, item.get('business_id'), item.get('name'),
+                                               item.get('location'), item.get('category'),
+                                               item.get('description'), item.get('latitude'),
+                                               item.get('longitude'))
+            if isinstance(user_business, str):
+                results.append(user_business)
+            else:
+                results.append(None)
+                changes.append(['add_business', [user_business]])
+        return self._batch_results(results, changes)
+
+    def _batch_results(self, results, changes):
+        """Commits a batch of changes and puts the result of each change
+        in the positions of results left to None."""
+        applied = iter(self._commit('batch', changes))
+        for position, result in enumerate(results):
+            if result is None:
+                change_result = next(applied)
+                results[position] = change_result.to_dict() if change_result else False
+        return results
+
+    @timed_method
+    def get_businesses(self, as_json=False):
         """Gets all businesses on the application
-        for a logged-in user"""
+        for a logged-in user
+        - as_json: return every business as its JSON encoding"""
         all_businesses = []
-        for item in self.business:
-            item1 = item.copy()
-            item1.pop('reviews', None)
-            all_businesses.append(item1)
+        with self.lock.read():
+            for item in self.storage.all_businesses():
+                item1 = item.to_json() if as_json else item.to_dict()
+                all_businesses.append(item1)
         return all_businesses
 
-    def update_business(self, user_id, business_id, name=None, location=None, description=None, category=None):
+    @timed_method
+    def page_businesses(self, limit, after=None, as_json=False):
+        """Gets one page of businesses ordered by business ID.
+        Returns the businesses and the cursor for the next page,
+        which is None on the last page.
+        - limit: Maximum number of businesses on the page.
+        - after: Cursor returned with the previous page.
+        - as_json: return every business as its JSON encoding"""
+        page = []
+        with self.lock.read():
+            records = self.storage.page_businesses(after, limit + 1)
+            for item in records[:limit]:
+                item1 = item.to_json() if as_json else item.to_dict()
+                page.append(item1)
+        if len(records) > limit:
+            return page, records[limit - 1].business_id
+        return page, None
+
+    def iter_businesses(self, after=None, chunk_size=500, as_json=False):
+        """Yields all businesses ordered by business ID, one at a time,
+        so that they can be streamed without building the whole list.
+        The lock is only held while a chunk of businesses is copied, not
+        while the caller works through them.
+        - after: business ID to start after.
+        - as_json: yield every business as its JSON encoding"""
+        while True:
+            with self.lock.read():
+                records = self.storage.page_businesses(after, chunk_size)
+                chunk = [item.to_json() if as_json else item.to_dict() for item in records]
+            for item1 in chunk:
+                yield item1
+            if len(records) < chunk_size:
+                return
+            after = records[-1].business_id
+
+    @timed_method
+    def search_businesses(self, query=None, category=None, location=None, limit=20, offset=0, as_json=False):
+        """Searches businesses by text, category and location.
+        Returns one page of matching businesses, best matches first,
+        and the total number of matches.
+        - query: Words to look for in business names and descriptions.
+        - category: Category the businesses must fall under.
+        - location: Location the businesses must be in.
+        - limit: Maximum number of businesses on the page.
+        - offset: Number of matches to skip.
+        - as_json: return every business as its JSON encoding"""
+        results = []
+        with self.lock.read():
+            business_ids, total = self.search_index.search(query, category, location, limit, offset)
+            for business_id in business_ids:
+                item = self.storage.get_business(business_id)
+                item1 = item.to_json() if as_json else item.to_dict()
+                results.append(item1)
+        return results, total
+
+    @timed_method
+    def nearby_businesses(self, latitude, longitude, radius, limit=20, category=None, as_json=False):
+        """Finds the businesses within a distance of a point, nearest first,
+        each with its distance in metres. Only the grid cells within the
+        distance are looked at.
+        - latitude, longitude: the point, in degrees
+        - radius: largest distance in metres
+        - limit: Maximum number of businesses to return.
+        - category: only return businesses of this category (case-insensitive)
+        - as_json: return the businesses as their JSON encodings"""
+        results = []
+        with self.lock.read():
+            include = None
+            if category is not None:
+                include = self.search_index.categories.get(normalize(category))
+                if not include:
+                    return results
+            for metres, business_id in self.geo_index.nearby(latitude, longitude, radius, limit, include):
+                business = self.storage.get_business(business_id)
+                if as_json:
+                    results.append(business.to_json()[:-1] + b',"distance":%.1f}' % metres)
+                else:
+                    item = business.to_dict()
+                    item['distance'] = round(metres, 1)
+                    results.append(item)
+        return results
+
+    @timed_method
+    def get_user_businesses(self, user_id):
+        """Gets the businesses created by a single user
+        - user_id: ID of the user who created the businesses."""
+        user_businesses = []
+        with self.lock.read():
+            for item in self.storage.businesses_for_user(user_id):
+                item1 = item.to_dict()
+                user_businesses.append(item1)
+        return user_businesses
+
+    @timed_method
+    def update_business(self, user_id, business_id, name=None, location=None, description=None, category=None,
+                        latitude=None, longitude=None):
         """Updates an existing business with details provided by the user.
         - user_id: ID of the user creating the business.
         - business_id: ID of the created business.
@@ -195,178 +643,186 @@ class Connect():
         - location: Holds where the business is located.
         - category: Holds the category which the business falls under.
         - description: Holds the description of the business.
-        - reviews: Holds reviews associated with the business.
-        - user_business: Dictionary holding details of a given business as follows:
+        - latitude, longitude: Coordinates of the business in degrees.
+        - my_business: Business holding details of the business, returned
+        as a dictionary as follows:
         {
             'user_id': integer,
             'business_id': integer,
             'name': 'string',
             'location': 'string',
             'description': 'string',
-            'category': 'string'
-        }
-        Is stored in the self.business list
-        - self.business: Holds a list of businesses, each in dictionary format."""
-        # iterate through list of businesses
-        for my_business in self.business:
-            # check that the user ID given is associated with the business
-            if user_id == my_business['user_id']:
-                # check that the business ID given is associated with the business
-                if business_id == my_business['business_id']:
-                    # make instance of the Business class with the parameters passed
-                    business = Business(business_id, name, location, description, category)
-                    # if we have a value for 'name', change the business name
-                    if name is not None:
-                        new_name = business.change_name(name)
-                        my_business['name'] = new_name
-                    # if we have a value for 'location', change the business location
-                    if location is not None:
-                        new_location = business.change_location(location)
-                        my_business['location'] = new_location
-                    # if we have a value for 'description', change the business description
-                    if description is not None:
-                        new_description = business.change_description(description)
-                        my_business['description'] = new_description
-                    # if we have a value for 'category', change the business category
-                    if category is not None:
-                        new_category = business.change_category(category)
-                        my_business['category'] = new_category
-                    # return the updated business
-                    return my_business
-        return False
-
-    def get_business(self, business_id):
-        all_businesses = []
-        for item in self.business:
-            item1 = item.copy()
-            item1.pop('reviews', None)
-            all_businesses.append(item1)
-
-            for business in all_businesses:
-                for key in business.keys():
-                    if key == 'id' and business[key] == business_id:
-                        return business
-
+            'category': 'string',
+            'latitude': number or None,
+            'longitude': number or None
+        }"""
+        changes = self._business_changes(user_id, business_id, name, location, description, category,
+                                         latitude, longitude)
+        if changes is False:
+            return False
+        my_business = self._commit('update_business', business_id, changes)
+        if not my_business:
+            return False
+        # return the updated business
+        return my_business.to_dict()
+
+    def _business_changes(self, user_id, business_id, name, location, description, category,
+                          latitude=None, longitude=None):
+        """Returns the fields of a business to change, or False if the
+        business does not exist or belongs to another user."""
+        with self.lock.read():
+            my_business = self.storage.get_business(business_id)
+            owner = None if my_business is None else my_business.user_id
+        # check that the business exists and that the user ID given is associated with it
+        if my_business is None or owner != user_id:
+            return False
+        changes = {}
+        # if we have a value for 'name', change the business name
+        if name is not None:
+            changes['name'] = name
+        # if we have a value for 'location', change the business location
+        if location is not None:
+            changes['location'] = location
+        # if we have a value for 'description', change the business description
+        if description is not None:
+            changes['description'] = description
+        # if we have a value for 'category', change the business category
+        if category is not None:
+            changes['category'] = category
+        # if we have coordinates, move the business
+        if latitude is not None and longitude is not None:
+            changes['latitude'] = latitude
+            changes['longitude'] = longitude
+        return changes
+
+    @timed_method
+    def update_businesses(self, user_id, updates):
+        """Updates several businesses of the user at once, under a single
+        write lock, in one storage transaction and one log record.
+        Returns a result per update, in order, as update_business would:
+        the updated business, or False if the business does not exist or
+        belongs to another user.
+        - user_id: ID of the user who owns the businesses.
+        - updates: list of dictionaries holding the business_id and the
+        name, location, description, category and coordinates to change, if any."""
+        results = []
+        changes = []
+        for item in updates:
+            business_id = item.get('business_id')
+            business_changes = self._business_changes(user_id, business_id, item.get('name'),
+                                                      item.get('location'), item.get('description'),
+                                                      item.get('category'), item.get('latitude'),
+                                                      item.get('longitude'))
+            results.append(business_changes)
+            if business_changes is not False:
+                changes.append(['update_business', [business_id, business_changes]])
+        return self._batch_results(results, changes)
+
+    @timed_method
+    def get_business(self, business_id, as_json=False):
+        """Gets a single business by its ID, with its number of reviews
+        - business_id: ID of the business.
+        - as_json: return the business as its JSON encoding"""
+        with self.lock.read():
+            business = self.storage.get_business(business_id)
+            if business is None:
+                return None
+            review_count = self.storage.review_count(business_id)
+            if as_json:
+                # the count changes with every review, so it is added to the
+                # cached encoding of the business rather than kept in it
+                return business.to_json()[:-1] + b',"review_count":%d}' % review_count
+            business = business.to_dict()
+            business['review_count'] = review_count
+        return business
+
+    @timed_method
     def delete_business(self, business_id):
         """Deletes a business created by the user."""
         if business_id is not None:
-            for my_business in self.business:
-                if my_business['id'] == business_id:
-                    self.business.remove(my_business)
-                    return True
+            return self._commit('delete_business', business_id)
 
+    @timed_method
     def add_review(self, business_id, review_id, user_review):
-        """Adds a review by a user"""
-        if business_id is not None:
-            for business in self.business:
-                for key, value in business.items():
-                    if key == 'id' and value == business_id:
-                        review = Review(review_id, user_review)
-                        new_review = {
-                            'id': review.review_id,
-                            'review': review.review
-                        }
-                        business['reviews'].append(new_review)
-                        return business
-
-    def get_reviews(self, business_id):
-        """Gets all reviews for a single business and
-        shows them to a logged-in user."""
-        if business_id is not None:
-            for business in self.business:
-                for business_id in business:
-                    return business['reviews']
-
-
-class User():
-    """Basic blueprint of the User class.
-    Provides the foundation for how the user interacts
-    with the application."""
-
-    def __init__(self, user_id, first_name, last_name, email, password):
-        """Required parameters for the User class
-        - user_id: Holds the user id
-        - first_name: Holds the user's first name
-        - last_name: Holds the user's last name
-        - password: Holds the user's password"""
-        self.user_id = user_id
-        self.first_name = first_name
-        self.last_name = last_name
-        self.email = email
-        self.password = password
-
-    def set_password(self, password):
-        """Sets the user's password. Handles password hashing
-        as well.
-        - password: Holds the user's password"""
-        salt = bcrypt.gensalt(16)
-        password = self.password
-        hashed_password = bcrypt.hashpw(password.encode('utf8'), salt)
-        return hashed_password.decode('utf8')
-
-    def check_password(self, password, hashed_password):
-        """Checks that the password entered is the same
-        as the hashed password we have
-        - password: Holds the entered password
-        - hashed_password: Holds the (stored) hashed password."""
-        return bcrypt.checkpw(password.encode('utf8'), hashed_password.encode('utf8'))
-
-    def check_email(self, email):
-        """Checks that the email entered is the same
-        as the email we have
-        - email: Holds the entered password
-        - user_email: Holds the (stored) email."""
-        if email == self.email:
-            return True
-        return False
-
-    def change_password(self, fresh_password):
-        """Changes the password of the user.
-        - password: Holds the (old entered) password
-        of the user
-        - fresh_password: Holds the (new entered) password
-        of the user"""
-        if self.password != fresh_password:
-            self.password = fresh_password
-            return self.password
-        return False
-
-class Business():
-    """Basic blueprint of the Business class.
-    Provides the foundation for how the businesses will
-    be modeled in with the application."""
-
-    def __init__(self, business_id, name, location, description, category):
-        self.business_id = business_id
-        self.name = name
-        self.location = location
-        self.description = description
-        self.category = category
-
-    def change_name(self, new_name):
-        """Changes business name."""
-        self.name = new_name
-        return new_name
-
-    def change_description(self, new_description):
-        """Changes business description"""
-        self.description = new_description
-        return new_description
-
-    def change_location(self, new_location):
-        """Changes business name."""
-        self.name = new_location
-        return new_location
-
-    def change_category(self, new_category):
-        """Changes business description"""
-        self.category = new_category
-        return new_category
-
-
-class Review():
-    def __init__(self, review_id, review):
-        self.review = review
-        self.review_id = review_id
-
+        """Adds a review by a user
+        Returns the new review, or None if there is no such business.
+        - business_id: ID of the business being reviewed.
+        - review_id: ID of the review.
+        - user_review: Text of the review."""
+        if self._commit('add_review', business_id, review_id, user_review):
+            return {
+                'id': review_id,
+                'review': user_review
+            }
 
+    @timed_method
+    def get_reviews(self, business_id, limit=None, after=0):
+        """Gets the reviews for a single business, oldest first, and
+        shows them to a logged-in user. Returns None if there is no such business.
+        - limit: Maximum number of reviews to return.
+        - after: Number of reviews already read, used as the cursor."""
+        with self.lock.read():
+            if self.storage.get_business(business_id) is None:
+                return None
+            reviews = self.storage.review_page(business_id, after, limit)
+        return [{'id': review_id, 'review': review} for review_id, review in reviews]
+
+    @timed_method
+    def review_count(self, business_id):
+        """Gets the number of reviews of a business."""
+        with self.lock.read():
+            return self.storage.review_count(business_id)
+
+    @timed_method
+    def get_changes(self, since):
+        """Gets the events of the changes made to businesses after lsn
+        since, oldest first, as (seq, JSON encoding) pairs, and the lsn
+        to ask from next time. The events are None if some of them are
+        no longer held, or if since is ahead of the databases, as after a
+        restart without persistence; the businesses must then be read again."""
+        with self.lock.read():
+            if since > self.lsn:
+                return None, self.lsn
+            return self.change_feed.since(since), self.lsn
+
+    def current_lsn(self):
+        """Gets the lsn of the latest change, from which get_changes
+        returns the changes made next."""
+        return self.lsn
+
+    def wait_changes(self, since, timeout):
+        """Gets the events after lsn since like get_changes, first waiting
+        up to timeout seconds for one if there is none."""
+        events, lsn = self.get_changes(since)
+        if events == []:
+            self.change_feed.wait(since, timeout)
+            events, lsn = self.get_changes(since)
+        return events, lsn
+
+    @timed_method
+    def get_stats(self, limit=TOP_REVIEWED):
+        """Gets the number of businesses and reviews, the TOP_KEYS categories
+        and locations with the most businesses and their number of businesses,
+        the number of categories and locations, and the most reviewed
+        businesses. The counts are kept up to date by every change, so
+        reading them does not depend on the number of businesses.
+        - limit: Number of most reviewed businesses to return, at most TOP_REVIEWED."""
+        with self.lock.read():
+            index = self.search_index
+            businesses = len(index.entries)
+            most_reviewed = []
+            for business_id, review_count in self.top_reviewed.top(limit):
+                business = self.storage.get_business(business_id)
+                most_reviewed.append({'business_id': business_id, 'name': business.name,
+                                      'review_count': review_count})
+            return {
+                'businesses': businesses,
+                'reviews': self.review_total,
+                'reviews_per_business': self.review_total / businesses if businesses else 0,
+                # categories and locations are counted under their normalized form
+                'categories': dict(index.category_counts.top(TOP_KEYS)),
+                'locations': dict(index.location_counts.top(TOP_KEYS)),
+                'category_count': len(index.category_counts),
+                'location_count': len(index.location_counts),
+                'most_reviewed': most_reviewed
+            }
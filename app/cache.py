@@ -0,0 +1,122 @@
+"""Cache of serialized responses for business reads.
+Bodies are kept with a strong ETag and evicted least recently used
+first. Connect tells the cache which businesses changed, so a cached
+body is never served after the data behind it has changed."""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+
+def make_etag(body):
+    """Returns a strong ETag for a response body."""
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+class ResponseCache():
+    """LRU cache of (etag, body) pairs.
+    Keys are ('business', business_id) for a single business and
+    ('businesses', parameters) for lists, which depend on every business.
+    - max_entries: number of bodies kept
+    - max_bytes: total size of the bodies kept. Bodies larger than a
+    tenth of it are not cached.
+    - size: total size of the bodies kept
+    - connect: Connect whose changes invalidate the cache
+    - instance: random tag of the cache, put in the ETags made from versions,
+    which only mean something to the process that made them"""
+
+    def __init__(self, max_entries=10000, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.list_keys = set()
+        self.connect = None
+        self.instance = os.urandom(8).hex()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def attach(self, connect):
+        """Empties the cache and follows the changes made to a Connect."""
+        with self.lock:
+            self.entries.clear()
+            self.list_keys.clear()
+            self.size = 0
+            self.connect = connect
+        connect.listeners.append(self.invalidate)
+
+    def version(self, key):
+        """Returns the current version of the data behind a key. Read it
+        before building a body and pass it to put."""
+        if key[0] == 'business':
+            return self.connect.business_version(key[1])
+        return self.connect.catalogue_version
+
+    def catalogue_etag(self):
+        """Returns an ETag for responses built from the whole catalogue
+        without caching them, made from the catalogue version."""
+        return '%s-%d' % (self.instance, self.connect.catalogue_version)
+
+    def get(self, key):
+        """Returns the cached (etag, body) of a key, or None."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, body, version):
+        """Caches a body built from the given version of the data and
+        returns its (etag, body). The body is not cached if the data
+        changed while it was being built."""
+        entry = (make_etag(body), body)
+        if len(body) * 10 > self.max_bytes:
+            return entry
+        with self.lock:
+            if self.connect is None or self.version(key) != version:
+                return entry
+            replaced = self.entries.pop(key, None)
+            if replaced is not None:
+                self.size -= len(replaced[1])
+            self.entries[key] = entry
+            self.size += len(body)
+            if key[0] == 'businesses':
+                self.list_keys.add(key)
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                evicted, (_, evicted_body) = self.entries.popitem(last=False)
+                self.size -= len(evicted_body)
+                self.list_keys.discard(evicted)
+                self.evictions += 1
+        return entry
+
+    def invalidate(self, business_id, catalogue_changed):
+        """Drops the bodies that depend on a business.
+        - catalogue_changed: whether the change shows in business lists"""
+        with self.lock:
+            entry = self.entries.pop(('business', business_id), None)
+            if entry is not None:
+                self.size -= len(entry[1])
+            if catalogue_changed:
+                for key in self.list_keys:
+                    self.size -= len(self.entries.pop(key)[1])
+                self.list_keys.clear()
+
+    def stats(self):
+        """Returns the hit and miss counters."""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': float(self.hits) / lookups if lookups else 0.0,
+                'evictions': self.evictions
+            }
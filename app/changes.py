@@ -0,0 +1,75 @@
+"""Feed of the changes made to businesses.
+Every change to a business is kept as an event in a bounded ring,
+numbered with the lsn of the change that made it, so clients can ask
+for the events after the last one they saw instead of reading every
+business again, or wait for new ones."""
+import threading
+from collections import deque
+
+# number of events kept unless another is given
+FEED_SIZE = 10000
+
+
+class ChangeFeed():
+    """Ring of the most recent business events, encoded as JSON.
+    Events of one change share its sequence number; a batch makes
+    several events with the same number.
+    - size: number of events kept
+    - events: deque of (seq, encoded event) pairs, oldest first
+    - start: events numbered up to start are not held, either dropped
+    from the ring or made before the feed was started
+    - last: number of the latest event
+    - condition: notified when a change has added events"""
+
+    def __init__(self, size=FEED_SIZE):
+        self.size = size
+        self.events = deque()
+        self.start = 0
+        self.last = 0
+        self.condition = threading.Condition()
+
+    def clear(self, seq):
+        """Drops every event, for databases loaded as of seq rather than
+        built by the changes the feed saw."""
+        self.events.clear()
+        self.start = self.last = seq
+
+    def append(self, seq, kind, business_id, fields=b''):
+        """Adds an event.
+        - seq: lsn of the change making the event
+        - kind: one of 'created', 'updated', 'deleted' and 'reviewed'
+        - fields: encoded members added to the event, each starting with a comma"""
+        events = self.events
+        if len(events) >= self.size:
+            self.start = events.popleft()[0]
+        self.last = seq
+        events.append((seq, b'{"seq":%d,"type":"%s","business_id":%d%s}' % (seq, kind.encode(), business_id,
+                                                                           fields)))
+
+    def since(self, seq):
+        """Returns the (seq, encoded event) pairs numbered after seq, oldest
+        first, or None if some of them are no longer held. Only the events
+        returned are looked at."""
+        if seq < self.start:
+            return None
+        events = []
+        for event in reversed(self.events):
+            if event[0] <= seq:
+                break
+            events.append(event)
+        events.reverse()
+        return events
+
+    def publish(self):
+        """Wakes the subscribers waiting for events."""
+        with self.condition:
+            self.condition.notify_all()
+
+    def wait(self, seq, timeout):
+        """Waits up to timeout seconds for events numbered after seq."""
+        with self.condition:
+            return self.condition.wait_for(lambda: self.last > seq, timeout)
+
+    def after_fork(self):
+        # nobody waits on the feed in a new process
+        self.condition = threading.Condition()
@@ -0,0 +1,70 @@
+"""Revoked JWTs.
+Logging out adds the jti (unique id) of the token to a TokenDenylist,
+and every request to a protected route checks that its token is not in
+it. Entries are dropped once their token expires, since expired tokens
+are turned away anyway, so the denylist only holds the tokens revoked
+during the lifetime of a token."""
+import threading
+import time
+
+
+class TokenDenylist():
+    """Set of revoked token ids that forgets them when their tokens expire.
+    Expiry uses a time wheel: a ring of slots, each holding the ids of the
+    tokens that expire within one resolution-long tick. Revoking a token
+    and checking one are a dictionary operation; as time passes the
+    sweep empties the slots of the ticks gone by.
+    - resolution: seconds covered by a slot of the wheel
+    - slots: number of slots. Tokens expiring more than a full turn of the
+    wheel ahead stay in their slot until the turn they expire in.
+    - clock: function returning the time in seconds"""
+
+    def __init__(self, resolution=60, slots=64, clock=time.time):
+        self.resolution = resolution
+        self.clock = clock
+        self.lock = threading.Lock()
+        # expiry time of every revoked token id; None for tokens that never expire
+        self.expiries = {}
+        self.wheel = [set() for _ in range(slots)]
+        self.tick = int(clock() // resolution)
+
+    def __contains__(self, jti):
+        return jti in self.expiries
+
+    def __len__(self):
+        return len(self.expiries)
+
+    def revoke(self, jti, expires=None):
+        """Adds a token to the denylist.
+        - jti: unique id of the token
+        - expires: time the token expires at, in seconds, or None if it never does"""
+        now = self.clock()
+        with self.lock:
+            if jti in self.expiries:
+                return
+            if expires is not None:
+                if expires <= now:
+                    return
+                self.wheel[int(expires // self.resolution) % len(self.wheel)].add(jti)
+            self.expiries[jti] = expires
+            self._sweep(now)
+
+    def sweep(self):
+        """Drops the tokens that have expired.
+        Returns the number of tokens dropped."""
+        with self.lock:
+            return self._sweep(self.clock())
+
+    def _sweep(self, now):
+        tick = int(now // self.resolution)
+        dropped = 0
+        # each slot is visited once per tick gone by, and at most once per call
+        for passed in range(self.tick, min(tick, self.tick + len(self.wheel))):
+            slot = self.wheel[passed % len(self.wheel)]
+            expired = [jti for jti in slot if self.expiries[jti] <= now]
+            for jti in expired:
+                slot.discard(jti)
+                del self.expiries[jti]
+            dropped += len(expired)
+        self.tick = max(self.tick, tick)
+        return dropped
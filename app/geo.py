@@ -0,0 +1,114 @@
+"""Spatial index for businesses.
+Businesses with coordinates are kept in a grid of cells a fixed number
+of degrees wide, so a nearby search only looks at the businesses in the
+cells within its radius."""
+import heapq
+import math
+
+# mean radius of the Earth in metres
+EARTH_RADIUS = 6371008.8
+METRES_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+
+# width and height of a grid cell in degrees, about 5.5 km of latitude
+CELL_SIZE = 0.05
+
+
+def distance(latitude1, longitude1, latitude2, longitude2):
+    """Returns the great-circle distance between two points in metres."""
+    phi1 = math.radians(latitude1)
+    phi2 = math.radians(latitude2)
+    sin_phi = math.sin((phi2 - phi1) / 2)
+    sin_lambda = math.sin(math.radians(longitude2 - longitude1) / 2)
+    a = sin_phi * sin_phi + math.cos(phi1) * math.cos(phi2) * sin_lambda * sin_lambda
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+class GridIndex():
+    """Grid over latitude and longitude holding the businesses that have coordinates.
+    - cell_size: width and height of a cell in degrees
+    - columns: number of cells around a parallel; columns wrap around
+    at the antimeridian
+    - cells: dictionary mapping a (row, column) cell to a dictionary of
+    {business_id: (latitude, longitude)}. Only cells holding businesses are kept.
+    - entries: dictionary mapping a business id to its cell, so that the
+    business can be taken out of the index again"""
+
+    def __init__(self, cell_size=CELL_SIZE):
+        self.cell_size = cell_size
+        self.columns = int(math.ceil(360 / cell_size))
+        self.cells = {}
+        self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _row(self, latitude):
+        return int(math.floor((latitude + 90) / self.cell_size))
+
+    def _column(self, longitude):
+        return int(math.floor((longitude + 180) / self.cell_size))
+
+    def add(self, business):
+        """Indexes a business record under its coordinates, if it has any.
+        - business: Business record"""
+        business_id = business.business_id
+        if business_id in self.entries:
+            self.remove(business_id)
+        if business.latitude is None or business.longitude is None:
+            return
+        cell = (self._row(business.latitude), self._column(business.longitude) % self.columns)
+        self.cells.setdefault(cell, {})[business_id] = (business.latitude, business.longitude)
+        self.entries[business_id] = cell
+
+    def remove(self, business_id):
+        """Takes a business out of the index."""
+        cell = self.entries.pop(business_id, None)
+        if cell is None:
+            return
+        points = self.cells[cell]
+        del points[business_id]
+        if not points:
+            del self.cells[cell]
+
+    def nearby(self, latitude, longitude, radius, limit, include=None):
+        """Finds the businesses within radius metres of a point.
+        Returns up to limit (distance in metres, business id) pairs, nearest first.
+        - include: set of the business ids that may be returned, or None for all"""
+        span = radius / METRES_PER_DEGREE
+        first_row = self._row(max(latitude - span, -90.0))
+        last_row = self._row(min(latitude + span, 90.0))
+        # a degree of longitude shrinks towards the poles, so the columns
+        # are widened for the parallel of the box nearest to a pole
+        widest = max(abs(latitude - span), abs(latitude + span))
+        columns = None
+        if widest < 90:
+            longitude_span = span / math.cos(math.radians(widest))
+            first_column = self._column(longitude - longitude_span)
+            last_column = self._column(longitude + longitude_span)
+            if last_column - first_column + 1 < self.columns:
+                columns = set(column % self.columns for column in range(first_column, last_column + 1))
+        box = (last_row - first_row + 1) * (self.columns if columns is None else len(columns))
+
+        if include is not None and len(include) < box:
+            # fewer businesses to check than cells to look up
+            points = []
+            for business_id in include:
+                cell = self.entries.get(business_id)
+                if cell is not None:
+                    points.append((business_id, self.cells[cell][business_id]))
+        else:
+            if box <= len(self.cells):
+                cells = [self.cells.get((row, column)) for row in range(first_row, last_row + 1)
+                         for column in (range(self.columns) if columns is None else columns)]
+            else:
+                # a sparse grid holds fewer cells than the box covers
+                cells = [points for (row, column), points in self.cells.items()
+                         if first_row <= row <= last_row and (columns is None or column in columns)]
+            points = [item for cell in cells if cell for item in cell.items()
+                      if include is None or item[0] in include]
+        found = []
+        for business_id, (point_latitude, point_longitude) in points:
+            metres = distance(latitude, longitude, point_latitude, point_longitude)
+            if metres <= radius:
+                found.append((metres, business_id))
+        return heapq.nsmallest(limit, found)
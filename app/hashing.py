@@ -0,0 +1,138 @@
+"""Password hashing for the application.
+bcrypt runs in a pool of worker processes so that request threads
+only wait for a result instead of spending seconds of CPU themselves."""
+import os
+import queue
+import threading
+import traceback
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import bcrypt
+
+from .metrics import BCRYPT_DURATION, REGISTRY
+
+DEFAULT_ROUNDS = 12
+
+
+def hash_password(password, rounds=DEFAULT_ROUNDS):
+    """Returns the bcrypt hash of a password in string format.
+    - password: Holds the password to hash
+    - rounds: Holds the bcrypt cost factor"""
+    return bcrypt.hashpw(password.encode('utf8'), bcrypt.gensalt(rounds)).decode('utf8')
+
+
+def check_password(password, hashed_password):
+    """Checks that a password matches a stored bcrypt hash.
+    - password: Holds the entered password
+    - hashed_password: Holds the (stored) hashed password."""
+    return bcrypt.checkpw(password.encode('utf8'), hashed_password.encode('utf8'))
+
+
+def hash_rounds(hashed_password):
+    """Returns the cost factor a bcrypt hash was made with,
+    or None if the hash cannot be read.
+    Hashes look like $2b$12$<salt and digest>."""
+    try:
+        return int(hashed_password.split('$')[2])
+    except (IndexError, ValueError):
+        return None
+
+
+class PasswordHasher():
+    """Hashes and checks passwords in a bounded process pool.
+    - rounds: bcrypt cost factor used for new hashes
+    - workers: number of hashing processes. 0 runs bcrypt
+    in the calling thread instead.
+    - max_pending: number of jobs allowed to be queued or running
+    at once. Further callers wait for a free slot.
+    - finished: queue of the rehashes done, with their callbacks, passed
+    on by the rehash thread"""
+
+    def __init__(self, rounds=DEFAULT_ROUNDS, workers=None, max_pending=None):
+        self.rounds = rounds
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        self.max_pending = max_pending or max(self.workers, 1) * 4
+        self.slots = threading.BoundedSemaphore(self.max_pending)
+        self.lock = threading.Lock()
+        self.pool = None
+        self.pool_pid = None
+        self.finished = None
+        self.finished_pid = None
+
+    def _get_pool(self):
+        """Returns the process pool, starting it on first use.
+        The pool is tied to the process that started it so a forked
+        server worker starts its own instead of sharing its parent's."""
+        with self.lock:
+            if self.pool is None or self.pool_pid != os.getpid():
+                self.pool = ProcessPoolExecutor(self.workers)
+                self.pool_pid = os.getpid()
+            return self.pool
+
+    def _get_finished(self):
+        """Returns the queue of finished rehashes, starting the thread
+        that runs their callbacks on first use. Like the pool, it is tied
+        to the process that started it."""
+        with self.lock:
+            if self.finished is None or self.finished_pid != os.getpid():
+                self.finished = queue.Queue()
+                self.finished_pid = os.getpid()
+                threading.Thread(target=self._run_callbacks, args=(self.finished,), name='rehash',
+                                 daemon=True).start()
+            return self.finished
+
+    def _run_callbacks(self, finished):
+        while True:
+            future, callback = finished.get()
+            try:
+                callback(future.result())
+            except Exception:
+                # the old hash is kept and the next login tries again
+                traceback.print_exc()
+
+    def submit(self, func, *args, blocking=True):
+        """Runs func(*args) in the pool and returns a Future.
+        Returns None if blocking is False and every slot is taken."""
+        if self.workers == 0:
+            future = Future()
+            try:
+                future.set_result(func(*args))
+            except Exception as error:
+                future.set_exception(error)
+            return future
+        if not self.slots.acquire(blocking):
+            return None
+        try:
+            future = self._get_pool().submit(func, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda done: self.slots.release())
+        return future
+
+    @REGISTRY.timed(BCRYPT_DURATION, op='hash')
+    def hash(self, password):
+        """Returns the hash of a password made with the configured cost."""
+        return self.submit(hash_password, password, self.rounds).result()
+
+    @REGISTRY.timed(BCRYPT_DURATION, op='check')
+    def check(self, password, hashed_password):
+        """Checks that a password matches a stored hash."""
+        return self.submit(check_password, password, hashed_password).result()
+
+    def needs_rehash(self, hashed_password):
+        """Checks whether a stored hash was made with a different cost."""
+        return hash_rounds(hashed_password) != self.rounds
+
+    def rehash(self, password, callback):
+        """Hashes a password with the configured cost in the background
+        and passes the new hash to callback once it is ready.
+        The callback runs in the rehash thread rather than in the pool's
+        result thread, which it would hold up while it waits for the
+        databases, and its errors are printed rather than dropped.
+        The rehash is skipped when the pool is busy; the next
+        login will try again."""
+        future = self.submit(hash_password, password, self.rounds, blocking=False)
+        if future is not None:
+            finished = self._get_finished()
+            future.add_done_callback(lambda done: finished.put((done, callback)))
@@ -0,0 +1,128 @@
+"""Generator of unique ids for users, businesses and reviews.
+Ids are 63-bit integers laid out like Snowflake ids:
+
+    41 bits milliseconds since EPOCH | 10 bits worker | 12 bits sequence
+
+so ids made later are larger. That makes them usable as pagination
+cursors and keeps new records at the end of indexes sorted by id.
+Generators with different worker numbers never make the same id.
+Processes sharing databases on one machine lease their worker numbers
+from a lock file, since process ids are reused and collide."""
+import fcntl
+import os
+import threading
+import time
+import weakref
+
+# 2018-01-01T00:00:00Z in milliseconds; 41 bits of milliseconds last 69 years from it
+EPOCH = 1514764800000
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKER = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+
+def default_worker():
+    """Returns a worker number for this process, taken from its pid."""
+    return os.getpid() & MAX_WORKER
+
+
+def lease_worker(path):
+    """Returns a worker number that no other generator on the machine
+    leased from the same file. Worker n is held by a lock on byte n of the
+    file, which is released when the process exits and is not passed on
+    to forked processes.
+    Raises IOError if every worker number is taken."""
+    held = _leases.get(path)
+    if held is None:
+        # locks belong to the process, and closing any of its handles on
+        # the file drops them all, so one handle per file is kept open
+        held = _leases[path] = (open(path, 'ab'), set())
+    handle, workers = held
+    for worker in range(MAX_WORKER + 1):
+        if worker in workers:
+            continue
+        try:
+            fcntl.lockf(handle, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, worker)
+        except OSError:
+            continue
+        workers.add(worker)
+        return worker
+    raise IOError('Every worker number leased from %s is taken' % path)
+
+
+# generators whose worker number is taken from the process id
+_from_pid = weakref.WeakSet()
+# generators whose worker number is leased, and the files leased from
+_leased = weakref.WeakSet()
+_leases = {}
+
+
+def _after_fork():
+    # the parent's leases stay with the parent. Most forked processes (the
+    # hasher's pool, snapshot writers) never make ids, so a leased generator
+    # only leases a number again when it first makes one
+    for handle, _ in _leases.values():
+        handle.close()
+    _leases.clear()
+    for generator in _from_pid:
+        generator.worker = default_worker() << SEQUENCE_BITS
+        generator.lock = threading.Lock()
+    for generator in _leased:
+        generator.worker = None
+        generator.lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+class IdGenerator():
+    """Makes time-ordered ids for one worker.
+    Up to 4096 ids are made per millisecond. Past that, and when the
+    clock steps back, ids are taken from the next millisecond instead of
+    waiting for the clock, so ids keep increasing.
+    - worker: number between 0 and 1023 that no other running generator uses.
+    None leases it from the lease file if there is one, and otherwise takes
+    it from the process id, again in every forked process. A forked process
+    leases its number when it makes its first id.
+    - clock: function returning the time in seconds
+    - lease: lock file the processes sharing the databases lease their
+    worker numbers from, or None"""
+
+    def __init__(self, worker=None, clock=time.time, lease=None):
+        self.lease = lease
+        if worker is None and lease is not None:
+            worker = lease_worker(lease)
+            _leased.add(self)
+        elif worker is None:
+            worker = default_worker()
+            _from_pid.add(self)
+        if not 0 <= worker <= MAX_WORKER:
+            raise ValueError('worker must be between 0 and %d' % MAX_WORKER)
+        self.worker = worker << SEQUENCE_BITS
+        self.clock = clock
+        self.lock = threading.Lock()
+        # milliseconds since EPOCH and sequence number of the last id
+        self.last = -1
+        self.sequence = MAX_SEQUENCE
+
+    def next_id(self):
+        """Returns a new id."""
+        now = int(self.clock() * 1000) - EPOCH
+        with self.lock:
+            if self.worker is None:
+                self.worker = lease_worker(self.lease) << SEQUENCE_BITS
+            if now > self.last:
+                self.last = now
+                self.sequence = 0
+            elif self.sequence < MAX_SEQUENCE:
+                self.sequence += 1
+            else:
+                self.last += 1
+                self.sequence = 0
+            return (self.last << (WORKER_BITS + SEQUENCE_BITS)) | self.worker | self.sequence
+
+
+def id_time(generated_id):
+    """Returns the time, in seconds, encoded in an id."""
+    return ((generated_id >> (WORKER_BITS + SEQUENCE_BITS)) + EPOCH) / 1000.0
@@ -0,0 +1,50 @@
+"""Locks used to share the Connect class between threads."""
+import threading
+from contextlib import contextmanager
+
+
+class ReadWriteLock():
+    """Lock held by any number of readers at once or by a single writer.
+    Writers that are waiting go before readers that arrive after them, so
+    a steady stream of reads cannot starve the writes. The lock is not
+    reentrant: a thread must not take it again while holding it.
+    - readers: number of threads holding the lock for reading
+    - writing: whether a thread holds the lock for writing
+    - waiting_writers: number of threads waiting to write"""
+
+    def __init__(self):
+        self.condition = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writing = False
+        self.waiting_writers = 0
+
+    @contextmanager
+    def read(self):
+        """Holds the lock for reading inside the block."""
+        with self.condition:
+            while self.writing or self.waiting_writers:
+                self.condition.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.readers -= 1
+                if not self.readers and self.waiting_writers:
+                    self.condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        """Holds the lock for writing inside the block."""
+        with self.condition:
+            self.waiting_writers += 1
+            while self.writing or self.readers:
+                self.condition.wait()
+            self.waiting_writers -= 1
+            self.writing = True
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writing = False
+                self.condition.notify_all()
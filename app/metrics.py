@@ -0,0 +1,283 @@
+"""Latency and size metrics, exposed in the Prometheus text format.
+Requests are timed per route, method and status by Flask hooks,
+Connect methods and bcrypt calls by decorators. Durations go into
+log-linear histograms in the style of HdrHistogram: every doubling of
+the duration is split into BUCKETS_PER_DOUBLING buckets, so a few
+hundred counters cover microseconds to minutes with a bounded relative
+error. A sampling profiler can be started and stopped at run time."""
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+from functools import wraps
+
+BUCKETS_PER_DOUBLING = 4
+LOWEST = 0.00001
+HIGHEST = 100.0
+
+
+def _bounds():
+    bounds = []
+    bound = LOWEST
+    while bound < HIGHEST:
+        bounds.append(float('%.3g' % bound))
+        bound *= 2 ** (1.0 / BUCKETS_PER_DOUBLING)
+    return bounds
+
+
+# upper bounds, in seconds, of the histogram buckets
+BOUNDS = _bounds()
+
+REQUEST_DURATION = 'weconnect_http_request_duration_seconds'
+REQUEST_BYTES = 'weconnect_http_request_bytes_total'
+RESPONSE_BYTES = 'weconnect_http_response_bytes_total'
+CONNECT_DURATION = 'weconnect_connect_call_duration_seconds'
+BCRYPT_DURATION = 'weconnect_bcrypt_duration_seconds'
+
+DESCRIPTIONS = {
+    REQUEST_DURATION: 'Time taken to answer requests, per route, method and status.',
+    REQUEST_BYTES: 'Bytes received in request bodies.',
+    RESPONSE_BYTES: 'Bytes sent in response bodies that have a known length.',
+    CONNECT_DURATION: 'Time spent in Connect methods.',
+    BCRYPT_DURATION: 'Time request threads spend waiting for bcrypt, per operation. '
+                     'The _sum series is the total time spent in bcrypt.',
+}
+
+
+class Histogram():
+    """Counts of observed durations per bucket of BOUNDS.
+    - counts: one counter per bucket plus one for durations above the last bound
+    - sum: total of the observed durations
+    - count: number of observed durations"""
+
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(BOUNDS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(BOUNDS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, fraction):
+        """Returns the upper bound of the bucket holding the given quantile."""
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return BOUNDS[index] if index < len(BOUNDS) else float('inf')
+        return 0.0
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels, extra=''):
+    pairs = ['%s="%s"' % (name, _escape(value)) for name, value in labels]
+    if extra:
+        pairs.append(extra)
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+
+class Metrics():
+    """Registry of histograms and counters.
+    Series are keyed by metric name and a tuple of (label, value) pairs.
+    - enabled: whether anything is recorded; can be switched at run time"""
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+
+    def histogram(self, name, labels):
+        """Returns the histogram of a series, creating it if needed."""
+        key = (name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            return histogram
+
+    def observe(self, name, labels, value):
+        """Adds a duration to the histogram of a series."""
+        histogram = self.histogram(name, labels)
+        with self.lock:
+            histogram.observe(value)
+
+    def inc(self, name, labels, amount=1):
+        """Adds to the counter of a series."""
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def timed(self, name, **labels):
+        """Decorator recording how long each call of a function takes."""
+        histogram = self.histogram(name, tuple(sorted(labels.items())))
+        lock = self.lock
+        clock = time.perf_counter
+
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                start = clock()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    elapsed = clock() - start
+                    with lock:
+                        histogram.observe(elapsed)
+            return wrapper
+        return decorator
+
+    def init_app(self, app):
+        """Times every request of a Flask application and counts its bytes."""
+        from flask import g, request
+
+        @app.before_request
+        def start_timer():
+            if self.enabled:
+                g.metrics_start = time.perf_counter()
+
+        @app.after_request
+        def record_request(response):
+            start = g.pop('metrics_start', None)
+            if start is None:
+                return response
+            route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+            self.observe(REQUEST_DURATION, (('method', request.method), ('route', route),
+                                            ('status', response.status_code)),
+                         time.perf_counter() - start)
+            labels = (('method', request.method), ('route', route))
+            if request.content_length:
+                self.inc(REQUEST_BYTES, labels, request.content_length)
+            if not response.is_streamed:
+                self.inc(RESPONSE_BYTES, labels, response.calculate_content_length() or 0)
+            return response
+
+    def reset(self):
+        """Sets every series back to zero."""
+        with self.lock:
+            for histogram in self.histograms.values():
+                histogram.__init__()
+            self.counters.clear()
+
+    def render(self):
+        """Returns the series in the Prometheus text exposition format.
+        Histograms only list the buckets that hold durations, plus +Inf."""
+        with self.lock:
+            histograms = sorted((key, list(histogram.counts), histogram.sum, histogram.count)
+                                for key, histogram in self.histograms.items())
+            counters = sorted(self.counters.items())
+        lines = []
+        described = set()
+
+        def describe(name, kind):
+            if name not in described:
+                described.add(name)
+                lines.append('# HELP %s %s' % (name, DESCRIPTIONS.get(name, name)))
+                lines.append('# TYPE %s %s' % (name, kind))
+
+        for (name, labels), counts, total, count in histograms:
+            describe(name, 'histogram')
+            cumulative = 0
+            for index, bucket in enumerate(counts[:-1]):
+                cumulative += bucket
+                if bucket:
+                    lines.append('%s_bucket%s %d' % (name, _labels(labels, 'le="%r"' % BOUNDS[index]), cumulative))
+            lines.append('%s_bucket%s %d' % (name, _labels(labels, 'le="+Inf"'), count))
+            lines.append('%s_sum%s %r' % (name, _labels(labels), total))
+            lines.append('%s_count%s %d' % (name, _labels(labels), count))
+        for (name, labels), value in counters:
+            describe(name, 'counter')
+            lines.append('%s%s %d' % (name, _labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+
+class SamplingProfiler():
+    """Samples the stacks of every thread at a fixed interval and counts
+    them as folded stacks ("outer;inner;innermost count"), the input of
+    flame graph tools.
+    - interval: seconds between samples
+    - max_stacks: number of distinct stacks kept; others are dropped"""
+
+    def __init__(self, interval=0.005, max_stacks=10000):
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self.stacks = Counter()
+        self.samples = 0
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopping = threading.Event()
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+    def start(self, interval=None):
+        """Starts sampling. Samples taken before are kept."""
+        with self.lock:
+            if interval is not None:
+                self.interval = interval
+            if self.thread is not None:
+                return
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """Stops sampling."""
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            self.stopping.set()
+            thread.join()
+
+    def folded(self):
+        """Returns the sampled stacks, most frequent first."""
+        with self.lock:
+            stacks = self.stacks.most_common()
+        return ''.join('%s %d\n' % (stack, count) for stack, count in stacks)
+
+    def clear(self):
+        with self.lock:
+            self.stacks.clear()
+            self.samples = 0
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self.stopping.wait(self.interval):
+            frames = sys._current_frames()
+            sampled = []
+            for thread_id, frame in frames.items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('%s:%s' % (frame.f_globals.get('__name__', '?'), code.co_name))
+                    frame = frame.f_back
+                sampled.append(';'.join(reversed(stack)))
+            del frames
+            with self.lock:
+                self.samples += 1
+                for stack in sampled:
+                    if stack in self.stacks or len(self.stacks) < self.max_stacks:
+                        self.stacks[stack] += 1
+
+
+# registry shared by the application, Connect and the password hasher
+REGISTRY = Metrics()
+
+
+def timed_method(func):
+    """Decorator recording the duration of a Connect method under its name."""
+    return REGISTRY.timed(CONNECT_DURATION, method=func.__name__)(func)
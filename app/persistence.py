@@ -0,0 +1,284 @@
+"""Durable storage for the Connect class.
+Every change to the databases is appended to a write-ahead log before
+the caller gets its answer, and the whole state is periodically written
+to a snapshot so the log can be thrown away. On start-up the snapshot
+is loaded and the log records written after it are replayed. Snapshots
+are written by a forked process, which sees the databases as they were
+at the fork while the server goes on changing them.
+
+Log records are framed as <length, crc32> followed by a JSON body
+[lsn, op, args]. Log segments are named after the first sequence
+number (lsn) they may hold. A snapshot holds the lsn it was taken at
+and a pickled copy of the state."""
+import fcntl
+import json
+import mmap
+import os
+import pickle
+import struct
+import sys
+import threading
+import traceback
+import zlib
+
+RECORD_HEADER = struct.Struct('<II')
+SNAPSHOT_MAGIC = b'WCSNAP01'
+SNAPSHOT_HEADER = struct.Struct('<8sQ')
+SNAPSHOT_NAME = 'snapshot.bin'
+LOCK_NAME = 'lock'
+
+
+def _segment_name(first_lsn):
+    return 'wal-%020d.log' % first_lsn
+
+
+def _record_dict(value):
+    # User and Business records are logged as their dictionaries
+    return value.to_dict()
+
+
+def encode_record(lsn, op, args):
+    """Returns the bytes of one log record."""
+    body = json.dumps([lsn, op, args], separators=(',', ':'), default=_record_dict).encode('utf8')
+    return RECORD_HEADER.pack(len(body), zlib.crc32(body)) + body
+
+
+def read_records(path):
+    """Yields the (lsn, op, args) records of a log segment, stopping at
+    the first record that was not completely written."""
+    with open(path, 'rb') as segment:
+        data = segment.read()
+    position = 0
+    while position + RECORD_HEADER.size <= len(data):
+        length, checksum = RECORD_HEADER.unpack_from(data, position)
+        body = data[position + RECORD_HEADER.size:position + RECORD_HEADER.size + length]
+        if len(body) < length or zlib.crc32(body) != checksum:
+            return
+        lsn, op, args = json.loads(body.decode('utf8'))
+        yield lsn, op, args
+        position += RECORD_HEADER.size + length
+
+
+class WriteAheadLog():
+    """Append-only log with group commit.
+    Writers add records to an in-memory batch and wait; a flusher thread
+    writes and fsyncs the whole batch at once, so one fsync covers every
+    writer that arrived while the previous one was running.
+    - directory: folder holding the log segments
+    - sync: whether to fsync after each batch"""
+
+    def __init__(self, directory, sync=True):
+        self.directory = directory
+        self.sync = sync
+        self.condition = threading.Condition()
+        self.pending = []
+        self.last_lsn = 0
+        self.durable_lsn = 0
+        self.segment = None
+        self.error = None
+        self.closed = False
+        self.flusher = None
+
+    def open(self, last_lsn):
+        """Starts a new segment after the records already in the log.
+        - last_lsn: sequence number of the last record recovered"""
+        self.last_lsn = self.durable_lsn = last_lsn
+        self.segment = open(os.path.join(self.directory, _segment_name(last_lsn + 1)), 'wb')
+        self.flusher = threading.Thread(target=self._flush_loop, name='wal-flusher', daemon=True)
+        self.flusher.start()
+
+    def append(self, lsn, op, args):
+        """Queues a record for the next batch.
+        Records must be appended in lsn order."""
+        record = encode_record(lsn, op, args)
+        with self.condition:
+            self.pending.append(record)
+            self.last_lsn = lsn
+            self.condition.notify_all()
+
+    def wait(self, lsn):
+        """Blocks until the record with the given lsn is on disk."""
+        with self.condition:
+            self.condition.wait_for(lambda: self.durable_lsn >= lsn or self.error is not None)
+            if self.durable_lsn < lsn:
+                raise IOError('Write-ahead log failed: %s' % self.error)
+
+    def rotate(self):
+        """Flushes the current segment and starts a new one. The caller
+        must make sure nothing is appended while rotating.
+        Returns the names of the segments that came before the new one."""
+        self.wait(self.last_lsn)
+        with self.condition:
+            self.segment.close()
+            self.segment = open(os.path.join(self.directory, _segment_name(self.last_lsn + 1)), 'wb')
+            current = os.path.basename(self.segment.name)
+        return [name for name in segment_names(self.directory) if name < current]
+
+    def close(self):
+        """Flushes outstanding records and stops the flusher."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        if self.flusher is not None:
+            self.flusher.join()
+        if self.segment is not None:
+            self.segment.close()
+
+    def _flush_loop(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending or self.closed)
+                if not self.pending:
+                    return
+                batch, self.pending = self.pending, []
+                last_lsn = self.last_lsn
+                segment = self.segment
+            try:
+                segment.write(b''.join(batch))
+                segment.flush()
+                if self.sync:
+                    os.fsync(segment.fileno())
+            except (IOError, OSError, ValueError) as error:
+                with self.condition:
+                    self.error = error
+                    self.condition.notify_all()
+                return
+            with self.condition:
+                self.durable_lsn = last_lsn
+                self.condition.notify_all()
+
+
+def segment_names(directory):
+    """Returns the log segment names in the directory, oldest first."""
+    return sorted(name for name in os.listdir(directory)
+                  if name.startswith('wal-') and name.endswith('.log'))
+
+
+class Persistence():
+    """Write-ahead log plus snapshots kept in one directory.
+    - directory: folder holding the snapshot and the log segments
+    - snapshot_every: number of logged changes after which a new
+    snapshot is written in the background
+    - sync: whether log writes are fsynced
+    The directory has a single writer: a lock on its lock file is held from
+    construction until close, and a second Persistence of the same
+    directory, in this process or another, raises IOError."""
+
+    def __init__(self, directory, snapshot_every=100000, sync=True):
+        self.directory = directory
+        self.snapshot_every = snapshot_every
+        self.changes = 0
+        self.snapshotting = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.lock_file = open(os.path.join(directory, LOCK_NAME), 'ab')
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self.lock_file.close()
+            raise IOError('%s is used by another process. Processes sharing the data must '
+                          'go through a state process: set WECONNECT_SHARED_SOCKET' % directory)
+        self.log = WriteAheadLog(directory, sync)
+
+    def load_snapshot(self):
+        """Returns the (state, lsn) of the latest snapshot,
+        or (None, 0) if there is none. The file is mapped into memory
+        rather than read into a buffer first."""
+        path = os.path.join(self.directory, SNAPSHOT_NAME)
+        if not os.path.exists(path) or os.path.getsize(path) < SNAPSHOT_HEADER.size:
+            return None, 0
+        with open(path, 'rb') as snapshot, \
+                mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            magic, lsn = SNAPSHOT_HEADER.unpack_from(mapped, 0)
+            if magic != SNAPSHOT_MAGIC:
+                raise ValueError('%s is not a snapshot' % path)
+            with memoryview(mapped)[SNAPSHOT_HEADER.size:] as view:
+                state = pickle.loads(view)
+        return state, lsn
+
+    def replay(self, after):
+        """Yields the logged (lsn, op, args) records newer than the given lsn."""
+        for name in segment_names(self.directory):
+            for lsn, op, args in read_records(os.path.join(self.directory, name)):
+                if lsn > after:
+                    yield lsn, op, args
+                    after = lsn
+
+    def open(self, last_lsn):
+        """Starts logging after the recovered records."""
+        self.log.open(last_lsn)
+
+    def append(self, lsn, op, args):
+        """Queues a change for the log. Returns True when enough changes
+        have been logged that a snapshot is due."""
+        self.log.append(lsn, op, args)
+        self.changes += 1
+        return self.changes >= self.snapshot_every and not self.snapshotting.locked()
+
+    def wait(self, lsn):
+        """Blocks until the change with the given lsn is durable."""
+        self.log.wait(lsn)
+
+    def begin_snapshot(self):
+        """Starts a new log segment for a snapshot about to be taken.
+        Must be called while no changes are being logged.
+        Returns the segment names the snapshot makes obsolete, or None
+        if another snapshot is already being written."""
+        if not self.snapshotting.acquire(False):
+            return None
+        self.changes = 0
+        return self.log.rotate()
+
+    def fork_snapshot(self, dump, lsn, obsolete):
+        """Forks a process writing the state returned by dump() to the
+        snapshot file as taken at lsn, then deleting the log segments it
+        makes obsolete. The process copies the databases from its
+        copy-on-write view of memory as it was at the fork, so the caller
+        only has to keep them still while forking.
+        Returns the process id to give to wait_snapshot."""
+        try:
+            pid = os.fork()
+        except OSError:
+            self.snapshotting.release()
+            raise
+        if pid == 0:
+            try:
+                self._write_snapshot(dump(), lsn, obsolete)
+            except BaseException:
+                traceback.print_exc()
+                sys.stderr.flush()
+                os._exit(1)
+            os._exit(0)
+        return pid
+
+    def wait_snapshot(self, pid):
+        """Waits for the process started by fork_snapshot. Raises IOError
+        if it failed, in which case the log segments are kept."""
+        try:
+            _, status = os.waitpid(pid, 0)
+        finally:
+            self.snapshotting.release()
+        if status != 0:
+            raise IOError('Snapshot process failed with status %d' % status)
+
+    def _write_snapshot(self, state, lsn, obsolete):
+        path = os.path.join(self.directory, SNAPSHOT_NAME)
+        temporary = path + '.tmp'
+        with open(temporary, 'wb') as snapshot:
+            snapshot.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, lsn))
+            pickle.dump(state, snapshot, protocol=pickle.HIGHEST_PROTOCOL)
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.replace(temporary, path)
+        directory = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        for name in obsolete:
+            os.remove(os.path.join(self.directory, name))
+
+    def close(self):
+        """Flushes the log, closes it and lets another writer have the directory."""
+        self.log.close()
+        self.lock_file.close()
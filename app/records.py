@@ -0,0 +1,152 @@
+"""Records kept by the storage backends.
+Users and businesses are stored as instances of these classes. They use
+__slots__, so a record holds its values without a per-record dictionary
+of field names, and the category and location of businesses are
+interned, so businesses sharing them share a single string.
+Reviews have no record class: they are kept in the columns of a ReviewLog.
+Records are turned into dictionaries only when they leave Connect.
+Businesses also keep their JSON encoding once they have been sent, so
+unchanged businesses are not encoded again for every response."""
+import sys
+
+from .encoding import dumps
+
+# fields of the dictionaries made from user and business records,
+# in the order kept by snapshots and database rows
+USER_FIELDS = ('id', 'first_name', 'last_name', 'email', 'password')
+BUSINESS_FIELDS = ('user_id', 'business_id', 'name', 'location', 'description', 'category',
+                   'latitude', 'longitude')
+
+
+def _intern(value):
+    return sys.intern(value) if type(value) is str else value
+
+
+class User():
+    """Basic blueprint of the User class.
+    Provides the foundation for how the user interacts
+    with the application."""
+
+    __slots__ = ('user_id', 'first_name', 'last_name', 'email', 'password')
+
+    def __init__(self, user_id, first_name, last_name, email, password):
+        """Required parameters for the User class
+        - user_id: Holds the user id
+        - first_name: Holds the user's first name
+        - last_name: Holds the user's last name
+        - password: Holds the user's password, hashed once the user is stored"""
+        self.user_id = user_id
+        self.first_name = first_name
+        self.last_name = last_name
+        self.email = email
+        self.password = password
+
+    @classmethod
+    def from_dict(cls, user_record):
+        """Makes a user from a dictionary holding USER_FIELDS."""
+        return cls(*[user_record[field] for field in USER_FIELDS])
+
+    def to_dict(self):
+        """Returns the user as a dictionary holding USER_FIELDS."""
+        return {'id': self.user_id, 'first_name': self.first_name, 'last_name': self.last_name,
+                'email': self.email, 'password': self.password}
+
+    def to_row(self):
+        """Returns the values of USER_FIELDS as a tuple."""
+        return (self.user_id, self.first_name, self.last_name, self.email, self.password)
+
+
+class Business():
+    """Basic blueprint of the Business class.
+    Provides the foundation for how the businesses will
+    be modeled in with the application."""
+
+    __slots__ = ('user_id', 'business_id', 'name', 'location', 'description', 'category',
+                 'latitude', 'longitude', 'encoded')
+
+    def __init__(self, business_id, name, location, description, category, user_id=None,
+                 latitude=None, longitude=None):
+        self.user_id = user_id
+        self.business_id = business_id
+        self.name = name
+        self.location = _intern(location)
+        self.description = description
+        self.category = _intern(category)
+        # coordinates in degrees, or None for businesses placed by location only
+        self.latitude = latitude
+        self.longitude = longitude
+        # JSON encoding of to_dict(), made by to_json and dropped by every change
+        self.encoded = None
+
+    @classmethod
+    def from_dict(cls, business_record):
+        """Makes a business from a dictionary holding BUSINESS_FIELDS.
+        Dictionaries logged before businesses had coordinates lack them."""
+        return cls.from_row([business_record.get(field) for field in BUSINESS_FIELDS])
+
+    @classmethod
+    def from_row(cls, row):
+        """Makes a business from the values of BUSINESS_FIELDS. Rows of
+        snapshots written before businesses had coordinates lack them."""
+        user_id, business_id, name, location, description, category = row[:6]
+        latitude, longitude = row[6:] or (None, None)
+        return cls(business_id, name, location, description, category, user_id, latitude, longitude)
+
+    def to_dict(self):
+        """Returns the business as a dictionary holding BUSINESS_FIELDS."""
+        return {'user_id': self.user_id, 'business_id': self.business_id, 'name': self.name,
+                'location': self.location, 'description': self.description, 'category': self.category,
+                'latitude': self.latitude, 'longitude': self.longitude}
+
+    def to_json(self):
+        """Returns to_dict() encoded as JSON bytes, encoding it only once."""
+        encoded = self.encoded
+        if encoded is None:
+            encoded = self.encoded = dumps(self.to_dict())
+        return encoded
+
+    def to_row(self):
+        """Returns the values of BUSINESS_FIELDS as a tuple."""
+        return (self.user_id, self.business_id, self.name, self.location, self.description, self.category,
+                self.latitude, self.longitude)
+
+    def update(self, changes):
+        """Changes the fields named in a dictionary of changes."""
+        for field, value in changes.items():
+            getattr(self, 'change_' + field)(value)
+
+    def change_name(self, new_name):
+        """Changes business name."""
+        self.name = new_name
+        self.encoded = None
+        return new_name
+
+    def change_description(self, new_description):
+        """Changes business description"""
+        self.description = new_description
+        self.encoded = None
+        return new_description
+
+    def change_location(self, new_location):
+        """Changes business location."""
+        self.location = _intern(new_location)
+        self.encoded = None
+        return new_location
+
+    def change_category(self, new_category):
+        """Changes business category"""
+        self.category = _intern(new_category)
+        self.encoded = None
+        return new_category
+
+    def change_latitude(self, new_latitude):
+        """Changes business latitude"""
+        self.latitude = new_latitude
+        self.encoded = None
+        return new_latitude
+
+    def change_longitude(self, new_longitude):
+        """Changes business longitude"""
+        self.longitude = new_longitude
+        self.encoded = None
+        return new_longitude
@@ -0,0 +1,131 @@
+"""Search index for businesses.
+Keeps an inverted index from name and description tokens to business
+ids, plus exact-match indexes on category and location, so a search
+only looks at the businesses that match it."""
+import heapq
+import re
+
+from .stats import TopCounts
+
+TOKEN = re.compile(r'\w+')
+
+# a token found in the business name counts this many times
+# more than one found in the description
+NAME_WEIGHT = 2
+
+
+def tokenize(text):
+    """Splits text into lower-case word tokens."""
+    if not text:
+        return []
+    return TOKEN.findall(text.lower())
+
+
+def normalize(value):
+    """Returns the form of a category or location used as an index key."""
+    if value is None:
+        return None
+    return value.strip().lower()
+
+
+class SearchIndex():
+    """Inverted index over the businesses in a BusinessStore.
+    - tokens: dictionary mapping a token to a dictionary of
+    {business_id: weight of the token in that business}
+    - categories: dictionary mapping a normalized category to a set of business ids
+    - locations: dictionary mapping a normalized location to a set of business ids
+    - category_counts, location_counts: TopCounts of the businesses per
+    normalized category and location, for the statistics
+    - entries: dictionary mapping a business id to what was indexed for it,
+    so that the business can be taken out of the index again"""
+
+    def __init__(self):
+        self.tokens = {}
+        self.categories = {}
+        self.locations = {}
+        self.category_counts = TopCounts()
+        self.location_counts = TopCounts()
+        self.entries = {}
+
+    def add(self, business):
+        """Indexes a business record.
+        - business: Business record"""
+        business_id = business.business_id
+        if business_id in self.entries:
+            self.remove(business_id)
+        weights = {}
+        for token in tokenize(business.name):
+            weights[token] = weights.get(token, 0) + NAME_WEIGHT
+        for token in tokenize(business.description):
+            weights[token] = weights.get(token, 0) + 1
+        for token, weight in weights.items():
+            self.tokens.setdefault(token, {})[business_id] = weight
+        category = normalize(business.category)
+        location = normalize(business.location)
+        self.categories.setdefault(category, set()).add(business_id)
+        self.locations.setdefault(location, set()).add(business_id)
+        for counts, key in ((self.category_counts, category), (self.location_counts, location)):
+            if key is not None:
+                counts.add(key)
+        self.entries[business_id] = (tuple(weights), category, location)
+
+    def remove(self, business_id):
+        """Takes a business out of the index."""
+        entry = self.entries.pop(business_id, None)
+        if entry is None:
+            return
+        tokens, category, location = entry
+        for token in tokens:
+            postings = self.tokens[token]
+            del postings[business_id]
+            if not postings:
+                del self.tokens[token]
+        for index, key in ((self.categories, category), (self.locations, location)):
+            ids = index[key]
+            ids.discard(business_id)
+            if not ids:
+                del index[key]
+        for counts, key in ((self.category_counts, category), (self.location_counts, location)):
+            if key is not None:
+                counts.remove(key)
+
+    def search(self, query=None, category=None, location=None, limit=20, offset=0):
+        """Finds the businesses matching every query token and the given
+        category and location. Results are ranked by the weight of the
+        query tokens, then by business id.
+        Returns the ids of the requested page and the number of matches.
+        - query: free text matched against business names and descriptions
+        - category, location: exact (case-insensitive) filters"""
+        postings = []
+        for token in set(tokenize(query)):
+            if token not in self.tokens:
+                return [], 0
+            postings.append(self.tokens[token])
+        candidates = list(postings)
+        for index, key in ((self.categories, category), (self.locations, location)):
+            if key is not None:
+                ids = index.get(normalize(key))
+                if not ids:
+                    return [], 0
+                candidates.append(ids)
+        if not candidates:
+            return [], 0
+        # walk the smallest candidate set and check membership in the others
+        candidates.sort(key=len)
+        smallest, others = candidates[0], candidates[1:]
+        if others:
+            matches = [business_id for business_id in smallest
+                       if all(business_id in other for other in others)]
+        else:
+            matches = list(smallest)
+        if not postings:
+            ranked = heapq.nsmallest(offset + limit, matches)
+        elif len(postings) == 1:
+            weights = postings[0]
+            ranked = [business_id for _, business_id in heapq.nsmallest(
+                offset + limit, [(-weights[business_id], business_id) for business_id in matches])]
+        else:
+            ranked = [business_id for _, business_id in heapq.nsmallest(
+                offset + limit, [(-sum(p[business_id] for p in postings), business_id)
+                                 for business_id in matches])]
+        return ranked[offset:], len(matches)
@@ -0,0 +1,224 @@
+"""Shared state for several server processes on one machine.
+One state process holds the authoritative Connect and applies every
+change. The worker processes keep a replica of the databases in their own
+memory, so reads never leave the process. Their changes are forwarded to
+the state process, which streams every applied change back to all the
+replicas in log order.
+
+The state process is reached over a Unix socket. The first worker that
+finds no state process starts one:
+
+    WECONNECT_SHARED_SOCKET=/tmp/weconnect.sock gunicorn -w 4 app:app
+
+It can also be started on its own with
+
+    WECONNECT_STATE_SERVER=1 python -m app.state_server /tmp/weconnect.sock
+
+Connections are authenticated with a key shared by the processes,
+kept in a file next to the socket unless one is configured."""
+import fcntl
+import os
+import pickle
+import queue
+import socket
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+from .storage import MemoryStorage
+
+
+class StateServer():
+    """Serves a Connect to the replicas of the worker processes.
+    A connection either forwards changes, sending ('commit', op, args) and
+    getting back ('ok', result, lsn) or ('error', message), or follows the
+    changes, sending ('subscribe', after) and getting back a copy of the
+    databases followed by a (lsn, op, args) message per change.
+    A replica that already holds the databases as of lsn `after`, such as
+    a worker forked from a process that loaded them, gets no copy when the
+    changes it missed are still in the history; they are sent instead.
+    - connect: Connect holding the databases. It must use MemoryStorage.
+    - address: path of the Unix socket
+    - authkey: bytes shared with the clients, or None
+    - history: number of recent changes kept for replicas catching up"""
+
+    def __init__(self, connect, address, authkey=None, history=100000):
+        if not isinstance(connect.storage, MemoryStorage):
+            raise ValueError('Shared state needs MemoryStorage')
+        self.connect = connect
+        self.history = deque(maxlen=history)
+        with connect.lock.write():
+            connect.followers.append(lambda lsn, op, args: self.history.append((lsn, op, args)))
+        self.listener = Listener(address, 'AF_UNIX', authkey=authkey)
+        self.closed = False
+
+    def serve_forever(self):
+        """Accepts connections until the listener is closed."""
+        while True:
+            try:
+                connection = self.listener.accept()
+            except (OSError, EOFError, AuthenticationError):
+                if self.closed:
+                    return
+                continue
+            threading.Thread(target=self._serve, args=(connection,), daemon=True).start()
+
+    def close(self):
+        """Stops accepting connections."""
+        self.closed = True
+        self.listener.close()
+
+    def _serve(self, connection):
+        try:
+            while True:
+                message = connection.recv()
+                if message[0] == 'subscribe':
+                    self._stream(connection, message[1])
+                    return
+                _, op, args = message
+                try:
+                    result, lsn = self.connect._commit_change(op, args)
+                except Exception as error:
+                    connection.send(('error', str(error)))
+                else:
+                    connection.send(('ok', result, lsn))
+        except (EOFError, OSError):
+            pass
+        finally:
+            connection.close()
+
+    def _stream(self, connection, after=None):
+        """Sends a copy of the databases, or nothing if the changes made
+        after lsn `after` are all in the history, and then every change."""
+        changes = queue.Queue()
+        follower = lambda lsn, op, args: changes.put((lsn, op, args))
+        # the copy and the start of the stream are taken at the same lsn
+        with self.connect.lock.write():
+            lsn = self.connect.lsn
+            if after is not None and after <= lsn and (
+                    after == lsn or (self.history and self.history[0][0] <= after + 1)):
+                state = None
+                for change in self.history:
+                    if change[0] > after:
+                        changes.put(change)
+            else:
+                state = self.connect.storage.dump()
+            self.connect.followers.append(follower)
+        try:
+            connection.send_bytes(pickle.dumps((state, lsn), pickle.HIGHEST_PROTOCOL))
+            del state
+            while True:
+                connection.send(changes.get())
+        finally:
+            with self.connect.lock.write():
+                self.connect.followers.remove(follower)
+
+
+class StateClient():
+    """Connection of a replica to the state process.
+    - address: path of the Unix socket
+    - authkey: bytes shared with the server, or None"""
+
+    def __init__(self, address, authkey=None):
+        self.address = address
+        self.authkey = authkey
+        self.lock = threading.Lock()
+        self.connection = Client(address, 'AF_UNIX', authkey=authkey)
+        self.stream = None
+
+    def commit(self, op, args):
+        """Has the state process apply a change.
+        Returns the result of the change and its lsn."""
+        with self.lock:
+            self.connection.send(('commit', op, args))
+            reply = self.connection.recv()
+        if reply[0] == 'error':
+            raise IOError('State process failed: %s' % reply[1])
+        return reply[1], reply[2]
+
+    def subscribe(self, after=None):
+        """Starts following the changes.
+        Returns a copy of the databases and the lsn it was taken at.
+        - after: lsn of the databases the caller already holds. The copy is
+        then None and the stream starts with the changes made after it,
+        unless the state process no longer has them."""
+        self.stream = Client(self.address, 'AF_UNIX', authkey=self.authkey)
+        self.stream.send(('subscribe', after))
+        return pickle.loads(self.stream.recv_bytes())
+
+    def changes(self):
+        """Yields the (lsn, op, args) changes applied after the copy,
+        until the state process goes away."""
+        try:
+            while True:
+                yield self.stream.recv()
+        except (EOFError, OSError):
+            return
+        finally:
+            self.stream.close()
+
+    def close(self, shutdown=True):
+        """Closes the connections. The thread reading the changes sees the
+        end of the stream and closes it.
+        - shutdown: end the stream. A forked process closing the connections
+        it got from its parent must not, or the parent's stream ends too."""
+        self.connection.close()
+        if self.stream is not None and not self.stream.closed:
+            if not shutdown:
+                self.stream.close()
+                return
+            with socket.fromfd(self.stream.fileno(), socket.AF_UNIX, socket.SOCK_STREAM) as stream_socket:
+                stream_socket.shutdown(socket.SHUT_RDWR)
+
+
+def shared_key(address):
+    """Returns the key authenticating the connections to the state process
+    listening on address, kept in <address>.key. The first process asking
+    for it makes a random one, readable by its user only."""
+    path = address + '.key'
+    if not os.path.exists(path):
+        # written whole under another name and then linked, so that no
+        # process reads half of it and only one of the keys made is kept
+        temporary = '%s.%d' % (path, os.getpid())
+        with os.fdopen(os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as key_file:
+            key_file.write(os.urandom(32).hex().encode())
+        try:
+            os.link(temporary, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.unlink(temporary)
+    with open(path, 'rb') as key_file:
+        return key_file.read()
+
+
+def connect_state(address, authkey=None, timeout=10):
+    """Returns a StateClient connected to the state process listening on
+    address, starting the process first if none is running. A lock file
+    next to the socket makes sure only one worker starts it."""
+    with open(address + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            return StateClient(address, authkey)
+        except (FileNotFoundError, ConnectionRefusedError):
+            pass
+        # a socket left behind by a state process that died
+        if os.path.exists(address):
+            os.unlink(address)
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        environment = dict(os.environ, WECONNECT_STATE_SERVER='1',
+                           PYTHONPATH=os.pathsep.join(filter(None, [root, os.environ.get('PYTHONPATH')])))
+        subprocess.Popen([sys.executable, '-m', 'app.state_server', address], env=environment,
+                         start_new_session=True)
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                return StateClient(address, authkey)
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
@@ -0,0 +1,26 @@
+"""Runs the state process shared by the worker processes.
+
+    WECONNECT_STATE_SERVER=1 python -m app.state_server /tmp/weconnect.sock
+
+The databases are set up from the same configuration as the workers',
+in memory, so WECONNECT_DATA_DIR makes the shared state durable."""
+import signal
+import sys
+
+from app import app, views
+from app.shared import StateServer, shared_key
+
+
+def main():
+    address = sys.argv[1] if len(sys.argv) > 1 else app.config['SHARED_SOCKET']
+    server = StateServer(views.weconnect, address, app.config['SHARED_AUTHKEY'] or shared_key(address))
+    # let atexit flush the log when the process is terminated
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    finally:
+        server.close()
+
+
+if __name__ == '__main__':
+    main()
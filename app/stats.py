@@ -0,0 +1,146 @@
+"""Statistics kept up to date as businesses and reviews change, so that
+they can be read without going through the catalogue."""
+import heapq
+from bisect import bisect_left, insort
+from itertools import islice
+
+# number of businesses ranked by TopReviewed unless another is given
+TOP_REVIEWED = 10
+
+# number of categories and of locations returned with the statistics
+TOP_KEYS = 20
+
+
+class TopReviewed():
+    """The k businesses with the most reviews.
+    A pool of more than k candidates is kept, holding the most reviewed
+    businesses, so that removing a ranked business lets the next
+    candidate move up. Adding a review costs O(log pool). Only when
+    removals leave fewer than k candidates while other businesses have
+    reviews is a rebuild from every business needed.
+    - k: number of businesses ranked
+    - pool: number of candidates kept, 4 * k unless another is given
+    - counts: dictionary mapping each candidate business id to its review count
+    - heap: min-heap of (review count, business id) pairs. Pairs whose count
+    is not the one in counts are left over from earlier counts and skipped.
+    - complete: whether every business with reviews is a candidate
+    - ranked: the k most reviewed candidates as returned by top, sorted
+    once after each change"""
+
+    def __init__(self, k=TOP_REVIEWED, pool=None):
+        self.k = k
+        self.pool = pool or 4 * k
+        self.counts = {}
+        self.heap = []
+        self.complete = True
+        self.ranked = None
+
+    def rebuild(self, review_counts):
+        """Ranks the businesses anew.
+        - review_counts: iterable of (business id, review count) pairs"""
+        reviewed = [(count, business_id) for business_id, count in review_counts if count]
+        top = heapq.nlargest(self.pool, reviewed)
+        self.counts = dict((business_id, count) for count, business_id in top)
+        self.heap = top[::-1]
+        heapq.heapify(self.heap)
+        self.complete = len(top) == len(reviewed)
+        self.ranked = None
+
+    def reviewed(self, business_id, count):
+        """Records the new review count of a business."""
+        if business_id in self.counts:
+            self.counts[business_id] = count
+        elif len(self.counts) < self.pool:
+            self.counts[business_id] = count
+        else:
+            self._drop_stale()
+            # a business is left out of the candidates either way
+            self.complete = False
+            if (count, business_id) <= self.heap[0]:
+                return
+            _, lowest = heapq.heappop(self.heap)
+            del self.counts[lowest]
+            self.counts[business_id] = count
+        heapq.heappush(self.heap, (count, business_id))
+        self.ranked = None
+        # left over pairs are cleared out before they outnumber the current ones
+        if len(self.heap) > 2 * self.pool:
+            self._heapify()
+
+    def remove(self, business_id):
+        """Stops ranking a business. Returns True if too few candidates
+        are left, in which case the ranking must be rebuilt."""
+        if self.counts.pop(business_id, None) is None:
+            return False
+        self._heapify()
+        self.ranked = None
+        return len(self.counts) < self.k and not self.complete
+
+    def top(self, limit=None):
+        """Returns up to limit (business id, review count) pairs, most
+        reviewed first, limit being at most k."""
+        if self.ranked is None:
+            self.ranked = sorted(self.counts.items(), key=lambda item: (-item[1], item[0]))[:self.k]
+        return self.ranked[:limit]
+
+    def _heapify(self):
+        self.heap = [(count, business_id) for business_id, count in self.counts.items()]
+        heapq.heapify(self.heap)
+
+    def _drop_stale(self):
+        while self.heap and self.counts.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+
+
+class TopCounts():
+    """Number of businesses per key, such as a category or a location,
+    from which the keys with the most businesses are read without looking
+    at the others. Keys are grouped by their count and the distinct counts
+    are kept sorted; since a count only moves by one, a change moves a key
+    between neighbouring groups.
+    - counts: dictionary mapping each key to its number of businesses
+    - keys: dictionary mapping a count to the set of keys having it
+    - order: sorted list of the counts in keys"""
+
+    def __init__(self):
+        self.counts = {}
+        self.keys = {}
+        self.order = []
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self, key):
+        """Counts one more business for the key."""
+        self._move(key, 1)
+
+    def remove(self, key):
+        """Counts one business less for the key."""
+        self._move(key, -1)
+
+    def top(self, limit):
+        """Returns up to limit (key, count) pairs, largest counts first.
+        Keys with the same count come in no particular order."""
+        found = []
+        for count in reversed(self.order):
+            if len(found) >= limit:
+                break
+            found.extend((key, count) for key in islice(self.keys[count], limit - len(found)))
+        return found
+
+    def _move(self, key, step):
+        count = self.counts.pop(key, 0)
+        if count:
+            group = self.keys[count]
+            group.discard(key)
+            if not group:
+                del self.keys[count]
+                del self.order[bisect_left(self.order, count)]
+        count += step
+        if count > 0:
+            self.counts[key] = count
+            group = self.keys.get(count)
+            if group is None:
+                group = self.keys[count] = set()
+                insort(self.order, count)
+            group.add(key)
@@ -0,0 +1,489 @@
+"""Storage backends for the Connect class.
+Connect keeps its indexes and rules to itself and delegates keeping
+user, business and review records to one of these classes:
+- MemoryStorage holds everything in the dictionaries of app.store.
+- SQLiteStorage holds everything in an SQLite database file, so the
+data can be larger than memory and survives restarts on its own."""
+import fcntl
+import queue
+import sqlite3
+import threading
+import time
+from array import array
+from contextlib import contextmanager
+
+from .denylist import TokenDenylist
+from .records import Business, User
+from .store import BusinessStore, ReviewLog, ReviewStore, UserStore, normalize_email
+
+
+class Storage():
+    """Interface of the storage backends.
+    Records are passed in and out as User and Business instances. Reviews are (review id, text) pairs kept in the order
+    they were added to their business."""
+
+    def get_user(self, user_id):
+        """Returns the user record with the given id, or None."""
+        raise NotImplementedError
+
+    def get_user_by_email(self, email):
+        """Returns the user record registered with an e-mail address, or None."""
+        raise NotImplementedError
+
+    def add_user(self, user_record):
+        """Adds a user. Returns False if the e-mail address or id is taken."""
+        raise NotImplementedError
+
+    def set_password(self, user_id, new_hash, old_hash):
+        """Replaces a user's password hash if it is still old_hash.
+        Returns whether it was replaced."""
+        raise NotImplementedError
+
+    def get_business(self, business_id):
+        """Returns the business record with the given id, or None."""
+        raise NotImplementedError
+
+    def add_business(self, business_record):
+        """Adds a business. Returns False if the business id is taken."""
+        raise NotImplementedError
+
+    def update_business(self, business_id, changes):
+        """Updates fields of a business. Returns the updated record,
+        or None if there is no such business."""
+        raise NotImplementedError
+
+    def delete_business(self, business_id):
+        """Deletes a business and its reviews. Returns the deleted
+        record, or None if there is no such business."""
+        raise NotImplementedError
+
+    def all_businesses(self):
+        """Returns every business record."""
+        raise NotImplementedError
+
+    def businesses_for_user(self, user_id):
+        """Returns the business records owned by a user."""
+        raise NotImplementedError
+
+    def page_businesses(self, after=None, limit=None):
+        """Returns up to limit business records in business id order,
+        starting after the given business id."""
+        raise NotImplementedError
+
+    def iter_businesses(self, after=None, chunk_size=500):
+        """Yields business records in business id order, a chunk at a time."""
+        while True:
+            chunk = self.page_businesses(after, chunk_size)
+            for business_record in chunk:
+                yield business_record
+            if len(chunk) < chunk_size:
+                return
+            after = chunk[-1].business_id
+
+    def add_review(self, business_id, review_id, text):
+        """Appends a review to a business."""
+        raise NotImplementedError
+
+    def review_page(self, business_id, start=0, limit=None):
+        """Returns up to limit (review id, text) pairs of a business,
+        skipping the first start reviews."""
+        raise NotImplementedError
+
+    def review_count(self, business_id):
+        """Returns the number of reviews of a business."""
+        raise NotImplementedError
+
+    def review_counts(self):
+        """Returns (business id, number of reviews) pairs for every
+        business with reviews."""
+        raise NotImplementedError
+
+    def revoke_token(self, jti, expires):
+        """Records a revoked token until it expires.
+        - expires: time the token expires at, in seconds, or None if it never does"""
+        raise NotImplementedError
+
+    def revoked_tokens(self):
+        """Returns (token id, expiry time) pairs for every revoked token
+        that has not expired."""
+        raise NotImplementedError
+
+    @contextmanager
+    def transaction(self):
+        """Groups the writes made inside the block. Backends that have
+        no use for it run the block as it is."""
+        yield
+
+    def close(self):
+        """Releases the resources held by the backend."""
+
+    def after_fork(self):
+        """Drops, in a forked process, the resources it shares with the
+        process it was forked from."""
+
+
+class MemoryStorage(Storage):
+    """Keeps records in memory.
+    - users: UserStore indexed by e-mail address and user id
+    - businesses: BusinessStore indexed by business id and owner
+    - reviews: ReviewStore holding one append-only log per business
+    - revoked: TokenDenylist of the revoked tokens"""
+
+    def __init__(self):
+        self.users = UserStore()
+        self.businesses = BusinessStore()
+        self.reviews = ReviewStore()
+        self.revoked = TokenDenylist()
+
+    def get_user(self, user_id):
+        return self.users.get(user_id)
+
+    def get_user_by_email(self, email):
+        return self.users.get_by_email(email)
+
+    def add_user(self, user_record):
+        return self.users.add(user_record)
+
+    def set_password(self, user_id, new_hash, old_hash):
+        user_record = self.users.get(user_id)
+        if user_record is None or user_record.password != old_hash:
+            return False
+        user_record.password = new_hash
+        return True
+
+    def get_business(self, business_id):
+        return self.businesses.get(business_id)
+
+    def add_business(self, business_record):
+        return self.businesses.add(business_record)
+
+    def update_business(self, business_id, changes):
+        business_record = self.businesses.get(business_id)
+        if business_record is not None:
+            business_record.update(changes)
+        return business_record
+
+    def delete_business(self, business_id):
+        self.reviews.remove(business_id)
+        return self.businesses.remove(business_id)
+
+    def all_businesses(self):
+        return list(self.businesses)
+
+    def businesses_for_user(self, user_id):
+        return self.businesses.for_user(user_id)
+
+    def page_businesses(self, after=None, limit=None):
+        return self.businesses.page(after, limit)
+
+    def iter_businesses(self, after=None, chunk_size=500):
+        return self.businesses.iter_from(after, chunk_size)
+
+    def add_review(self, business_id, review_id, text):
+        self.reviews.add(business_id, review_id, text)
+
+    def review_page(self, business_id, start=0, limit=None):
+        return self.reviews.page(business_id, start, limit)
+
+    def review_count(self, business_id):
+        return self.reviews.count(business_id)
+
+    def review_counts(self):
+        return [(business_id, len(log)) for business_id, log in self.reviews.logs.items() if len(log)]
+
+    def revoke_token(self, jti, expires):
+        self.revoked.revoke(jti, expires)
+
+    def revoked_tokens(self):
+        self.revoked.sweep()
+        return list(self.revoked.expiries.items())
+
+    def dump(self):
+        """Returns a copy of the records made of plain tuples, for snapshots."""
+        return {
+            'users': [user.to_row() for user in self.users],
+            'businesses': [business.to_row() for business in self.businesses],
+            'reviews': [(business_id, log.ids.tobytes(), list(log.texts))
+                        for business_id, log in self.reviews.logs.items()],
+            'revoked': self.revoked_tokens()
+        }
+
+    def load(self, state):
+        """Adds the records of a copy made by dump."""
+        for user in state['users']:
+            self.users.add(User(*user))
+        for business in state['businesses']:
+            self.businesses.add(Business.from_row(business))
+        for business_id, ids, texts in state['reviews']:
+            log = self.reviews.logs[business_id] = ReviewLog()
+            log.ids = array('q', ids)
+            log.texts = texts
+        # copies made before tokens were revoked through the databases have none
+        for jti, expires in state.get('revoked', ()):
+            self.revoked.revoke(jti, expires)
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    first_name TEXT,
+    last_name TEXT,
+    email TEXT NOT NULL,
+    email_key TEXT NOT NULL UNIQUE,
+    password TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS businesses (
+    business_id INTEGER PRIMARY KEY,
+    user_id INTEGER,
+    name TEXT,
+    location TEXT,
+    description TEXT,
+    category TEXT,
+    review_count INTEGER NOT NULL DEFAULT 0,
+    latitude REAL,
+    longitude REAL
+);
+CREATE INDEX IF NOT EXISTS businesses_user_id ON businesses (user_id);
+CREATE INDEX IF NOT EXISTS businesses_category ON businesses (category);
+CREATE TABLE IF NOT EXISTS reviews (
+    business_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    review_id INTEGER NOT NULL,
+    review TEXT,
+    PRIMARY KEY (business_id, position)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS revoked_tokens (
+    jti TEXT PRIMARY KEY,
+    expires REAL
+) WITHOUT ROWID;
+'''
+
+SELECT_USER = 'SELECT id, first_name, last_name, email, password FROM users '
+SELECT_BUSINESS = ('SELECT user_id, business_id, name, location, description, category, latitude, longitude '
+                   'FROM businesses ')
+
+
+class SQLiteStorage(Storage):
+    """Keeps records in an SQLite database in WAL mode.
+    Connections are kept in a pool and lent to a thread for each read or
+    transaction, so threads that come and go, such as those of a server
+    starting a thread per request, reuse them. Statements are fixed strings
+    so each connection's statement cache keeps them prepared. Reviews are
+    clustered by (business_id, position), and the review count is kept on
+    the business row.
+    - path: file holding the database
+    - pool_size: most connections opened; threads wait for one beyond that
+    - cached_statements: size of each connection's prepared statement cache
+    - idle: queue of the connections not lent to a thread
+    - connections: every connection opened, so that close can close them
+    The database has a single user process: Connect keeps its indexes and
+    caches in memory, and another process changing the file would leave them
+    stale. A lock on <path>.lock is held from construction until close, and
+    a second SQLiteStorage of the same file raises IOError."""
+
+    def __init__(self, path, pool_size=8, cached_statements=256):
+        self.lock_file = open(path + '.lock', 'ab')
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self.lock_file.close()
+            raise IOError('%s is used by another process. The sqlite backend serves a single '
+                          'process; use the memory backend with WECONNECT_SHARED_SOCKET for several' % path)
+        self.path = path
+        self.pool_size = pool_size
+        self.cached_statements = cached_statements
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.idle = queue.Queue()
+        self.connections = []
+        with self._connection() as connection:
+            connection.executescript(SCHEMA)
+            # databases made before businesses had coordinates get the columns
+            columns = [row[1] for row in connection.execute('PRAGMA table_info(businesses)')]
+            for column in ('latitude', 'longitude'):
+                if column not in columns:
+                    connection.execute('ALTER TABLE businesses ADD COLUMN %s REAL' % column)
+
+    @contextmanager
+    def _connection(self):
+        """Lends a connection to the calling thread inside the block.
+        Nested blocks get the same connection, so reads made inside a
+        transaction see its writes."""
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            yield connection
+            return
+        connection = self._checkout()
+        self.local.connection = connection
+        try:
+            yield connection
+        finally:
+            self.local.connection = None
+            self.idle.put(connection)
+
+    def _checkout(self):
+        """Takes an idle connection, opening one if the pool is not full."""
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            opening = len(self.connections) < self.pool_size
+            if opening:
+                connection = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False,
+                                             cached_statements=self.cached_statements)
+                self.connections.append(connection)
+        if not opening:
+            return self.idle.get()
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    @contextmanager
+    def transaction(self):
+        """Runs the writes made inside the block in one transaction.
+        Nested blocks join the outer transaction."""
+        with self._connection() as connection:
+            if connection.in_transaction:
+                yield connection
+                return
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield connection
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+
+    def _fetchone(self, sql, args):
+        with self._connection() as connection:
+            return connection.execute(sql, args).fetchone()
+
+    def _fetchall(self, sql, args=()):
+        with self._connection() as connection:
+            return connection.execute(sql, args).fetchall()
+
+    def get_user(self, user_id):
+        row = self._fetchone(SELECT_USER + 'WHERE id = ?', (user_id,))
+        return None if row is None else User(*row)
+
+    def get_user_by_email(self, email):
+        row = self._fetchone(SELECT_USER + 'WHERE email_key = ?', (normalize_email(email),))
+        return None if row is None else User(*row)
+
+    def add_user(self, user_record):
+        try:
+            with self.transaction() as connection:
+                connection.execute(
+                    'INSERT INTO users (id, first_name, last_name, email, email_key, password) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (user_record.user_id, user_record.first_name, user_record.last_name,
+                     user_record.email, normalize_email(user_record.email), user_record.password))
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    def set_password(self, user_id, new_hash, old_hash):
+        with self.transaction() as connection:
+            cursor = connection.execute('UPDATE users SET password = ? WHERE id = ? AND password = ?',
+                                        (new_hash, user_id, old_hash))
+        return cursor.rowcount == 1
+
+    def get_business(self, business_id):
+        row = self._fetchone(SELECT_BUSINESS + 'WHERE business_id = ?', (business_id,))
+        return None if row is None else Business.from_row(row)
+
+    def add_business(self, business_record):
+        try:
+            with self.transaction() as connection:
+                connection.execute(
+                    'INSERT INTO businesses (user_id, business_id, name, location, description, category, '
+                    'latitude, longitude) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    business_record.to_row())
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    def update_business(self, business_id, changes):
+        with self.transaction() as connection:
+            connection.execute(
+                'UPDATE businesses SET name = COALESCE(?, name), location = COALESCE(?, location), '
+                'description = COALESCE(?, description), category = COALESCE(?, category), '
+                'latitude = COALESCE(?, latitude), longitude = COALESCE(?, longitude) '
+                'WHERE business_id = ?',
+                (changes.get('name'), changes.get('location'), changes.get('description'),
+                 changes.get('category'), changes.get('latitude'), changes.get('longitude'), business_id))
+            return self.get_business(business_id)
+
+    def delete_business(self, business_id):
+        with self.transaction() as connection:
+            business_record = self.get_business(business_id)
+            if business_record is not None:
+                connection.execute('DELETE FROM reviews WHERE business_id = ?', (business_id,))
+                connection.execute('DELETE FROM businesses WHERE business_id = ?', (business_id,))
+        return business_record
+
+    def _businesses(self, sql, args):
+        return [Business.from_row(row) for row in self._fetchall(sql, args)]
+
+    def all_businesses(self):
+        return self._businesses(SELECT_BUSINESS + 'ORDER BY business_id', ())
+
+    def businesses_for_user(self, user_id):
+        return self._businesses(SELECT_BUSINESS + 'WHERE user_id = ? ORDER BY business_id', (user_id,))
+
+    def page_businesses(self, after=None, limit=None):
+        if after is None:
+            return self._businesses(SELECT_BUSINESS + 'ORDER BY business_id LIMIT ?',
+                                    (-1 if limit is None else limit,))
+        return self._businesses(SELECT_BUSINESS + 'WHERE business_id > ? ORDER BY business_id LIMIT ?',
+                                (after, -1 if limit is None else limit))
+
+    def add_review(self, business_id, review_id, text):
+        with self.transaction() as connection:
+            position = connection.execute('SELECT review_count FROM businesses WHERE business_id = ?',
+                                          (business_id,)).fetchone()[0]
+            connection.execute('INSERT INTO reviews (business_id, position, review_id, review) '
+                               'VALUES (?, ?, ?, ?)', (business_id, position, review_id, text))
+            connection.execute('UPDATE businesses SET review_count = review_count + 1 WHERE business_id = ?',
+                               (business_id,))
+
+    def review_page(self, business_id, start=0, limit=None):
+        return self._fetchall(
+            'SELECT review_id, review FROM reviews WHERE business_id = ? AND position >= ? '
+            'ORDER BY position LIMIT ?', (business_id, start, -1 if limit is None else limit))
+
+    def review_count(self, business_id):
+        row = self._fetchone('SELECT review_count FROM businesses WHERE business_id = ?', (business_id,))
+        return 0 if row is None else row[0]
+
+    def review_counts(self):
+        return self._fetchall('SELECT business_id, review_count FROM businesses WHERE review_count > 0')
+
+    def revoke_token(self, jti, expires):
+        with self.transaction() as connection:
+            # the tokens that expired since are dropped on the way
+            connection.execute('DELETE FROM revoked_tokens WHERE expires <= ?', (time.time(),))
+            connection.execute('INSERT OR IGNORE INTO revoked_tokens (jti, expires) VALUES (?, ?)',
+                               (jti, expires))
+
+    def revoked_tokens(self):
+        return self._fetchall('SELECT jti, expires FROM revoked_tokens WHERE expires IS NULL OR expires > ?',
+                              (time.time(),))
+
+    def close(self):
+        with self.lock:
+            for connection in self.connections:
+                connection.close()
+            self.connections = []
+        self.idle = queue.Queue()
+        self.local = threading.local()
+        self.lock_file.close()
+
+    def after_fork(self):
+        # SQLite connections must not be used across a fork; the parent's
+        # are left open for the parent and new ones are opened on first use
+        self.lock = threading.Lock()
+        self.idle = queue.Queue()
+        self.connections = []
+        self.local = threading.local()
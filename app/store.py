@@ -0,0 +1,256 @@
+"""Storage classes used by the Connect class.
+Records are held in dictionaries keyed by their identifiers
+so that lookups do not have to scan every record."""
+from array import array
+from bisect import bisect_left, bisect_right, insort
+
+# number of ids a block of SortedIds holds before it is split in two
+BLOCK_SIZE = 1000
+
+
+def normalize_email(email):
+    """Returns the form of an e-mail address used as an index key.
+    - email: Holds the e-mail address entered by the user"""
+    if email is None:
+        return None
+    return email.strip().lower()
+
+
+class UserStore():
+    """Holds User records indexed by e-mail address and by user id.
+    - by_email: dictionary mapping the normalized e-mail to a user record
+    - by_id: dictionary mapping the user id to the same user record"""
+
+    def __init__(self):
+        self.by_email = {}
+        self.by_id = {}
+
+    def __len__(self):
+        return len(self.by_email)
+
+    def __iter__(self):
+        return iter(self.by_email.values())
+
+    def add(self, user_record):
+        """Adds a user record to the store.
+        Returns False if the e-mail address or the user id is already taken.
+        - user_record: User holding the user details"""
+        email = normalize_email(user_record.email)
+        if email in self.by_email or user_record.user_id in self.by_id:
+            return False
+        self.by_email[email] = user_record
+        self.by_id[user_record.user_id] = user_record
+        return True
+
+    def get_by_email(self, email):
+        """Returns the user record registered with the e-mail address, if any."""
+        return self.by_email.get(normalize_email(email))
+
+    def get(self, user_id):
+        """Returns the user record with the given id, if any."""
+        return self.by_id.get(user_id)
+
+
+class SortedIds():
+    """Sorted list of ids split into blocks of at most BLOCK_SIZE ids,
+    so that adding or removing an id moves the ids of one block rather
+    than every id after it.
+    - blocks: list of sorted lists of ids, each one's ids smaller than the next one's
+    - maxes: list of the largest id of every block, used to find the block
+    holding an id
+    - size: number of ids held"""
+
+    def __init__(self):
+        self.blocks = []
+        self.maxes = []
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for block in self.blocks:
+            yield from block
+
+    def add(self, item):
+        """Adds an id, keeping the ids sorted."""
+        maxes = self.maxes
+        if not maxes:
+            self.blocks.append([item])
+            maxes.append(item)
+        else:
+            position = min(bisect_left(maxes, item), len(maxes) - 1)
+            block = self.blocks[position]
+            insort(block, item)
+            maxes[position] = block[-1]
+            if len(block) > BLOCK_SIZE:
+                half = len(block) // 2
+                self.blocks.insert(position + 1, block[half:])
+                del block[half:]
+                maxes.insert(position, block[-1])
+        self.size += 1
+
+    def remove(self, item):
+        """Removes an id held by the list."""
+        position = bisect_left(self.maxes, item)
+        block = self.blocks[position]
+        del block[bisect_left(block, item)]
+        if block:
+            self.maxes[position] = block[-1]
+        else:
+            del self.blocks[position]
+            del self.maxes[position]
+        self.size -= 1
+
+    def slice_after(self, after=None, limit=None):
+        """Returns up to limit ids greater than after, in order.
+        - after: None to start from the smallest id
+        - limit: maximum number of ids, None for all of them"""
+        if after is None:
+            position, start = 0, 0
+        else:
+            position = bisect_right(self.maxes, after)
+            if position == len(self.blocks):
+                return []
+            start = bisect_right(self.blocks[position], after)
+        found = []
+        for block in self.blocks[position:]:
+            if limit is None:
+                found.extend(block[start:])
+            else:
+                found.extend(block[start:start + limit - len(found)])
+                if len(found) >= limit:
+                    break
+            start = 0
+        return found
+
+
+class BusinessStore():
+    """Holds Business records indexed by business id and by owner.
+    - by_id: dictionary mapping the business id to a business record
+    - by_user: dictionary mapping a user id to that user's business
+    records, themselves keyed by business id
+    - order: SortedIds of the business ids, used for keyset pagination"""
+
+    def __init__(self):
+        self.by_id = {}
+        self.by_user = {}
+        self.order = SortedIds()
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def __iter__(self):
+        return iter(self.by_id.values())
+
+    def add(self, business_record):
+        """Adds a business record to the store.
+        Returns False if the business id is already taken.
+        - business_record: Business holding the business details"""
+        business_id = business_record.business_id
+        if business_id in self.by_id:
+            return False
+        self.by_id[business_id] = business_record
+        self.by_user.setdefault(business_record.user_id, {})[business_id] = business_record
+        self.order.add(business_id)
+        return True
+
+    def get(self, business_id):
+        """Returns the business record with the given id, if any."""
+        return self.by_id.get(business_id)
+
+    def remove(self, business_id):
+        """Removes the business record with the given id and returns it,
+        or returns None if there is no such record."""
+        business_record = self.by_id.pop(business_id, None)
+        if business_record is not None:
+            owned = self.by_user[business_record.user_id]
+            del owned[business_id]
+            if not owned:
+                del self.by_user[business_record.user_id]
+            self.order.remove(business_id)
+        return business_record
+
+    def for_user(self, user_id):
+        """Returns the business records owned by the given user."""
+        return list(self.by_user.get(user_id, {}).values())
+
+    def page(self, after=None, limit=None):
+        """Returns up to limit business records in business id order,
+        starting after the given business id.
+        - after: business id the previous page ended with, None to start
+        from the first business
+        - limit: maximum number of records, None for all of them"""
+        return [self.by_id[business_id] for business_id in self.order.slice_after(after, limit)]
+
+    def iter_from(self, after=None, chunk_size=500):
+        """Yields business records in business id order, starting after
+        the given business id. Records are fetched a chunk at a time and
+        each chunk starts from the last id yielded, so businesses added
+        or removed while iterating do not break the iteration."""
+        while True:
+            chunk = self.page(after, chunk_size)
+            for business_record in chunk:
+                yield business_record
+            if len(chunk) < chunk_size:
+                return
+            after = chunk[-1].business_id
+
+
+class ReviewLog():
+    """Append-only log of the reviews of one business.
+    Review ids are packed into an array and texts into a list
+    instead of keeping one dictionary per review.
+    - ids: array of review ids, in the order the reviews were added
+    - texts: list of review texts, in the same order"""
+    __slots__ = ('ids', 'texts')
+
+    def __init__(self):
+        self.ids = array('q')
+        self.texts = []
+
+    def __len__(self):
+        return len(self.ids)
+
+    def append(self, review_id, text):
+        """Adds a review at the end of the log."""
+        self.ids.append(review_id)
+        self.texts.append(text)
+
+    def page(self, start=0, limit=None):
+        """Returns (review id, text) pairs starting at position start."""
+        end = None if limit is None else start + limit
+        return list(zip(self.ids[start:end], self.texts[start:end]))
+
+
+class ReviewStore():
+    """Holds the reviews of every business, one ReviewLog per business.
+    - logs: dictionary mapping a business id to its ReviewLog"""
+
+    def __init__(self):
+        self.logs = {}
+
+    def add(self, business_id, review_id, text):
+        """Appends a review to the business' log."""
+        log = self.logs.get(business_id)
+        if log is None:
+            log = self.logs[business_id] = ReviewLog()
+        log.append(review_id, text)
+
+    def page(self, business_id, start=0, limit=None):
+        """Returns up to limit (review id, text) pairs of a business,
+        skipping the first start reviews. Since the logs are append-only,
+        a position is a stable cursor."""
+        log = self.logs.get(business_id)
+        if log is None:
+            return []
+        return log.page(start, limit)
+
+    def count(self, business_id):
+        """Returns the number of reviews of a business."""
+        log = self.logs.get(business_id)
+        return 0 if log is None else len(log)
+
+    def remove(self, business_id):
+        """Drops every review of a business."""
+        self.logs.pop(business_id, None)
@@ -1,15 +1,124 @@
-import os, random
-from app import app
-from flask import abort, Flask, jsonify, make_response, request
-from flask_jwt_extended import (JWTManager, jwt_required, create_access_token, get_jwt_identity)
+"""Routes of the API and the databases they use.
+The databases, the caches and the id generator are kept at module level,
+one set per process; init_app sets them up from the configuration of the
+application."""
+import atexit, gc, time
+from flask import abort, Blueprint, Flask, current_app, jsonify, make_response, request, Response
+from flask_jwt_extended import (JWTManager, jwt_required, create_access_token, get_jwt_identity, get_raw_jwt)
+from .admission import AdmissionControl
 from .app_class import Connect
+from .cache import ResponseCache
+from .changes import ChangeFeed
+from .encoding import dumps, join
+from .hashing import PasswordHasher
+from .ids import IdGenerator
+from .metrics import REGISTRY, SamplingProfiler
+from .persistence import Persistence
+from .shared import connect_state, shared_key
+from .stats import TOP_REVIEWED
+from .storage import SQLiteStorage
 
-app.config['JWT_SECRET_KEY'] = os.urandom(20)
-jwt = JWTManager(app)
+api = Blueprint('api', __name__)
 
-weconnect = Connect()
+jwt = JWTManager()
 
-@app.route('/api/v1/auth/register', methods=['POST'])
+
+@jwt.token_in_blacklist_loader
+def token_revoked(decoded_token):
+    """Checks whether the token was revoked by logging out"""
+    return weconnect.is_revoked(decoded_token['jti'])
+
+# page size of GET /api/v1/businesses when a limit is not given, and the largest allowed
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# parameters of GET /api/v1/businesses making up its cache key, with their types
+LIST_PARAMETERS = (('limit', int), ('after', int), ('offset', int), ('q', str), ('category', str),
+                   ('location', str))
+
+# radius in metres of GET /api/v1/businesses/nearby when one is not given, and the largest allowed
+NEARBY_RADIUS = 5000
+MAX_NEARBY_RADIUS = 100000
+
+profiler = SamplingProfiler()
+# shortest interval between profiler samples; sampling every thread's stack
+# more often would take the interpreter from the requests
+MIN_PROFILER_INTERVAL = 0.001
+
+# the limits are set from the configuration by init_app
+admission = AdmissionControl(1, 0, 0, 1, 1)
+response_cache = ResponseCache()
+
+# set up by init_app
+weconnect = ids = None
+
+
+def init_app(app):
+    """Sets up the databases from the configuration of app and adds the routes to it.
+    Raises ValueError if an application was already set up in this process,
+    since it would be left using the databases set up for this one."""
+    global weconnect, ids
+    if weconnect is not None:
+        raise ValueError('The databases are kept by app.views, one set per process: '
+                         'an application was already built in this process')
+    if app.config['SHARED_SOCKET'] and app.config['STORAGE'] == 'sqlite':
+        # the state process holds the databases in memory to stream them to the workers
+        raise ValueError('WECONNECT_SHARED_SOCKET needs the memory storage backend, '
+                         'not WECONNECT_STORAGE=sqlite')
+    # tokens of logged out users are refused; only access tokens are issued
+    app.config['JWT_BLACKLIST_ENABLED'] = True
+    app.config['JWT_BLACKLIST_TOKEN_CHECKS'] = ['access']
+    jwt.init_app(app)
+
+    REGISTRY.enabled = app.config['METRICS_ENABLED']
+    REGISTRY.init_app(app)
+
+    # ids of new users, businesses and reviews. Processes sharing a state
+    # process lease their worker numbers from a lock file next to its socket
+    lease = app.config['SHARED_SOCKET'] + '.ids' if app.config['SHARED_SOCKET'] else None
+    ids = IdGenerator(app.config['ID_WORKER'], lease=lease)
+
+    admission.configure(app.config['AUTH_MAX_CONCURRENT'], app.config['AUTH_MAX_QUEUE'],
+                        app.config['AUTH_QUEUE_TIMEOUT'], app.config['AUTH_RATE'],
+                        app.config['AUTH_BURST'], app.config['AUTH_TRUSTED_PROXIES'])
+
+    persistence = storage = primary = None
+    if app.config['SHARED_SOCKET'] and not app.config['STATE_SERVER']:
+        # the databases live in the state process; this process keeps a replica
+        primary = connect_state(app.config['SHARED_SOCKET'],
+                                app.config['SHARED_AUTHKEY'] or shared_key(app.config['SHARED_SOCKET']))
+    elif app.config['STORAGE'] == 'sqlite':
+        storage = SQLiteStorage(app.config['SQLITE_PATH'], app.config['SQLITE_POOL_SIZE'])
+    elif app.config['DATA_DIR']:
+        persistence = Persistence(app.config['DATA_DIR'], app.config['SNAPSHOT_EVERY'], app.config['WAL_SYNC'])
+    weconnect = Connect(PasswordHasher(app.config['BCRYPT_LOG_ROUNDS'], app.config['BCRYPT_WORKERS']),
+                        persistence, storage, primary, ChangeFeed(app.config['CHANGE_FEED_SIZE']))
+    atexit.register(lambda: weconnect.close())
+
+    response_cache.max_entries = app.config['RESPONSE_CACHE_SIZE']
+    response_cache.max_bytes = app.config['RESPONSE_CACHE_BYTES']
+    response_cache.attach(weconnect)
+
+    app.register_blueprint(api)
+
+
+def before_fork():
+    """Readies the databases loaded by a preloading server to be shared
+    with the worker processes it is about to fork."""
+    weconnect.detach()
+    # objects made so far are left alone by the collector, so it does not
+    # write to the memory pages the workers share
+    gc.freeze()
+
+
+def after_fork():
+    """Restarts, in a forked worker process, what the worker cannot share
+    with the process it was forked from."""
+    weconnect.after_fork()
+
+
+@api.route('/api/v1/auth/register', methods=['POST'])
+@admission.limit('register')
 def register_user():
     data = request.get_json()
     email = data['email']
@@ -20,12 +129,20 @@ def register_user():
         abort(400)
     if email is None:
         abort(400)
-    new_user = weconnect.register_user(random.randint(1, 500),
+    new_user = weconnect.register_user(ids.next_id(),
                                       first_name, last_name, email, password)
-    if new_user:
-        return jsonify({'message': 'Successfully created user'}), 200
+    if new_user is None:
+        abort(400)
+    # a message if the e-mail address is registered, False if it was
+    # registered by a concurrent request or the id was taken
+    if isinstance(new_user, str):
+        return jsonify({'message': new_user}), 409
+    if new_user is False:
+        return jsonify({'message': 'The e-mail address or user id was taken; try again'}), 409
+    return jsonify({'message': 'Successfully created user'}), 200
 
-@app.route('/api/v1/auth/login', methods=['POST'])
+@api.route('/api/v1/auth/login', methods=['POST'])
+@admission.limit('login')
 def login_user():
     data = request.get_json()
     email = data['email']
@@ -39,13 +156,19 @@ def login_user():
     else:
         abort(404)
 
-@app.route('/api/auth/logout', methods=['POST'])
+@api.route('/api/v1/auth/logout', methods=['POST'])
+@api.route('/api/auth/logout', methods=['POST'])
+@jwt_required
 def logout():
-    pass
+    """Revokes the token the request was made with"""
+    token = get_raw_jwt()
+    weconnect.revoke_token(token['jti'], token.get('exp'))
+    return jsonify({'message': 'Successfully logged out'}), 200
 
 
-@app.route('/api/v1/auth/reset-password', methods=['POST'])
+@api.route('/api/v1/auth/reset-password', methods=['POST'])
 @jwt_required
+@admission.limit('reset-password')
 def reset_password():
     data = request.get_json()
     email = data['email']
@@ -59,25 +182,256 @@ def reset_password():
     else:
         return jsonify({'message': 'Supply your password and/or a new password'}), 401
 
-@app.route('/api/v1/businesses', methods=['GET'])
+@api.route('/api/v1/status', methods=['GET'])
+def status():
+    """Returns the admission control and response cache counters used to size them"""
+    return jsonify({'admission': admission.stats(), 'cache': response_cache.stats()})
+
+
+@api.route('/metrics', methods=['GET'])
+def metrics():
+    """Returns the latency histograms and byte counters in the Prometheus text format"""
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+
+@api.route('/api/v1/profiler', methods=['GET'])
+@jwt_required
+def get_profile():
+    """Returns the stacks sampled by the profiler in the folded format of flame graph tools"""
+    if not current_app.config['PROFILER_ENABLED']:
+        abort(404)
+    return Response(profiler.folded(), mimetype='text/plain')
+
+
+@api.route('/api/v1/profiler', methods=['POST'])
+@jwt_required
+def set_profiler():
+    """Starts or stops the sampling profiler.
+    - running: whether the profiler should run
+    - interval: seconds between samples, at least MIN_PROFILER_INTERVAL
+    - clear: drop the samples taken so far"""
+    if not current_app.config['PROFILER_ENABLED']:
+        abort(404)
+    data = request.get_json() or {}
+    interval = data.get('interval')
+    if interval is not None and (not isinstance(interval, (int, float)) or interval < MIN_PROFILER_INTERVAL):
+        abort(400)
+    if data.get('clear'):
+        profiler.clear()
+    if data.get('running'):
+        profiler.start(interval)
+    elif 'running' in data:
+        profiler.stop()
+    return jsonify({'running': profiler.running, 'interval': profiler.interval, 'samples': profiler.samples})
+
+
+@api.route('/api/v1/businesses', methods=['GET'])
 @jwt_required
 def get_businesses():
-    """Returns all businesses"""
-    businesses = weconnect.get_businesses()
-    return jsonify({'businesses': businesses})
+    """Returns all businesses.
+    - limit, after: return one page of businesses ordered by ID, starting
+    after the business ID given in 'after'. The response carries the cursor
+    of the next page in 'next'.
+    - stream: serialize the businesses one at a time as they are sent
+    - q, category, location: search the businesses instead. Results are
+    ranked, and paged with 'limit' and 'offset'; 'next' holds the offset
+    of the next page."""
+    if request.args.get('stream'):
+        return Response(stream_businesses(request.args.get('after', type=int)), mimetype='application/json')
+    key = tuple(request.args.get(name, type=kind) for name, kind in LIST_PARAMETERS)
+    if not any(key):
+        # the full list is as large as the catalogue, so it is not cached
+        return catalogue_response(list_businesses)
+    return cached_response(('businesses',) + key, list_businesses)
+
+
+def list_businesses():
+    """Builds the response of GET /api/v1/businesses"""
+    limit = request.args.get('limit', type=int)
+    after = request.args.get('after', type=int)
+    query = request.args.get('q')
+    category = request.args.get('category')
+    location = request.args.get('location')
+    if query is not None or category is not None or location is not None:
+        return search_businesses(query, category, location, limit)
+    if limit is None and after is None:
+        businesses = weconnect.get_businesses(as_json=True)
+        return json_response(b'{"businesses":%s}' % join(businesses))
+    limit = PAGE_SIZE if limit is None else limit
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        abort(400)
+    businesses, next_after = weconnect.page_businesses(limit, after, as_json=True)
+    return json_response(b'{"businesses":%s,"next":%s}' % (join(businesses), dumps(next_after)))
+
+
+def search_businesses(query, category, location, limit):
+    """Returns one page of search results"""
+    offset = request.args.get('offset', 0, type=int)
+    limit = PAGE_SIZE if limit is None else limit
+    if limit < 1 or limit > MAX_PAGE_SIZE or offset < 0:
+        abort(400)
+    businesses, total = weconnect.search_businesses(query, category, location, limit, offset, as_json=True)
+    next_offset = offset + limit if offset + limit < total else None
+    return json_response(b'{"businesses":%s,"total":%d,"next":%s}' % (join(businesses), total, dumps(next_offset)))
+
+
+def json_response(body, status=200):
+    """Returns a response holding an already encoded JSON body"""
+    return Response(body, status=status, mimetype='application/json')
+
+
+def stream_businesses(after):
+    """Yields the JSON body {"businesses": [...]} piece by piece"""
+    yield b'{"businesses": ['
+    separator = b''
+    for business in weconnect.iter_businesses(after, as_json=True):
+        yield separator + business
+        separator = b', '
+    yield b']}'
+
+
+@api.route('/api/v1/businesses/stats', methods=['GET'])
+@jwt_required
+def get_stats():
+    """Returns the number of businesses and reviews, the businesses per
+    category and location and the most reviewed businesses.
+    - limit: number of most reviewed businesses, at most 10"""
+    limit = request.args.get('limit', TOP_REVIEWED, type=int)
+    if limit < 1 or limit > TOP_REVIEWED:
+        abort(400)
+    return json_response(dumps(weconnect.get_stats(limit)))
+
+
+@api.route('/api/v1/businesses/changes', methods=['GET'])
+@jwt_required
+def get_changes():
+    """Returns the events of the changes made to businesses after
+    'since', oldest first, and in 'seq' the value of 'since' to send next.
+    Without 'since' there are no events, only the current 'seq'. Answers
+    410 if the events are no longer all held; the businesses must then be
+    read again."""
+    since = request.args.get('since', type=int)
+    if since is None:
+        return json_response(b'{"changes":[],"seq":%d}' % weconnect.current_lsn())
+    events, seq = weconnect.get_changes(since)
+    if events is None:
+        return json_response(b'{"message":"Changes no longer held, read the businesses again","seq":%d}' % seq,
+                             410)
+    return json_response(b'{"changes":%s,"seq":%d}' % (join([event for _, event in events]), seq))
 
 
-@app.route('/api/v1/businesses/<businessId>', methods=['GET'])
+@api.route('/api/v1/businesses/changes/stream', methods=['GET'])
+@jwt_required
+def stream_changes():
+    """Sends the events of the changes made to businesses after 'since',
+    or after the Last-Event-ID of a reconnecting client, as server-sent
+    events, and then every new event as it is made."""
+    since = request.headers.get('Last-Event-ID', type=int)
+    if since is None:
+        since = request.args.get('since', type=int)
+    if since is None:
+        abort(400)
+    token = get_raw_jwt()
+    response = Response(change_events(since, token['jti'], token['exp'],
+                                      current_app.config['CHANGE_FEED_HEARTBEAT']),
+                        mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # proxies must pass the events on as they come
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def change_events(since, jti, expires, heartbeat):
+    """Yields the events after since in the server-sent events format,
+    and a comment every heartbeat seconds without events, until the
+    token the stream was opened with is revoked. A 'reset' event ends the
+    stream when the events are no longer all held, and an 'expired' event
+    once the token expires at the time expires."""
+    while not weconnect.is_revoked(jti):
+        remaining = expires - time.time()
+        if remaining <= 0:
+            yield b'event: expired\ndata: {}\n\n'
+            return
+        events, seq = weconnect.wait_changes(since, min(heartbeat, remaining))
+        if events is None:
+            yield b'event: reset\ndata: {"seq":%d}\n\n' % seq
+            return
+        if events:
+            yield b''.join([b'id: %d\ndata: %s\n\n' % event for event in events])
+            since = events[-1][0]
+        else:
+            yield b': keep-alive\n\n'
+
+
+@api.route('/api/v1/businesses/nearby', methods=['GET'])
+@jwt_required
+def nearby_businesses():
+    """Returns the businesses nearest to a point, each with its distance in metres.
+    - lat, lon: the point, in degrees
+    - radius: largest distance in metres
+    - limit: number of businesses to return
+    - category: only return businesses of this category"""
+    latitude = request.args.get('lat', type=float)
+    longitude = request.args.get('lon', type=float)
+    radius = request.args.get('radius', NEARBY_RADIUS, type=float)
+    limit = request.args.get('limit', PAGE_SIZE, type=int)
+    if check_coordinates({'latitude': latitude, 'longitude': longitude}) or latitude is None:
+        abort(400)
+    if not 0 < radius <= MAX_NEARBY_RADIUS or limit < 1 or limit > MAX_PAGE_SIZE:
+        abort(400)
+    businesses = weconnect.nearby_businesses(latitude, longitude, radius, limit,
+                                             request.args.get('category'), as_json=True)
+    return json_response(b'{"businesses":%s}' % join(businesses))
+
+
+@api.route('/api/v1/businesses/<businessId>', methods=['GET'])
 @jwt_required
 def get_business(businessId):
     """Returns a specific business"""
-    business = weconnect.get_business(int(businessId))
-    if business is None:
-        abort(404)
-    return jsonify({'business': business})
+    business_id = int(businessId)
 
+    def build():
+        business = weconnect.get_business(business_id, as_json=True)
+        if business is None:
+            abort(404)
+        return json_response(b'{"business":%s}' % business)
+    return cached_response(('business', business_id), build)
 
-@app.route('/api/v1/businesses', methods=['POST'])
+
+def catalogue_response(build):
+    """Answers a GET whose body is built from the whole catalogue without
+    caching the body. Its ETag comes from the catalogue version, so an
+    If-None-Match holding it gets a 304 without building the body."""
+    etag = response_cache.catalogue_etag()
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = build()
+    response.set_etag(etag)
+    return response
+
+
+def cached_response(key, build):
+    """Answers a GET from the response cache, building and caching the
+    response with build() on a miss. Requests whose If-None-Match holds
+    the ETag of the cached body get a 304 without reaching weconnect."""
+    entry = response_cache.get(key)
+    if entry is None:
+        version = response_cache.version(key)
+        response = build()
+        if response.status_code != 200:
+            return response
+        entry = response_cache.put(key, response.get_data(), version)
+    etag, body = entry
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    return response
+
+
+@api.route('/api/v1/businesses', methods=['POST'])
 @jwt_required
 def register_business():
     """Registers a business"""
@@ -90,12 +444,114 @@ def register_business():
     user_id = current_user
     if not data or not name:
         abort(400)
+    if check_coordinates(data):
+        abort(400)
     if name is not None or description is not None or location is not None or category is not None:
-        new_business = weconnect.create_business(user_id, random.randint(1, 500), name, location, category, description)
+        new_business = weconnect.create_business(user_id, ids.next_id(), name, location, category, description,
+                                                 data.get('latitude'), data.get('longitude'))
+        if new_business is False:
+            abort(409)
         return jsonify({'business': new_business}), 201
     return jsonify({"response": "Empty value entered"}), 400
 
-@app.route('/api/v1/businesses/<businessId>', methods=['PUT'])
+@api.route('/api/v1/businesses:batch', methods=['POST'])
+@jwt_required
+def register_businesses():
+    """Registers several businesses in one request.
+    Takes {"businesses": [...]} holding up to BATCH_MAX_ITEMS businesses and
+    returns a result per business, in the order they were sent."""
+    items = batch_items()
+    results = [None] * len(items)
+    businesses = []
+    for position, item in enumerate(items):
+        message = check_business_fields(item, required=True)
+        if message:
+            results[position] = {'status': 400, 'message': message}
+            continue
+        businesses.append(dict(item, business_id=ids.next_id()))
+    created = iter(weconnect.create_businesses(get_jwt_identity(), businesses))
+    for position, result in enumerate(results):
+        if result is not None:
+            continue
+        new_business = next(created)
+        if new_business is False:
+            results[position] = {'status': 409, 'message': 'Business ID already taken'}
+        else:
+            results[position] = {'status': 201, 'business': new_business}
+    return jsonify({'results': results}), 200
+
+
+@api.route('/api/v1/businesses:batch', methods=['PUT'])
+@jwt_required
+def update_businesses():
+    """Updates several businesses in one request.
+    Takes {"businesses": [...]} holding up to BATCH_MAX_ITEMS items, each with
+    the business_id and the fields to change, and returns a result per item."""
+    items = batch_items()
+    results = [None] * len(items)
+    updates = []
+    for position, item in enumerate(items):
+        message = check_business_fields(item, required=False)
+        if not message and not isinstance(item.get('business_id'), int):
+            message = 'business_id must be an integer'
+        if message:
+            results[position] = {'status': 400, 'message': message}
+            continue
+        updates.append(item)
+    updated = iter(weconnect.update_businesses(get_jwt_identity(), updates))
+    for position, result in enumerate(results):
+        if result is not None:
+            continue
+        business = next(updated)
+        if business is False:
+            results[position] = {'status': 404, 'message': 'Business not found'}
+        else:
+            results[position] = {'status': 200, 'business': business}
+    return jsonify({'results': results}), 200
+
+
+def batch_items():
+    """Returns the list of items of a batch request, checking its size"""
+    data = request.get_json()
+    items = data.get('businesses') if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items or len(items) > current_app.config['BATCH_MAX_ITEMS']:
+        abort(400)
+    return items
+
+
+def check_business_fields(item, required):
+    """Returns what is wrong with the business details of a batch item, or None.
+    - required: whether every field must be given"""
+    if not isinstance(item, dict):
+        return 'Each business must be an object'
+    for field in ('name', 'location', 'description', 'category'):
+        value = item.get(field)
+        if value is None:
+            if required:
+                return 'Missing Field: %s' % field
+        elif not isinstance(value, str):
+            return '%s must be a string' % field
+    if required and not item['name']:
+        return 'Empty value entered'
+    return check_coordinates(item)
+
+
+def check_coordinates(item):
+    """Returns what is wrong with the latitude and longitude of a business, or None.
+    Both are optional, but one is not accepted without the other."""
+    latitude = item.get('latitude')
+    longitude = item.get('longitude')
+    if latitude is None and longitude is None:
+        return None
+    for field, value, bound in (('latitude', latitude, 90), ('longitude', longitude, 180)):
+        if value is None:
+            return 'Missing Field: %s' % field
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not -bound <= value <= bound:
+            return '%s must be a number between -%d and %d' % (field, bound, bound)
+    return None
+
+
+@api.route('/api/v1/businesses/<businessId>', methods=['PUT'])
 @jwt_required
 def update_business(businessId):
     """Updates a business"""
@@ -118,8 +574,54 @@ def update_business(businessId):
         abort(400)
     if category and isinstance(category, str) == False:
         abort(400)
+    if check_coordinates(data):
+        abort(400)
 
     if name or description or location or category is not None:
-        business = weconnect.update_business(user_id, int(businessId), name, location, description, category)
+        business = weconnect.update_business(user_id, int(businessId), name, location, description, category,
+                                             data.get('latitude'), data.get('longitude'))
         return jsonify(business), 201
 
+
+@api.route('/api/v1/businesses/<businessId>', methods=['DELETE'])
+@jwt_required
+def delete_business(businessId):
+    """Deletes a business owned by the logged-in user"""
+    business = weconnect.get_business(int(businessId))
+    if business is None:
+        abort(404)
+    if business['user_id'] != get_jwt_identity():
+        abort(403)
+    weconnect.delete_business(int(businessId))
+    return jsonify({'message': 'Successfully deleted business'}), 200
+
+
+@api.route('/api/v1/businesses/<businessId>/reviews', methods=['POST'])
+@jwt_required
+def add_review(businessId):
+    """Adds a review to a business"""
+    data = request.get_json()
+    if not data or not data.get('review') or not isinstance(data['review'], str):
+        abort(400)
+    review = weconnect.add_review(int(businessId), ids.next_id(), data['review'])
+    if review is None:
+        abort(404)
+    return jsonify({'review': review}), 201
+
+
+@api.route('/api/v1/businesses/<businessId>/reviews', methods=['GET'])
+@jwt_required
+def get_reviews(businessId):
+    """Returns the reviews of a business, oldest first.
+    - limit, after: return one page of reviews, skipping the number of
+    reviews given in 'after'. 'next' holds the cursor of the next page."""
+    limit = request.args.get('limit', PAGE_SIZE, type=int)
+    after = request.args.get('after', 0, type=int)
+    if limit < 1 or limit > MAX_PAGE_SIZE or after < 0:
+        abort(400)
+    reviews = weconnect.get_reviews(int(businessId), limit, after)
+    if reviews is None:
+        abort(404)
+    count = weconnect.review_count(int(businessId))
+    next_after = after + len(reviews) if after + len(reviews) < count else None
+    return json_response(dumps({'reviews': reviews, 'count': count, 'next': next_after}))
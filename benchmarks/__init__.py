@@ -0,0 +1,3 @@
+"""Benchmarks for the WeConnect API.
+Run them from the repository root, e.g.
+    python -m benchmarks.bench_users"""
@@ -0,0 +1,70 @@
+"""Compares creating and updating businesses through the batch endpoints
+with one request per business, through the Flask test client.
+
+    python -m benchmarks.bench_batch --businesses 10000 --batch-size 1000"""
+import argparse
+import json
+import time
+
+from flask_jwt_extended import create_access_token
+
+from app import app, views
+from app.hashing import PasswordHasher
+from benchmarks.common import print_table
+
+
+def business(number):
+    return {'name': 'Business %d' % number, 'location': 'Location %d' % (number % 50),
+            'category': 'Category %d' % (number % 20), 'description': 'Description of business %d' % number}
+
+
+def run(client, headers, method, requests):
+    """Sends (url, body) requests and returns the elapsed seconds."""
+    send = client.post if method == 'POST' else client.put
+    start = time.perf_counter()
+    for url, body in requests:
+        response = send(url, data=json.dumps(body), content_type='application/json', headers=headers)
+        assert response.status_code in (200, 201), response.status_code
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--businesses', type=int, default=10000)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    options = parser.parse_args()
+
+    client = app.test_client()
+    with app.test_request_context():
+        token = create_access_token(identity=1)
+    headers = {'Authorization': 'Bearer %s' % token}
+    count, size = options.businesses, options.batch_size
+
+    rows = []
+    for mode in ('single', 'batch'):
+        views.weconnect = views.Connect(PasswordHasher(rounds=4))
+        views.response_cache.attach(views.weconnect)
+        if mode == 'single':
+            create = run(client, headers, 'POST', [('/api/v1/businesses', business(n))
+                                                    for n in range(count)])
+        else:
+            create = run(client, headers, 'POST', [
+                ('/api/v1/businesses:batch', {'businesses': [business(n) for n in range(start, start + size)]})
+                for start in range(0, count, size)])
+        ids = [item['business_id'] for item in views.weconnect.iter_businesses()]
+        if mode == 'single':
+            update = run(client, headers, 'PUT', [('/api/v1/businesses/%d' % business_id,
+                                                   dict(business(n), name='Renamed %d' % n))
+                                                  for n, business_id in enumerate(ids)])
+        else:
+            update = run(client, headers, 'PUT', [
+                ('/api/v1/businesses:batch', {'businesses': [{'business_id': business_id, 'name': 'Renamed'}
+                                                             for business_id in ids[start:start + size]]})
+                for start in range(0, count, size)])
+        rows.append([mode, '%.0f' % (count / create), '%.0f' % (count / update)])
+        views.weconnect.close()
+    print_table(['mode', 'creates/s', 'updates/s'], rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""Measures get, update and delete latency on Connect.business
+as the catalogue grows, plus GET /api/v1/businesses/<businessId>
+through the Flask test client.
+
+    python -m benchmarks.bench_businesses --sizes 1000 100000 1000000"""
+import argparse
+import random
+
+from flask_jwt_extended import create_access_token
+
+from app import app
+from app.records import Business
+from app.views import weconnect
+from benchmarks.common import print_table, summarize, time_calls
+
+
+def seed(connect, size):
+    """Adds size businesses spread over a thousand owners."""
+    for business_id in range(1, size + 1):
+        connect.storage.add_business(Business(
+            business_id, 'Business %d' % business_id, 'Location %d' % (business_id % 50),
+            'Description of business %d' % business_id, 'Category %d' % (business_id % 20),
+            business_id % 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000, 1000000])
+    parser.add_argument('--requests', type=int, default=1000)
+    options = parser.parse_args()
+
+    client = app.test_client()
+    with app.test_request_context():
+        token = create_access_token(identity=1)
+    headers = {'Authorization': 'Bearer %s' % token}
+
+    rows = []
+    for size in options.sizes:
+        weconnect.__init__()
+        seed(weconnect, size)
+        ids = [random.randint(1, size) for _ in range(options.requests)]
+        get = summarize(time_calls(weconnect.get_business, [(i,) for i in ids]))
+        update = summarize(time_calls(weconnect.update_business,
+                                      [(i % 1000, i, 'Renamed %d' % i) for i in ids]))
+        http = summarize(time_calls(lambda url: client.get(url, headers=headers),
+                                    [('/api/v1/businesses/%d' % i,) for i in ids[:200]]))
+        delete = summarize(time_calls(weconnect.delete_business, [(i,) for i in set(ids)]))
+        rows.append([size, '%.2f' % get['p50'], '%.2f' % update['p50'],
+                     '%.2f' % delete['p50'], '%.0f' % http['p50'], '%.0f' % http['p99']])
+    print_table(['businesses', 'get p50 us', 'update p50 us', 'delete p50 us',
+                 'GET p50 us', 'GET p99 us'], rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""Compares polling the full business list with polling the change feed,
+and measures idle subscribers waiting on the feed: the memory each one
+holds and the time for a change to reach all of them.
+
+    python -m benchmarks.bench_changes --businesses 10000 --subscribers 100 1000 5000"""
+import argparse
+import threading
+import time
+
+from flask_jwt_extended import create_access_token
+
+from app import app, views
+from app.app_class import Connect
+from app.hashing import PasswordHasher
+from benchmarks.common import print_table, summarize
+
+
+def seed(connect, size):
+    for start in range(1, size + 1, 1000):
+        connect.create_businesses(1, [{'business_id': business_id, 'name': 'Business %d' % business_id,
+                                       'location': 'Location %d' % (business_id % 50),
+                                       'category': 'Category %d' % (business_id % 20),
+                                       'description': 'Description of business %d' % business_id}
+                                      for business_id in range(start, min(start + 1000, size + 1))])
+
+
+def rss():
+    """Returns the resident memory of this process in MB."""
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024.0
+
+
+def polling(size, changes, polls):
+    """Returns the latency and size of polls of the full list and of the
+    feed, with changes businesses renamed between polls."""
+    views.weconnect = Connect(PasswordHasher(rounds=4, workers=0))
+    views.response_cache.attach(views.weconnect)
+    seed(views.weconnect, size)
+    client = app.test_client()
+    with app.test_request_context():
+        headers = {'Authorization': 'Bearer %s' % create_access_token(identity=1)}
+    results = {'list': [], 'changes': []}
+    sizes = {'list': 0, 'changes': 0}
+    seq = views.weconnect.lsn
+    for poll in range(polls):
+        for number in range(changes):
+            business_id = (poll * changes + number) % size + 1
+            views.weconnect.update_business(1, business_id, name='Renamed %d' % poll)
+        start = time.perf_counter()
+        body = client.get('/api/v1/businesses', headers=headers).data
+        results['list'].append((time.perf_counter() - start) * 1e6)
+        sizes['list'] += len(body)
+        start = time.perf_counter()
+        response = client.get('/api/v1/businesses/changes?since=%d' % seq, headers=headers)
+        results['changes'].append((time.perf_counter() - start) * 1e6)
+        sizes['changes'] += len(response.data)
+        seq = response.get_json()['seq']
+    views.weconnect.close()
+    return [(name, summarize(sorted(results[name]))['p50'], sizes[name] / polls) for name in ('list', 'changes')]
+
+
+def subscribers(count, changes):
+    """Starts count subscribers waiting on the feed, as the event streams
+    do, and returns the memory they hold and the p50 and p99 time for a
+    change to reach the last of them, in microseconds."""
+    connect = Connect(PasswordHasher(rounds=4, workers=0))
+    connect.create_business(1, 1, 'Busy Cafe', 'Nairobi', 'food', 'Everyone reviews it')
+    received = [0]
+    lock = threading.Lock()
+    everyone = threading.Condition(lock)
+    stop = []
+
+    def subscriber(since):
+        while not stop:
+            events, seq = connect.wait_changes(since, 1)
+            if events:
+                since = events[-1][0]
+                with lock:
+                    received[0] += 1
+                    if received[0] == count:
+                        everyone.notify()
+
+    before = rss()
+    threading.stack_size(256 * 1024)
+    threads = [threading.Thread(target=subscriber, args=(connect.lsn,), daemon=True) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    # let every subscriber reach its wait
+    time.sleep(1 + count / 2000.0)
+    held = (rss() - before) * 1024 / count
+    latencies = []
+    for review_id in range(changes):
+        with lock:
+            received[0] = 0
+        start = time.perf_counter()
+        connect.add_review(1, review_id, 'Review')
+        with lock:
+            everyone.wait_for(lambda: received[0] == count, 30)
+        latencies.append((time.perf_counter() - start) * 1e6)
+    stop.append(True)
+    connect.add_review(1, changes, 'Review')
+    for thread in threads:
+        thread.join()
+    threading.stack_size(0)
+    connect.close()
+    latencies.sort()
+    return held, summarize(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--businesses', type=int, default=10000)
+    parser.add_argument('--changes', type=int, default=10, help='changes between polls')
+    parser.add_argument('--polls', type=int, default=50)
+    parser.add_argument('--subscribers', type=int, nargs='+', default=[100, 1000, 5000])
+    options = parser.parse_args()
+
+    rows = [[name, '%.0f' % latency, '%.0f' % size]
+            for name, latency, size in polling(options.businesses, options.changes, options.polls)]
+    print_table(['poll', 'p50 us', 'bytes'], rows)
+    print()
+    rows = []
+    for count in options.subscribers:
+        held, latency = subscribers(count, 20)
+        rows.append([count, '%.0f' % held, '%.0f' % latency['p50'], '%.0f' % latency['p99']])
+    print_table(['subscribers', 'KB each', 'fan-out p50 us', 'fan-out p99 us'], rows)
+
+
+if __name__ == '__main__':
+    main()
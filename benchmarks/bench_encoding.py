@@ -0,0 +1,83 @@
+"""Compares building business responses with jsonify from the
+dictionaries returned by Connect against joining the JSON encodings
+kept by the business records. The response cache is bypassed, so every
+response is built.
+
+    python -m benchmarks.bench_encoding --businesses 10000 --requests 2000"""
+import argparse
+import time
+
+from flask import jsonify
+
+from app import app, encoding, views
+from app.app_class import Connect
+from app.encoding import dumps, join
+from app.hashing import PasswordHasher
+from benchmarks.bench_businesses import seed
+from benchmarks.common import print_table
+
+
+def rate(func, count):
+    start = time.perf_counter()
+    for number in range(count):
+        func(number)
+    return count / (time.perf_counter() - start)
+
+
+def forget_encodings(connect):
+    for business in connect.storage.all_businesses():
+        business.encoded = None
+
+
+def encoding_pair(page):
+    businesses, next_after = page
+    return join(businesses), dumps(next_after)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--businesses', type=int, default=10000)
+    parser.add_argument('--requests', type=int, default=2000)
+    options = parser.parse_args()
+
+    connect = Connect(PasswordHasher(rounds=4, workers=0))
+    seed(connect, options.businesses)
+    size = options.businesses
+    count = options.requests
+
+    workloads = [
+        ('detail', count,
+         lambda n: jsonify({'business': connect.get_business(n % size + 1)}),
+         lambda n: views.json_response(b'{"business":%s}' % connect.get_business(n % size + 1, as_json=True))),
+        ('page of 20', count,
+         lambda n: jsonify(dict(zip(('businesses', 'next'), connect.page_businesses(20, n % size)))),
+         lambda n: views.json_response(b'{"businesses":%s,"next":%s}' % tuple(
+             encoding_pair(connect.page_businesses(20, n % size, as_json=True))))),
+        ('page of 100', count // 5,
+         lambda n: jsonify(dict(zip(('businesses', 'next'), connect.page_businesses(100, n % size)))),
+         lambda n: views.json_response(b'{"businesses":%s,"next":%s}' % tuple(
+             encoding_pair(connect.page_businesses(100, n % size, as_json=True))))),
+        ('all businesses', 5,
+         lambda n: jsonify({'businesses': connect.get_businesses()}),
+         lambda n: views.json_response(b'{"businesses":%s}' % join(connect.get_businesses(as_json=True)))),
+    ]
+    fast = encoding.orjson
+    rows = []
+    with app.test_request_context():
+        for name, requests, old, new in workloads:
+            results = [rate(old, requests)]
+            for encoder in (None, fast):
+                encoding.orjson = encoder
+                forget_encodings(connect)
+                results.append(rate(new, requests))
+                results.append(rate(new, requests))
+            encoding.orjson = fast
+            rows.append([name] + ['%.0f' % result for result in results] +
+                        ['%.1fx' % (results[-1] / results[0])])
+    connect.close()
+    print_table(['responses/s', 'jsonify', 'json first', 'json cached', 'orjson first', 'orjson cached',
+                 'speedup'], rows)
+
+
+if __name__ == '__main__':
+    main()
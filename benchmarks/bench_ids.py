@@ -0,0 +1,42 @@
+"""Measures how many ids IdGenerator makes per second, from one thread
+and from several threads sharing a generator.
+
+    python -m benchmarks.bench_ids --count 1000000 --threads 1 4"""
+import argparse
+import threading
+import time
+
+from app.ids import IdGenerator
+from benchmarks.common import print_table
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=1000000)
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 4])
+    options = parser.parse_args()
+
+    rows = []
+    for threads in options.threads:
+        ids = IdGenerator()
+        per_thread = options.count // threads
+        made = [None] * threads
+
+        def work(slot):
+            next_id = ids.next_id
+            made[slot] = [next_id() for _ in range(per_thread)]
+
+        workers = [threading.Thread(target=work, args=(slot,)) for slot in range(threads)]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+        unique = len(set(made_id for chunk in made for made_id in chunk))
+        rows.append([threads, '%.0f' % (per_thread * threads / elapsed), unique == per_thread * threads])
+    print_table(['threads', 'ids/s', 'unique'], rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,348 @@
+"""Load test of the HTTP API: seeds users, businesses and reviews, replays
+a mixed workload over every endpoint and reports latency percentiles and
+throughput per endpoint.
+
+Requests go through the Flask test client, or with --server through a
+WSGI server started in this process and --clients concurrent clients.
+The workload is drawn from a seeded random generator, so two runs with
+the same options send the same requests.
+
+    python -m benchmarks.bench_load --businesses 10000 --requests 5000 --save baseline.json
+    python -m benchmarks.bench_load --businesses 10000 --requests 5000 --compare baseline.json
+
+--mix sets the share of each endpoint, e.g. --mix get_business=50 login=0.
+With --compare the run exits with status 1 when an endpoint's p50 or p95
+grew, or its throughput fell, by more than --tolerance."""
+import argparse
+import http.client
+import json
+import platform
+import random
+import sys
+import threading
+import time
+
+from flask_jwt_extended import create_access_token
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from app import app, views
+from app.hashing import PasswordHasher
+from benchmarks.common import percentile, print_table
+
+# share of the workload taken by each endpoint, in percent
+MIX = {
+    'get_business': 30,
+    'list_businesses': 15,
+    'search_businesses': 10,
+    'get_reviews': 10,
+    'add_review': 10,
+    'update_business': 8,
+    'create_business': 7,
+    'delete_business': 2,
+    'login': 5,
+    'register': 3,
+}
+
+
+class Dataset():
+    """Seeded users, businesses and reviews, and the requests drawn from them.
+    - users: number of users; the first hundred own the businesses
+    - businesses: number of businesses
+    - reviews: number of reviews, spread over the businesses"""
+
+    def __init__(self, users, businesses, reviews):
+        self.users = users
+        self.lock = threading.Lock()
+        self.registered = 0
+        self.tokens = {}
+        # ids of the businesses of each owner
+        self.owned = {}
+        self.business_ids = []
+        self.positions = {}
+        self.size = {'users': users, 'businesses': businesses, 'reviews': reviews}
+
+    def seed(self, connect):
+        """Adds the dataset to connect straight through Connect."""
+        user_ids = []
+        for number in range(self.users):
+            user_id = views.ids.next_id()
+            connect.register_user(user_id, 'First%d' % number, 'Last%d' % number,
+                                  'user%d@example.com' % number, 'password%d' % number)
+            user_ids.append(user_id)
+        owners = user_ids[:100]
+        items = {}
+        for number in range(self.size['businesses']):
+            owner = owners[number % len(owners)]
+            items.setdefault(owner, []).append({
+                'business_id': views.ids.next_id(), 'name': 'Business %d' % number,
+                'location': 'Location %d' % (number % 50), 'category': 'Category %d' % (number % 20),
+                'description': 'Description of business %d' % number})
+        for owner, businesses in items.items():
+            for start in range(0, len(businesses), 1000):
+                connect.create_businesses(owner, businesses[start:start + 1000])
+            self.owned[owner] = [business['business_id'] for business in businesses]
+            for business_id in self.owned[owner]:
+                self.positions[business_id] = len(self.business_ids)
+                self.business_ids.append(business_id)
+        for number in range(self.size['reviews']):
+            connect.add_review(self.business_ids[number % len(self.business_ids)], views.ids.next_id(),
+                               'Review %d' % number)
+        with app.test_request_context():
+            for owner in owners:
+                self.tokens[owner] = 'Bearer %s' % create_access_token(identity=owner)
+        self.owners = dict((token, owner) for owner, token in self.tokens.items())
+
+    def request(self, endpoint, rng):
+        """Returns the (method, url, body, token) of a request to an endpoint."""
+        owner = rng.choice(list(self.tokens))
+        token = self.tokens[owner]
+        with self.lock:
+            business_id = rng.choice(self.business_ids)
+            owned = self.owned[owner]
+        if endpoint == 'get_business':
+            return 'GET', '/api/v1/businesses/%d' % business_id, None, token
+        if endpoint == 'list_businesses':
+            return 'GET', '/api/v1/businesses?limit=20&after=%d' % (business_id - 1), None, token
+        if endpoint == 'search_businesses':
+            return 'GET', '/api/v1/businesses?q=business&category=Category%%20%d&limit=20' % rng.randrange(20), \
+                None, token
+        if endpoint == 'get_reviews':
+            return 'GET', '/api/v1/businesses/%d/reviews?limit=20' % business_id, None, token
+        if endpoint == 'add_review':
+            return 'POST', '/api/v1/businesses/%d/reviews' % business_id, \
+                {'review': 'Review %d' % rng.randrange(10 ** 6)}, token
+        if endpoint == 'create_business':
+            number = rng.randrange(10 ** 6)
+            return 'POST', '/api/v1/businesses', {
+                'name': 'New business %d' % number, 'location': 'Location %d' % (number % 50),
+                'category': 'Category %d' % (number % 20), 'description': 'Description %d' % number}, token
+        if endpoint == 'update_business':
+            number = rng.randrange(10 ** 6)
+            return 'PUT', '/api/v1/businesses/%d' % rng.choice(owned), {
+                'name': 'Renamed %d' % number, 'location': 'Location %d' % (number % 50),
+                'category': 'Category %d' % (number % 20), 'description': 'Description %d' % number}, token
+        if endpoint == 'delete_business':
+            # deletes the owner's newest business but never its last one;
+            # an owner with a single business deletes a missing one instead
+            with self.lock:
+                business_id = owned.pop() if len(owned) > 1 else 0
+                if business_id:
+                    self._forget(business_id)
+            return 'DELETE', '/api/v1/businesses/%d' % business_id, None, token
+        if endpoint == 'login':
+            number = rng.randrange(self.users)
+            return 'POST', '/api/v1/auth/login', {'email': 'user%d@example.com' % number,
+                                                  'password': 'password%d' % number}, None
+        if endpoint == 'register':
+            with self.lock:
+                self.registered += 1
+                number = self.registered
+            return 'POST', '/api/v1/auth/register', {
+                'email': 'new%d-%d@example.com' % (number, rng.randrange(10 ** 9)), 'first_name': 'New',
+                'last_name': 'User', 'password': 'password'}, None
+        raise ValueError('Unknown endpoint %s' % endpoint)
+
+    def created(self, token, response_body):
+        """Makes a business created by the workload available to later requests."""
+        business_id = json.loads(response_body)['business']['business_id']
+        owner = self.owners[token]
+        with self.lock:
+            self.owned[owner].append(business_id)
+            self.positions[business_id] = len(self.business_ids)
+            self.business_ids.append(business_id)
+
+    def _forget(self, business_id):
+        """Removes a business from the ids requests are drawn from, in O(1)."""
+        position = self.positions.pop(business_id)
+        last = self.business_ids.pop()
+        if last != business_id:
+            self.business_ids[position] = last
+            self.positions[last] = position
+
+
+class QuietHandler(WSGIRequestHandler):
+    """Request handler of the local server that does not log every request."""
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def client_sender():
+    """Returns a function sending a request through the Flask test client."""
+    client = app.test_client()
+
+    def send(method, url, body, token):
+        headers = {'Authorization': token} if token else {}
+        response = client.open(url, method=method, headers=headers,
+                               data=json.dumps(body) if body is not None else None,
+                               content_type='application/json')
+        return response.status_code, response.get_data()
+    return send
+
+
+def server_sender(port):
+    """Returns a function sending a request to the local server."""
+    def send(method, url, body, token):
+        headers = {'Content-Type': 'application/json'}
+        if token:
+            headers['Authorization'] = token
+        connection = http.client.HTTPConnection('127.0.0.1', port)
+        try:
+            connection.request(method, url, json.dumps(body) if body is not None else None, headers)
+            response = connection.getresponse()
+            return response.status, response.read()
+        finally:
+            connection.close()
+    return send
+
+
+def run(dataset, send, endpoints, weights, count, seed, samples):
+    """Sends count requests drawn from the mix, adding (endpoint, seconds, status)
+    to samples."""
+    rng = random.Random(seed)
+    for endpoint in rng.choices(endpoints, weights, k=count):
+        method, url, body, token = dataset.request(endpoint, rng)
+        start = time.perf_counter()
+        status, response_body = send(method, url, body, token)
+        elapsed = time.perf_counter() - start
+        if endpoint == 'create_business' and status == 201:
+            dataset.created(token, response_body)
+        samples.append((endpoint, elapsed, status))
+
+
+def report(samples, elapsed):
+    """Returns the latencies, in milliseconds, and the throughput of each endpoint."""
+    latencies = {}
+    errors = {}
+    for endpoint, seconds, status in samples:
+        latencies.setdefault(endpoint, []).append(seconds * 1000)
+        errors[endpoint] = errors.get(endpoint, 0) + (status >= 400)
+    results = {}
+    for endpoint, values in sorted(latencies.items()):
+        values.sort()
+        results[endpoint] = {
+            'requests': len(values), 'errors': errors[endpoint],
+            'p50': percentile(values, 0.50), 'p95': percentile(values, 0.95), 'p99': percentile(values, 0.99),
+            'throughput': len(values) / elapsed,
+        }
+    values = sorted(seconds * 1000 for _, seconds, _ in samples)
+    results['all'] = {
+        'requests': len(values), 'errors': sum(errors.values()),
+        'p50': percentile(values, 0.50), 'p95': percentile(values, 0.95), 'p99': percentile(values, 0.99),
+        'throughput': len(values) / elapsed,
+    }
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Prints the change of every endpoint against a baseline.
+    Returns the endpoints that got slower by more than tolerance."""
+    rows = []
+    regressions = []
+    for endpoint, result in results.items():
+        old = baseline['endpoints'].get(endpoint)
+        if old is None:
+            continue
+        changes = [(result[key] - old[key]) / old[key] if old[key] else 0.0
+                   for key in ('p50', 'p95', 'p99', 'throughput')]
+        # p99 is reported but left out of the verdict: a few slow requests move it too much
+        slower = changes[0] > tolerance or changes[1] > tolerance or changes[3] < -tolerance
+        if slower:
+            regressions.append(endpoint)
+        rows.append([endpoint] + ['%+.1f%%' % (100 * change) for change in changes] +
+                    ['REGRESSION' if slower else 'ok'])
+    print_table(['endpoint', 'p50', 'p95', 'p99', 'req/s', ''], rows)
+    return regressions
+
+
+def parse_mix(values):
+    mix = dict(MIX)
+    for value in values:
+        endpoint, _, weight = value.partition('=')
+        if endpoint not in MIX:
+            raise SystemExit('Unknown endpoint %s; choose from %s' % (endpoint, ', '.join(MIX)))
+        mix[endpoint] = float(weight)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--businesses', type=int, default=10000)
+    parser.add_argument('--reviews', type=int, default=20000)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--warmup', type=int, default=500)
+    parser.add_argument('--mix', nargs='*', default=[], metavar='ENDPOINT=WEIGHT')
+    parser.add_argument('--server', action='store_true', help='send requests to a local WSGI server')
+    parser.add_argument('--clients', type=int, default=1, help='concurrent clients of --server')
+    parser.add_argument('--bcrypt-rounds', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--save', metavar='PATH', help='write the results as a JSON baseline')
+    parser.add_argument('--compare', metavar='PATH', help='compare the results with a JSON baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    options = parser.parse_args()
+    if options.clients > 1 and not options.server:
+        parser.error('--clients needs --server')
+
+    mix = parse_mix(options.mix)
+    endpoints = [endpoint for endpoint in MIX if mix[endpoint] > 0]
+    weights = [mix[endpoint] for endpoint in endpoints]
+
+    views.weconnect = views.Connect(PasswordHasher(rounds=options.bcrypt_rounds, workers=0))
+    views.response_cache.attach(views.weconnect)
+    # every request comes from one address; lift its rate limit
+    views.admission.clients.rate = views.admission.clients.burst = 10 ** 9
+    dataset = Dataset(options.users, options.businesses, options.reviews)
+    dataset.seed(views.weconnect)
+
+    server = None
+    if options.server:
+        server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        send = server_sender(server.server_port)
+    else:
+        send = client_sender()
+
+    try:
+        run(dataset, send, endpoints, weights, options.warmup, options.seed - 1, [])
+        samples = []
+        per_client = options.requests // options.clients
+        clients = [threading.Thread(target=run, args=(dataset, send, endpoints, weights, per_client,
+                                                       options.seed + number, samples))
+                   for number in range(options.clients)]
+        start = time.perf_counter()
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        if server is not None:
+            server.shutdown()
+        views.weconnect.close()
+
+    results = report(samples, elapsed)
+    print_table(['endpoint', 'requests', 'errors', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s'],
+                [[endpoint, result['requests'], result['errors'], '%.2f' % result['p50'], '%.2f' % result['p95'],
+                  '%.2f' % result['p99'], '%.0f' % result['throughput']] for endpoint, result in results.items()])
+
+    settings = dict(dataset.size, requests=options.requests, mix=mix, server=options.server,
+                    clients=options.clients, bcrypt_rounds=options.bcrypt_rounds, seed=options.seed)
+    if options.save:
+        with open(options.save, 'w') as baseline_file:
+            json.dump({'settings': settings, 'python': platform.python_version(),
+                       'machine': platform.node(), 'endpoints': results}, baseline_file, indent=2, sort_keys=True)
+    if options.compare:
+        with open(options.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline['settings'] != settings:
+            print('warning: the baseline was taken with other settings: %s' % baseline['settings'])
+        print()
+        regressions = compare(results, baseline, options.tolerance)
+        if regressions:
+            print('\nslower than the baseline: %s' % ', '.join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""Reports the memory taken per business and per user record, kept as
+plain dictionaries (as they were stored before) and as the __slots__
+records of app.records, plus the whole MemoryStorage per business.
+
+    python -m benchmarks.bench_memory --records 1000000"""
+import argparse
+import gc
+import tracemalloc
+
+from app.records import Business, User
+from app.storage import MemoryStorage
+from benchmarks.common import print_table
+
+
+def business_values(number):
+    # category and location strings are built per record, as they are
+    # when they arrive in a request
+    return (number % 1000, number, 'Business %d' % number, 'City %d' % (number % 300),
+            'Serving since %d' % (1900 + number % 120), 'Category %d' % (number % 40))
+
+
+def user_values(number):
+    return (number, 'First%d' % number, 'Last%d' % number, 'user%d@example.com' % number,
+            '$2b$12$' + '%053d' % number)
+
+
+def measure(make, count):
+    """Returns the bytes allocated per item by make(number)."""
+    gc.collect()
+    tracemalloc.start()
+    items = [make(number) for number in range(count)]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del items
+    return float(size) / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--records', type=int, default=1000000)
+    options = parser.parse_args()
+    count = options.records
+
+    fields = ('user_id', 'business_id', 'name', 'location', 'description', 'category')
+    user_fields = ('id', 'first_name', 'last_name', 'email', 'password')
+
+    def storage_per_business(number):
+        storage.add_business(Business.from_row(business_values(number)))
+
+    storage = MemoryStorage()
+    rows = [
+        ['business', '%.0f' % measure(lambda n: dict(zip(fields, business_values(n))), count),
+         '%.0f' % measure(lambda n: Business.from_row(business_values(n)), count)],
+        ['user', '%.0f' % measure(lambda n: dict(zip(user_fields, user_values(n))), count),
+         '%.0f' % measure(lambda n: User(*user_values(n)), count)],
+    ]
+    print_table(['record', 'dict bytes', 'slots bytes'], rows)
+    print('MemoryStorage: %.0f bytes per business with indexes' % measure(storage_per_business, count))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""Measures the overhead of the metrics layer: request and Connect
+call throughput with recording switched on and off.
+
+    python -m benchmarks.bench_metrics --requests 5000 --rounds 5"""
+import argparse
+import time
+
+from flask_jwt_extended import create_access_token
+
+from app import app, views
+from app.hashing import PasswordHasher
+from app.metrics import REGISTRY
+from benchmarks.common import print_table
+
+
+def rate(func, count):
+    start = time.perf_counter()
+    for number in range(count):
+        func(number)
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--rounds', type=int, default=5)
+    options = parser.parse_args()
+
+    views.weconnect = views.Connect(PasswordHasher(rounds=4))
+    views.response_cache.attach(views.weconnect)
+    for business_id in range(1, 1001):
+        views.weconnect.create_business(1, business_id, 'Business %d' % business_id, 'City',
+                                        'Category', 'Description')
+    client = app.test_client()
+    with app.test_request_context():
+        token = create_access_token(identity=1)
+    headers = {'Authorization': 'Bearer %s' % token}
+
+    workloads = [
+        ('GET business', lambda n: client.get('/api/v1/businesses/%d' % (n % 1000 + 1), headers=headers), 1),
+        ('GET page', lambda n: client.get('/api/v1/businesses?limit=20&after=%d' % (n % 900), headers=headers), 1),
+        ('Connect.get_business', lambda n: views.weconnect.get_business(n % 1000 + 1), 20),
+    ]
+    rows = []
+    for name, func, scale in workloads:
+        best = {True: 0.0, False: 0.0}
+        # alternate the two settings so that drift affects both alike
+        for _ in range(options.rounds):
+            for enabled in (False, True):
+                REGISTRY.enabled = enabled
+                best[enabled] = max(best[enabled], rate(func, options.requests * scale))
+        overhead = 100.0 * (best[False] - best[True]) / best[False]
+        rows.append([name, '%.0f' % best[False], '%.0f' % best[True], '%.1f%%' % overhead])
+    REGISTRY.enabled = True
+    views.weconnect.close()
+    print_table(['workload', 'off ops/s', 'on ops/s', 'overhead'], rows)
+
+
+if __name__ == '__main__':
+    main()
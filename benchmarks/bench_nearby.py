@@ -0,0 +1,68 @@
+"""Measures nearby searches on the grid index against measuring the
+distance to every business, with businesses spread over a country-sized
+area, for a few search radii.
+
+    python -m benchmarks.bench_nearby --points 1000000 --radii 1000 5000 20000"""
+import argparse
+import heapq
+import random
+
+from app.geo import GridIndex, distance
+from app.records import Business
+from benchmarks.common import print_table, summarize, time_calls
+
+# south-west corner and size in degrees of the area the businesses are spread over
+AREA = (45.0, 0.0, 10.0)
+
+
+def scan(points, latitude, longitude, radius, limit, include=None):
+    """Finds the nearest businesses by measuring the distance to every one."""
+    found = []
+    for business_id, point_latitude, point_longitude in points:
+        if include is not None and business_id not in include:
+            continue
+        metres = distance(latitude, longitude, point_latitude, point_longitude)
+        if metres <= radius:
+            found.append((metres, business_id))
+    return heapq.nsmallest(limit, found)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--points', type=int, default=1000000)
+    parser.add_argument('--radii', type=float, nargs='+', default=[1000, 5000, 20000])
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--scans', type=int, default=5)
+    parser.add_argument('--limit', type=int, default=20)
+    options = parser.parse_args()
+
+    rng = random.Random(1)
+    south, west, size = AREA
+    index = GridIndex()
+    points = []
+    for business_id in range(options.points):
+        latitude, longitude = south + rng.random() * size, west + rng.random() * size
+        points.append((business_id, latitude, longitude))
+        index.add(Business(business_id, 'Business', 'Place', 'Description', 'Category', 1, latitude, longitude))
+    # one business in twenty belongs to the filtered category
+    category = set(business_id for business_id in range(0, options.points, 20))
+
+    rows = []
+    for radius in options.radii:
+        for name, include in (('all', None), ('category', category)):
+            queries = [(south + rng.random() * size, west + rng.random() * size)
+                       for _ in range(options.queries)]
+            grid = summarize(time_calls(lambda latitude, longitude: index.nearby(
+                latitude, longitude, radius, options.limit, include), queries))
+            brute = summarize(time_calls(lambda latitude, longitude: scan(
+                points, latitude, longitude, radius, options.limit, include), queries[:options.scans]))
+            for latitude, longitude in queries[:options.scans]:
+                assert index.nearby(latitude, longitude, radius, options.limit, include) == \
+                    scan(points, latitude, longitude, radius, options.limit, include)
+            rows.append(['%.0f' % radius, name, '%.0f' % grid['p50'], '%.0f' % grid['p99'],
+                         '%.0f' % brute['p50'], '%.0fx' % (brute['p50'] / grid['p50'])])
+    print_table(['radius m', 'businesses', 'grid p50 us', 'grid p99 us', 'scan p50 us', 'speedup'], rows)
+
+
+if __name__ == '__main__':
+    main()
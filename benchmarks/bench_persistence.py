@@ -0,0 +1,115 @@
+"""Measures snapshot writing, restart time and logged write throughput.
+
+The databases are filled directly, written to a snapshot, and then
+a tail of changes is logged on top. Restart time is the time taken by
+Connect to load the snapshot and replay the tail. The longest write
+made while a second snapshot is taken shows how long changes wait for it.
+
+    python -m benchmarks.bench_persistence --records 10000000"""
+import argparse
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from app.app_class import Connect
+from app.hashing import PasswordHasher
+from app.persistence import Persistence
+
+HASH = '$2b$04$' + 'x' * 53
+
+
+def fill(connect, records):
+    """Adds records split into 10% users, 20% businesses and 70% reviews."""
+    users = max(1, records // 10)
+    businesses = max(1, records // 5)
+    reviews = records - users - businesses
+    for user_id in range(1, users + 1):
+        connect._apply_add_user({'id': user_id, 'first_name': 'First', 'last_name': 'Last',
+                                 'email': 'user%d@example.com' % user_id, 'password': HASH})
+    for business_id in range(1, businesses + 1):
+        connect._apply_add_business({'user_id': business_id % users + 1, 'business_id': business_id,
+                                     'name': 'Business %d' % business_id, 'location': 'City %d' % (business_id % 300),
+                                     'description': 'Serving since %d' % (1900 + business_id % 120),
+                                     'category': 'Category %d' % (business_id % 40)})
+    for review_id in range(1, reviews + 1):
+        connect.storage.add_review(review_id % businesses + 1, review_id, 'Review %d' % review_id)
+
+
+def logged_writes(connect, threads, per_thread):
+    """Adds reviews from several threads and returns the changes per second."""
+    def work(offset):
+        for number in range(per_thread):
+            connect.add_review(1, offset + number, 'Logged review')
+    workers = [threading.Thread(target=work, args=(10 ** 12 + index * per_thread,)) for index in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return threads * per_thread / (time.perf_counter() - start)
+
+
+def longest_write_during_snapshot(connect):
+    """Takes a snapshot while a thread keeps adding reviews, and returns
+    the longest time one of them took, in seconds."""
+    done = threading.Event()
+    longest = [0.0]
+
+    def work():
+        review_id = 2 * 10 ** 12
+        while not done.is_set():
+            start = time.perf_counter()
+            connect.add_review(1, review_id, 'Logged review')
+            longest[0] = max(longest[0], time.perf_counter() - start)
+            review_id += 1
+    writer = threading.Thread(target=work)
+    writer.start()
+    time.sleep(0.1)
+    connect.snapshot()
+    done.set()
+    writer.join()
+    return longest[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--records', type=int, default=10000000)
+    parser.add_argument('--tail', type=int, default=10000, help='changes logged after the snapshot')
+    parser.add_argument('--no-sync', action='store_true', help='skip fsync on log writes')
+    options = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='weconnect-bench-')
+    hasher = PasswordHasher(workers=0)
+    try:
+        connect = Connect(hasher, Persistence(directory, snapshot_every=10 ** 12, sync=not options.no_sync))
+        fill(connect, options.records)
+        start = time.perf_counter()
+        connect.snapshot()
+        snapshot_seconds = time.perf_counter() - start
+        snapshot_bytes = os.path.getsize(os.path.join(directory, 'snapshot.bin'))
+
+        single = logged_writes(connect, 1, options.tail // 2)
+        grouped = logged_writes(connect, 16, options.tail // 32)
+        longest = longest_write_during_snapshot(connect)
+        connect.close()
+        del connect
+
+        start = time.perf_counter()
+        connect = Connect(hasher, Persistence(directory))
+        restart_seconds = time.perf_counter() - start
+        connect.close()
+
+        print('records                 %d' % options.records)
+        print('snapshot write          %.2f s, %.1f MB' % (snapshot_seconds, snapshot_bytes / 1e6))
+        print('logged writes, 1 thread %.0f/s' % single)
+        print('logged writes, 16 thr.  %.0f/s (group commit)' % grouped)
+        print('longest write during a snapshot  %.1f ms' % (longest * 1000))
+        print('restart (snapshot + %d logged changes)  %.2f s' % (options.tail, restart_seconds))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
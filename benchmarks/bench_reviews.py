@@ -0,0 +1,36 @@
+"""Measures business reads and review pages on a business with a
+growing number of reviews.
+
+    python -m benchmarks.bench_reviews --sizes 1000 100000 500000"""
+import argparse
+import random
+
+from app.app_class import Connect
+from app.hashing import PasswordHasher
+from benchmarks.common import print_table, summarize, time_calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 100000, 500000])
+    parser.add_argument('--reads', type=int, default=1000)
+    options = parser.parse_args()
+
+    rows = []
+    for size in options.sizes:
+        connect = Connect(PasswordHasher(workers=0))
+        connect.create_business(1, 1, 'Busy Cafe', 'Nairobi', 'food', 'Everyone reviews it')
+        appended = summarize(time_calls(connect.add_review,
+                                        [(1, review_id, 'Review number %d' % review_id)
+                                         for review_id in range(1, size + 1)]))
+        get = summarize(time_calls(connect.get_business, [(1,)] * options.reads))
+        pages = summarize(time_calls(connect.get_reviews,
+                                     [(1, 20, random.randint(0, size - 1)) for _ in range(options.reads)]))
+        rows.append([size, '%.2f' % appended['p50'], '%.2f' % get['p50'], '%.2f' % get['p99'],
+                     '%.2f' % pages['p50'], '%.2f' % pages['p99']])
+    print_table(['reviews', 'append p50 us', 'get business p50 us', 'p99 us',
+                 'review page p50 us', 'p99 us'], rows)
+
+
+if __name__ == '__main__':
+    main()
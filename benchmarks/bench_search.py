@@ -0,0 +1,70 @@
+"""Measures Connect.search_businesses against a linear scan
+over the whole catalogue.
+
+    python -m benchmarks.bench_search --size 1000000"""
+import argparse
+import random
+
+from app.app_class import Connect
+from app.hashing import PasswordHasher
+from app.search import tokenize
+from benchmarks.common import print_table, summarize, time_calls
+
+WORDS = ['coffee', 'bakery', 'garage', 'pharmacy', 'salon', 'grill', 'books', 'florist',
+         'hardware', 'tailor', 'dental', 'yoga', 'pizza', 'sushi', 'vintage', 'repair']
+
+
+def seed(connect, size):
+    """Creates size businesses with names drawn from a small vocabulary
+    plus a unique word per business, so queries range from very common
+    to matching a single business."""
+    rand = random.Random(1)
+    for business_id in range(1, size + 1):
+        connect.create_business(
+            business_id % 1000, business_id,
+            '%s %s shop%d' % (rand.choice(WORDS), rand.choice(WORDS), business_id),
+            'city%d' % rand.randint(1, 500), 'category%d' % rand.randint(1, 40),
+            'Family run %s since %d' % (rand.choice(WORDS), rand.randint(1950, 2020)))
+
+
+def scan(connect, query, category):
+    """Finds the first page of matches by looking at every business."""
+    tokens = set(tokenize(query))
+    matches = [business for business in connect.storage.all_businesses()
+               if business.category == category
+               and tokens <= set(tokenize(business.name + ' ' + business.description))]
+    return matches[:20]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=int, default=1000000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--scans', type=int, default=3)
+    options = parser.parse_args()
+
+    connect = Connect(PasswordHasher(workers=0))
+    seed(connect, options.size)
+    cases = [
+        ('unique word', lambda: ('shop%d' % random.randint(1, options.size), None, None)),
+        ('word + category', lambda: (random.choice(WORDS), 'category%d' % random.randint(1, 40), None)),
+        ('two words + location', lambda: ('%s %s' % (random.choice(WORDS), random.choice(WORDS)),
+                                          None, 'city%d' % random.randint(1, 500))),
+        ('category + location', lambda: (None, 'category%d' % random.randint(1, 40),
+                                         'city%d' % random.randint(1, 500))),
+        ('common word', lambda: (random.choice(WORDS), None, None)),
+    ]
+    rows = []
+    for name, make_args in cases:
+        latencies = summarize(time_calls(connect.search_businesses,
+                                         [make_args() for _ in range(options.queries)]))
+        rows.append([name, '%.0f' % latencies['p50'], '%.0f' % latencies['p99']])
+    scanned = summarize(time_calls(scan, [(connect, random.choice(WORDS), 'category%d' % random.randint(1, 40))
+                                          for _ in range(options.scans)]))
+    rows.append(['linear scan', '%.0f' % scanned['p50'], '%.0f' % scanned['p99']])
+    print('%d businesses' % options.size)
+    print_table(['query', 'p50 us', 'p99 us'], rows)
+
+
+if __name__ == '__main__':
+    main()
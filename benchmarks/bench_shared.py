@@ -0,0 +1,82 @@
+"""Measures Connect throughput in shared-state mode as the number of
+worker processes grows. A state process holds the databases; every
+worker keeps a replica, reads from it and forwards its writes.
+
+    python -m benchmarks.bench_shared --processes 1 2 4 8 --write-ratio 0.05"""
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from app.app_class import Connect
+from app.hashing import PasswordHasher
+from app.shared import StateClient, StateServer
+from benchmarks.common import print_table
+
+
+def serve(address, businesses):
+    connect = Connect(PasswordHasher(rounds=4, workers=0))
+    connect.create_businesses(1, [{'business_id': business_id, 'name': 'Business %d' % business_id,
+                                   'location': 'Location %d' % (business_id % 50),
+                                   'category': 'Category %d' % (business_id % 20),
+                                   'description': 'Description of business %d' % business_id}
+                                  for business_id in range(1, businesses + 1)])
+    StateServer(connect, address).serve_forever()
+
+
+def work(address, businesses, seconds, write_ratio, results):
+    connect = Connect(PasswordHasher(rounds=4, workers=0), primary=StateClient(address))
+    rng = random.Random(os.getpid())
+    operations = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        business_id = rng.randint(1, businesses)
+        if rng.random() < write_ratio:
+            connect.update_business(1, business_id, name='Renamed %d' % operations)
+        else:
+            connect.get_business(business_id)
+        operations += 1
+    connect.close()
+    results.put(operations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--processes', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--businesses', type=int, default=100000)
+    parser.add_argument('--seconds', type=float, default=3.0)
+    parser.add_argument('--write-ratio', type=float, default=0.05)
+    options = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    address = os.path.join(directory, 'state.sock')
+    context = multiprocessing.get_context('fork')
+    server = context.Process(target=serve, args=(address, options.businesses), daemon=True)
+    server.start()
+    while not os.path.exists(address):
+        time.sleep(0.05)
+
+    rows = []
+    try:
+        for processes in options.processes:
+            results = context.Queue()
+            workers = [context.Process(target=work, args=(address, options.businesses, options.seconds,
+                                                          options.write_ratio, results))
+                       for _ in range(processes)]
+            for worker in workers:
+                worker.start()
+            operations = sum(results.get() for _ in workers)
+            for worker in workers:
+                worker.join()
+            rows.append([processes, '%.0f' % (operations / options.seconds)])
+    finally:
+        server.terminate()
+        shutil.rmtree(directory)
+    print_table(['processes', 'operations/s'], rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+"""Compares starting worker processes that each load the databases with
+forking them from a master that loaded them once, as gunicorn --preload
+does. Reports the time from starting a worker to its first response and
+the memory of every worker, after the first response and after reading
+every business, as resident (RSS), proportional (PSS, shared pages split
+between the processes sharing them) and private sizes. The databases
+are kept by a state process, since workers cannot share a log otherwise,
+so every worker holds a replica of them.
+
+    python -m benchmarks.bench_startup --businesses 200000 --workers 4"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.common import print_table
+
+ENVIRONMENT = {'WAL_SYNC': '0', 'BCRYPT_WORKERS': '0', 'JWT_SECRET_KEY': 'benchmark secret'}
+
+
+def seed(directory, size):
+    """Writes a snapshot of size businesses to directory."""
+    from app.app_class import Connect
+    from app.hashing import PasswordHasher
+    from app.persistence import Persistence
+    connect = Connect(PasswordHasher(rounds=4, workers=0), Persistence(directory, sync=False))
+    for start in range(1, size + 1, 1000):
+        connect.create_businesses(1, [{'business_id': business_id, 'name': 'Business %d' % business_id,
+                                       'location': 'Location %d' % (business_id % 50),
+                                       'category': 'Category %d' % (business_id % 20),
+                                       'description': 'Description of business %d' % business_id}
+                                      for business_id in range(start, min(start + 1000, size + 1))])
+    connect.snapshot()
+    connect.close()
+
+
+def memory(pid):
+    """Returns the RSS, PSS and private memory of a process in MB."""
+    sizes = {}
+    with open('/proc/%d/smaps_rollup' % pid) as rollup:
+        for line in rollup:
+            fields = line.split()
+            if len(fields) == 3 and fields[2] == 'kB':
+                sizes[fields[0].rstrip(':')] = int(fields[1]) / 1024.0
+    return sizes['Rss'], sizes['Pss'], sizes['Private_Clean'] + sizes['Private_Dirty']
+
+
+def serve(app, started, report, wait):
+    """Answers a first request, then reads every business, reporting after
+    each step, and waits to be told to exit."""
+    from flask_jwt_extended import create_access_token
+    with app.test_request_context():
+        headers = {'Authorization': 'Bearer %s' % create_access_token(identity=1)}
+    client = app.test_client()
+    assert client.get('/api/v1/businesses?limit=1', headers=headers).status_code == 200
+    report('%f\n' % (time.time() - started))
+    after = 0
+    while after is not None:
+        page = client.get('/api/v1/businesses?limit=100&after=%d' % after, headers=headers).get_json()
+        after = page['next']
+    report('read\n')
+    wait()
+
+
+def worker(started):
+    """Entry point of a worker started as a new process."""
+    from app import app
+    serve(app, started, lambda line: (sys.stdout.write(line), sys.stdout.flush()), sys.stdin.readline)
+
+
+def start_fresh(count):
+    """Starts count workers that load the databases themselves."""
+    workers = []
+    for _ in range(count):
+        process = subprocess.Popen([sys.executable, '-m', 'benchmarks.bench_startup', '--worker', str(time.time())],
+                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True)
+        workers.append((process.pid, process.stdout.readline, lambda process=process: finish(process)))
+    return workers
+
+
+def finish(process):
+    process.stdin.write('\n')
+    process.stdin.flush()
+    process.wait()
+
+
+def start_forked(count):
+    """Loads the databases and forks count workers sharing them."""
+    from app import app, views
+    views.before_fork()
+    workers = []
+    for _ in range(count):
+        started = time.time()
+        report_read, report_write = os.pipe()
+        exit_read, exit_write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                views.after_fork()
+                serve(app, started, lambda line: os.write(report_write, line.encode()),
+                      lambda: os.read(exit_read, 1))
+            finally:
+                os._exit(0)
+        reports = os.fdopen(report_read)
+        workers.append((pid, reports.readline,
+                        lambda pid=pid, exit_write=exit_write: (os.write(exit_write, b'x'), os.waitpid(pid, 0))))
+    return workers
+
+
+def start_state(address):
+    """Starts the state process loading the snapshot and waits for it to listen."""
+    from app.shared import StateClient
+    process = subprocess.Popen([sys.executable, '-m', 'app.state_server', address],
+                               env=dict(os.environ, WECONNECT_STATE_SERVER='1'))
+    while True:
+        try:
+            StateClient(address).close()
+            return process
+        except (FileNotFoundError, ConnectionRefusedError):
+            time.sleep(0.05)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--businesses', type=int, default=200000)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--worker', type=float, help=argparse.SUPPRESS)
+    options = parser.parse_args()
+    if options.worker is not None:
+        worker(options.worker)
+        return
+
+    directory = tempfile.mkdtemp()
+    address = os.path.join(directory, 'state.sock')
+    os.environ.update(ENVIRONMENT, WECONNECT_DATA_DIR=directory)
+    rows = []
+    state = None
+    try:
+        seed(directory, options.businesses)
+        state = start_state(address)
+        os.environ['WECONNECT_SHARED_SOCKET'] = address
+        for mode in ('fresh', 'preload'):
+            load = time.time()
+            workers = start_fresh(options.workers) if mode == 'fresh' else start_forked(options.workers)
+            # for preload: loading the databases in the master and forking
+            load = time.time() - load
+            first = [float(readline()) for _, readline, _ in workers]
+            started = [memory(pid) for pid, _, _ in workers]
+            for _, readline, _ in workers:
+                readline()
+            read = [memory(pid) for pid, _, _ in workers]
+            for _, _, stop in workers:
+                stop()
+            average = lambda values: sum(values) / len(values)
+            rows.append([mode, '%.0f' % (1000 * average(first)),
+                         '%.0f' % average([rss for rss, _, _ in started]),
+                         '%.0f' % average([pss for _, pss, _ in started]),
+                         '%.0f' % average([private for _, _, private in started]),
+                         '%.0f' % average([pss for _, pss, _ in read]),
+                         '%.0f' % average([private for _, _, private in read]),
+                         '%.0f' % (1000 * load) if mode == 'preload' else '-'])
+    finally:
+        if state is not None:
+            state.terminate()
+            state.wait()
+        shutil.rmtree(directory)
+    print_table(['workers', 'first response ms', 'RSS MB', 'PSS MB', 'private MB',
+                 'PSS after reads', 'private after reads', 'master load ms'], rows)
+
+
+if __name__ == '__main__':
+    main()
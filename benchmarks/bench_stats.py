@@ -0,0 +1,68 @@
+"""Measures reading the catalogue statistics kept by Connect against
+counting them from the full business list, as dashboards did, plus the
+cost the counters add to reviews and deletes, as the catalogue grows.
+Deleting the most reviewed business is measured on its own, since it
+changes the ranking.
+
+    python -m benchmarks.bench_stats --sizes 1000 10000 100000"""
+import argparse
+import random
+
+from app.app_class import Connect
+from app.hashing import PasswordHasher
+from benchmarks.common import print_table, summarize, time_calls
+
+
+def seed(connect, size, reviews):
+    """Adds size businesses and reviews spread over them at random."""
+    for start in range(1, size + 1, 1000):
+        connect.create_businesses(1, [{'business_id': business_id, 'name': 'Business %d' % business_id,
+                                       'location': 'Location %d' % (business_id % 50),
+                                       'category': 'Category %d' % (business_id % 20),
+                                       'description': 'Description of business %d' % business_id}
+                                      for business_id in range(start, min(start + 1000, size + 1))])
+    for review_id in range(1, reviews + 1):
+        connect.add_review(random.randint(1, size), review_id, 'Review %d' % review_id)
+
+
+def count_from_list(connect):
+    """Builds the statistics from the full business list."""
+    categories, locations = {}, {}
+    businesses = connect.get_businesses()
+    for business in businesses:
+        categories[business['category']] = categories.get(business['category'], 0) + 1
+        locations[business['location']] = locations.get(business['location'], 0) + 1
+    counts = sorted((connect.review_count(business['business_id']), business['business_id'])
+                    for business in businesses)
+    return len(businesses), categories, locations, counts[-10:]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--requests', type=int, default=1000)
+    options = parser.parse_args()
+
+    rows = []
+    for size in options.sizes:
+        connect = Connect(PasswordHasher(rounds=4, workers=0))
+        seed(connect, size, size)
+        stats = summarize(time_calls(connect.get_stats, [()] * options.requests))
+        listed = summarize(time_calls(count_from_list, [(connect,)] * max(1, min(options.requests, 100000 // size))))
+        review = summarize(time_calls(connect.add_review,
+                                      [(random.randint(1, size), size + n, 'Review') for n in range(options.requests)]))
+        delete_top = summarize(time_calls(lambda: connect.delete_business(connect.top_reviewed.top(1)[0][0]),
+                                          [()] * min(size // 10, 200)))
+        delete = summarize(time_calls(connect.delete_business,
+                                      [(business_id,) for business_id in random.sample(range(1, size + 1),
+                                                                                       min(size, options.requests))]))
+        connect.close()
+        rows.append([size, '%.1f' % stats['p50'], '%.1f' % stats['p99'], '%.0f' % listed['p50'],
+                     '%.1f' % review['p50'], '%.1f' % delete['p50'], '%.0f' % delete['p99'],
+                     '%.1f' % delete_top['p50'], '%.0f' % delete_top['p99']])
+    print_table(['businesses', 'stats p50 us', 'stats p99 us', 'counting list p50 us',
+                 'review p50 us', 'delete p50 us', 'delete p99 us', 'delete top p50 us', 'delete top p99 us'], rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""Runs the same workload against every storage backend and reports
+operations per second for each kind of operation.
+
+    python -m benchmarks.bench_storage --businesses 100000"""
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from app.app_class import Connect
+from app.hashing import PasswordHasher
+from app.storage import MemoryStorage, SQLiteStorage
+from benchmarks.common import print_table
+
+HASH = '$2b$04$' + 'x' * 53
+
+
+def throughput(func, args_list):
+    """Calls func for every tuple in args_list and returns calls per second."""
+    start = time.perf_counter()
+    for args in args_list:
+        func(*args)
+    return len(args_list) / (time.perf_counter() - start)
+
+
+def run(connect, size, operations):
+    """Returns the operations per second of each step of the workload."""
+    rand = random.Random(7)
+    results = {}
+    with connect.storage.transaction():
+        results['register'] = throughput(
+            connect._commit, [('add_user', {'id': user_id, 'first_name': 'First', 'last_name': 'Last',
+                                            'email': 'user%d@example.com' % user_id, 'password': HASH})
+                              for user_id in range(1, size // 10 + 1)])
+    results['create'] = throughput(
+        connect.create_business, [(business_id % 1000, business_id, 'Business %d' % business_id,
+                                   'City %d' % (business_id % 300), 'Category %d' % (business_id % 40),
+                                   'Description %d' % business_id)
+                                  for business_id in range(1, size + 1)])
+    ids = [rand.randint(1, size) for _ in range(operations)]
+    results['get'] = throughput(connect.get_business, [(business_id,) for business_id in ids])
+    results['update'] = throughput(connect.update_business,
+                                   [(business_id % 1000, business_id, 'Renamed %d' % business_id)
+                                    for business_id in ids])
+    results['review'] = throughput(connect.add_review, [(business_id, number, 'Great place')
+                                                        for number, business_id in enumerate(ids)])
+    results['reviews page'] = throughput(connect.get_reviews, [(business_id, 20, 0) for business_id in ids])
+    results['page'] = throughput(connect.page_businesses,
+                                 [(20, rand.randint(1, size)) for _ in range(operations)])
+    results['login lookup'] = throughput(connect.storage.get_user_by_email,
+                                         [('user%d@example.com' % rand.randint(1, size // 10),)
+                                          for _ in range(operations)])
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--businesses', type=int, default=100000)
+    parser.add_argument('--operations', type=int, default=20000)
+    options = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='weconnect-bench-')
+    hasher = PasswordHasher(workers=0)
+    try:
+        backends = [('memory', MemoryStorage()),
+                    ('sqlite', SQLiteStorage(os.path.join(directory, 'bench.db')))]
+        columns = {}
+        for name, storage in backends:
+            connect = Connect(hasher, storage=storage)
+            columns[name] = run(connect, options.businesses, options.operations)
+            connect.close()
+        steps = list(columns['memory'])
+        print_table(['ops/s'] + [name for name, _ in backends],
+                    [[step] + ['%.0f' % columns[name][step] for name, _ in backends] for step in steps])
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""Measures Connect read throughput as the number of reader threads
+grows, with one thread writing in the background.
+
+    python -m benchmarks.bench_threads --threads 1 2 4 8 16"""
+import argparse
+import threading
+import time
+
+from app.app_class import Connect
+from app.hashing import PasswordHasher
+from benchmarks.bench_businesses import seed
+from benchmarks.common import print_table
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    parser.add_argument('--businesses', type=int, default=100000)
+    parser.add_argument('--seconds', type=float, default=2.0)
+    options = parser.parse_args()
+
+    connect = Connect(PasswordHasher(rounds=4, workers=0))
+    seed(connect, options.businesses)
+    connect._build_indexes()
+
+    rows = []
+    for threads in options.threads:
+        stop = threading.Event()
+        reads = [0] * threads
+        writes = [0]
+
+        def read(slot):
+            business_id = slot
+            while not stop.is_set():
+                connect.get_business(business_id % options.businesses + 1)
+                connect.search_businesses('business', category='Category 3', limit=10)
+                business_id += 7919
+                reads[slot] += 2
+
+        def write():
+            business_id = 0
+            while not stop.is_set():
+                connect.update_business(business_id % 1000, business_id % options.businesses + 1,
+                                        name='Renamed %d' % business_id)
+                business_id += 1
+                writes[0] += 1
+
+        workers = [threading.Thread(target=read, args=(slot,)) for slot in range(threads)]
+        workers.append(threading.Thread(target=write))
+        for worker in workers:
+            worker.start()
+        time.sleep(options.seconds)
+        stop.set()
+        for worker in workers:
+            worker.join()
+        rows.append([threads, '%.0f' % (sum(reads) / options.seconds), '%.0f' % (writes[0] / options.seconds)])
+    connect.close()
+    print_table(['reader threads', 'reads/s', 'writes/s'], rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""Measures Connect.login_user latency as the number of
+registered users grows.
+
+Users are inserted straight into the user store with a cheap
+pre-computed hash so that seeding a million accounts does not take
+hours of bcrypt work. Every login still performs one bcrypt check.
+
+    python -m benchmarks.bench_users --sizes 1000 10000 100000 1000000"""
+import argparse
+import random
+
+import bcrypt
+
+from app.app_class import Connect
+from app.hashing import PasswordHasher
+from app.records import User
+from benchmarks.common import print_table, summarize, time_calls
+
+
+def seed(connect, size, hashed):
+    """Adds size users sharing the same password hash."""
+    for user_id in range(1, size + 1):
+        connect.storage.add_user(User(user_id, 'First%d' % user_id, 'Last%d' % user_id,
+                                      'user%d@example.com' % user_id, hashed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000, 1000000])
+    parser.add_argument('--logins', type=int, default=200)
+    parser.add_argument('--rounds', type=int, default=4, help='bcrypt cost of the seeded and new hashes')
+    options = parser.parse_args()
+
+    hashed = bcrypt.hashpw(b'secret', bcrypt.gensalt(options.rounds)).decode('utf8')
+    rows = []
+    for size in options.sizes:
+        # the seeded hashes already have the hasher's cost, so logins do not rehash them
+        connect = Connect(PasswordHasher(rounds=options.rounds, workers=0))
+        seed(connect, size, hashed)
+        emails = [('user%d@example.com' % random.randint(1, size), 'secret')
+                  for _ in range(options.logins)]
+        login = summarize(time_calls(connect.login_user, emails))
+        lookup = summarize(time_calls(connect.storage.get_user_by_email, [(email,) for email, _ in emails]))
+        rows.append([size, '%.0f' % login['p50'], '%.0f' % login['p99'],
+                     '%.2f' % lookup['p50'], '%.2f' % lookup['p99']])
+    print_table(['users', 'login p50 us', 'login p99 us', 'lookup p50 us', 'lookup p99 us'], rows)
+
+
+if __name__ == '__main__':
+    main()
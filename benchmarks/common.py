@@ -0,0 +1,40 @@
+"""Helpers shared by the benchmark scripts."""
+import time
+
+
+def percentile(samples, fraction):
+    """Returns the value below which the given fraction of samples fall.
+    - samples: sorted list of measurements
+    - fraction: number between 0 and 1"""
+    if not samples:
+        return 0.0
+    index = min(len(samples) - 1, int(round(fraction * (len(samples) - 1))))
+    return samples[index]
+
+
+def time_calls(func, args_list):
+    """Calls func once for every tuple in args_list and returns the
+    sorted latencies in microseconds."""
+    latencies = []
+    for args in args_list:
+        start = time.perf_counter()
+        func(*args)
+        latencies.append((time.perf_counter() - start) * 1e6)
+    latencies.sort()
+    return latencies
+
+
+def summarize(latencies):
+    """Returns p50/p95/p99 of sorted latencies as a dictionary."""
+    return {
+        'p50': percentile(latencies, 0.50),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99),
+    }
+
+
+def print_table(header, rows):
+    """Prints rows of values as aligned columns."""
+    widths = [max(len(str(value)) for value in column) for column in zip(header, *rows)]
+    for row in [header] + rows:
+        print('  '.join(str(value).rjust(width) for value, width in zip(row, widths)))
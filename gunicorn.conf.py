@@ -0,0 +1,20 @@
+"""gunicorn settings read from the working directory.
+
+    gunicorn --preload -w 4 app:app
+
+With --preload the master builds the application and loads the
+databases once, and the workers it forks share that memory until they
+change it. The hooks below ready the databases for the fork and restart
+in every worker what it cannot share with the master."""
+
+
+def pre_fork(server, worker):
+    if server.cfg.preload_app:
+        from app import views
+        views.before_fork()
+
+
+def post_fork(server, worker):
+    if server.cfg.preload_app:
+        from app import views
+        views.after_fork()
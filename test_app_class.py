@@ -0,0 +1,532 @@
+import os, queue, random, shutil, socket, tempfile, threading, time, unittest
+from multiprocessing import AuthenticationError
+
+from app.app_class import Connect
+from app.changes import ChangeFeed
+from app.denylist import TokenDenylist
+from app.geo import GridIndex, distance
+from app.hashing import PasswordHasher
+from app.ids import IdGenerator, MAX_WORKER, SEQUENCE_BITS, id_time, lease_worker
+from app.persistence import Persistence
+from app.records import Business
+from app.shared import StateClient, StateServer, shared_key
+from app.stats import TopCounts, TopReviewed
+from app.storage import SQLiteStorage
+from app.store import SortedIds
+
+class ConnectPersistence(unittest.TestCase):
+    """Tests that Connect recovers its databases from the log and snapshots"""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.hasher = PasswordHasher(rounds=4, workers=0)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def reopen(self, connect):
+        connect.close()
+        return Connect(self.hasher, Persistence(self.directory))
+
+    def test_recover_from_log_and_snapshot(self):
+        connect = Connect(self.hasher, Persistence(self.directory))
+        connect.register_user(1, 'Harry', 'Potter', 'harry@aol.com', 'dumbledore')
+        connect.create_business(1, 10, 'Mortal Kombat', 'Earth', 'something', 'something')
+        connect.create_business(1, 11, 'Leaky Cauldron', 'London', 'pub', 'butterbeer')
+        connect.add_review(10, 100, 'Flawless victory')
+        connect = self.reopen(connect)
+        self.assertEqual(connect.login_user('harry@aol.com', 'dumbledore'), 1)
+        self.assertEqual(connect.review_count(10), 1)
+
+        connect.snapshot()
+        connect.update_business(1, 10, name='Mortal Kombat1')
+        connect.delete_business(11)
+        connect.reset_password('harry@aol.com', 'dumbledore', 'severus snape')
+        connect.add_review(10, 101, 'Finish him')
+        connect.revoke_token('logged-out', time.time() + 3600)
+        connect = self.reopen(connect)
+        self.assertTrue(connect.is_revoked('logged-out'))
+        self.assertEqual(connect.login_user('harry@aol.com', 'severus snape'), 1)
+        self.assertEqual(connect.get_business(10)['name'], 'Mortal Kombat1')
+        self.assertIsNone(connect.get_business(11))
+        self.assertEqual([review['review'] for review in connect.get_reviews(10)],
+                         ['Flawless victory', 'Finish him'])
+        self.assertEqual(connect.search_businesses('kombat1')[1], 1)
+        connect.close()
+
+    def test_background_snapshot(self):
+        connect = Connect(self.hasher, Persistence(self.directory, snapshot_every=5))
+        for business_id in range(10, 22):
+            connect.create_business(1, business_id, 'Business', 'Earth', 'game', 'fight')
+        # the snapshots are written by forked processes, waited for by a thread
+        path = os.path.join(self.directory, 'snapshot.bin')
+        deadline = time.monotonic() + 5
+        while (connect.persistence.snapshotting.locked() or not os.path.exists(path)) \
+                and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(os.path.exists(path))
+        connect = self.reopen(connect)
+        self.assertEqual(len(connect.get_businesses()), 12)
+        connect.close()
+
+    def test_recover_batch(self):
+        connect = Connect(self.hasher, Persistence(self.directory))
+        results = connect.create_businesses(1, [
+            dict(business_id=10, name='Mortal Kombat', location='Earth', category='game', description='fight'),
+            dict(business_id=10, name='Street Fighter', location='Earth', category='game', description='fight'),
+            dict(business_id=11, name='Leaky Cauldron', location='London', category='pub')])
+        self.assertEqual(results[0]['name'], 'Mortal Kombat')
+        self.assertIs(results[1], False)
+        self.assertIsInstance(results[2], str)
+        results = connect.update_businesses(1, [dict(business_id=10, name='Mortal Kombat1'),
+                                                dict(business_id=11, name='Leaky Cauldron')])
+        self.assertEqual(results[0]['name'], 'Mortal Kombat1')
+        self.assertIs(results[1], False)
+        connect = self.reopen(connect)
+        self.assertEqual(connect.get_business(10)['name'], 'Mortal Kombat1')
+        self.assertEqual(len(connect.get_businesses()), 1)
+        connect.close()
+
+    def test_single_writer(self):
+        connect = Connect(self.hasher, Persistence(self.directory))
+        # a second writer would overwrite the first one's log segment
+        self.assertRaises(IOError, Persistence, self.directory)
+        connect.close()
+        Persistence(self.directory).close()
+
+    def test_refuses_to_fork_the_log(self):
+        connect = Connect(self.hasher, Persistence(self.directory))
+        # forked workers would each write the same log segment
+        self.assertRaises(ValueError, connect.detach)
+        self.assertRaises(ValueError, connect.after_fork)
+        connect.close()
+
+class SQLiteStorageTest(unittest.TestCase):
+    """Tests that the SQLite backend lends pooled connections to threads, serves one process and keeps revoked tokens"""
+    def test_short_lived_threads_reuse_connections(self):
+        directory = tempfile.mkdtemp()
+        try:
+            storage = SQLiteStorage(os.path.join(directory, 'weconnect.db'), pool_size=4)
+            connect = Connect(PasswordHasher(rounds=4, workers=0), storage=storage)
+            connect.create_business(1, 10, 'Mortal Kombat', 'Earth', 'game', 'fight')
+            names = []
+            for _ in range(50):
+                threads = [threading.Thread(target=lambda: names.append(connect.get_business(10)['name']))
+                           for _ in range(4)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            self.assertEqual(names, ['Mortal Kombat'] * 200)
+            self.assertLessEqual(len(storage.connections), 4)
+            connect.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_single_process(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'weconnect.db')
+            connect = Connect(PasswordHasher(rounds=4, workers=0), storage=SQLiteStorage(path))
+            # another process would not see the indexes and caches of this one change
+            self.assertRaises(IOError, SQLiteStorage, path)
+            self.assertRaises(ValueError, connect.detach)
+            self.assertRaises(ValueError, connect.after_fork)
+            connect.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_revoked_tokens_survive_restarts(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'weconnect.db')
+            connect = Connect(PasswordHasher(rounds=4, workers=0), storage=SQLiteStorage(path))
+            connect.revoke_token('logged-out', time.time() + 3600)
+            connect.revoke_token('expired', time.time() - 1)
+            connect.close()
+            connect = Connect(PasswordHasher(rounds=4, workers=0), storage=SQLiteStorage(path))
+            self.assertTrue(connect.is_revoked('logged-out'))
+            self.assertFalse(connect.is_revoked('expired'))
+            connect.close()
+        finally:
+            shutil.rmtree(directory)
+
+class ConnectThreads(unittest.TestCase):
+    """Tests that Connect can be shared by many threads"""
+    def test_mixed_reads_and_writes(self):
+        connect = Connect(PasswordHasher(rounds=4, workers=0))
+        errors = []
+
+        def work(worker):
+            rng = random.Random(worker)
+            try:
+                for step in range(300):
+                    business_id = rng.randint(1, 200)
+                    action = rng.random()
+                    if action < 0.2:
+                        connect.create_business(worker, business_id, 'Shop %d' % step, 'Town %d' % (step % 5),
+                                                'cat %d' % (step % 3), 'sells things')
+                    elif action < 0.3:
+                        connect.update_business(worker, business_id, name='Renamed %d' % step, category='cat 9')
+                    elif action < 0.35:
+                        business = connect.get_business(business_id)
+                        if business is not None and business['user_id'] == worker:
+                            connect.delete_business(business_id)
+                    elif action < 0.45:
+                        connect.add_review(business_id, step, 'review %d' % step)
+                    elif action < 0.6:
+                        connect.search_businesses('shop', category='cat 1', limit=5)
+                    elif action < 0.75:
+                        list(connect.iter_businesses(chunk_size=7))
+                    elif action < 0.9:
+                        connect.page_businesses(10, business_id)
+                    else:
+                        connect.get_reviews(business_id, 5)
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=work, args=(worker,)) for worker in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+        # the indexes agree with the stored businesses
+        businesses = connect.get_businesses()
+        ids = [business['business_id'] for business in businesses]
+        self.assertEqual([business['business_id'] for business in connect.iter_businesses()], sorted(ids))
+        self.assertEqual(set(connect.search_index.entries), set(ids))
+        renamed = [business_id for business_id in ids if connect.get_business(business_id)['category'] == 'cat 9']
+        self.assertEqual(connect.search_businesses(category='cat 9', limit=1000)[1], len(renamed))
+        for business_id in range(1, 201):
+            if business_id not in ids:
+                self.assertIsNone(connect.get_reviews(business_id))
+        connect.close()
+
+class ConnectShared(unittest.TestCase):
+    """Tests that replicas share the databases of a state server"""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.address = os.path.join(self.directory, 'state.sock')
+        self.hasher = PasswordHasher(rounds=4, workers=0)
+        self.primary = Connect(self.hasher)
+        self.server = StateServer(self.primary, self.address)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.directory)
+
+    def replica(self):
+        return Connect(self.hasher, primary=StateClient(self.address))
+
+    def wait_for(self, replica, lsn):
+        deadline = time.monotonic() + 5
+        while replica.lsn < lsn and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def test_replicas_share_changes(self):
+        first = self.replica()
+        first.register_user(1, 'Harry', 'Potter', 'harry@aol.com', 'dumbledore')
+        first.create_business(1, 10, 'Mortal Kombat', 'Earth', 'game', 'fight')
+        # a replica started later gets the changes made so far
+        second = self.replica()
+        self.assertEqual(second.login_user('harry@aol.com', 'dumbledore'), 1)
+        self.assertEqual(second.get_business(10)['name'], 'Mortal Kombat')
+        # and the changes made afterwards, in either direction
+        second.update_business(1, 10, name='Mortal Kombat1')
+        self.assertEqual(second.get_business(10)['name'], 'Mortal Kombat1')
+        first.add_review(10, 100, 'Flawless victory')
+        first.revoke_token('logged-out', time.time() + 3600)
+        self.assertFalse(second.create_business(1, 10, 'Street Fighter', 'Earth', 'game', 'fight'))
+        self.wait_for(first, self.primary.lsn)
+        self.wait_for(second, self.primary.lsn)
+        for connect in (first, second, self.primary):
+            self.assertEqual(connect.get_business(10)['name'], 'Mortal Kombat1')
+            self.assertEqual(connect.review_count(10), 1)
+            self.assertEqual(connect.search_businesses('kombat1')[1], 1)
+            self.assertTrue(connect.is_revoked('logged-out'))
+            # the second replica's feed starts where its copy of the databases was taken
+            self.assertEqual(connect.get_changes(2), self.primary.get_changes(2))
+        self.assertIsNone(second.get_changes(1)[0])
+        first.close()
+        second.close()
+
+    def test_shared_key(self):
+        address = os.path.join(self.directory, 'keyed.sock')
+        key = shared_key(address)
+        # every process asking gets the key made by the first
+        self.assertEqual(shared_key(address), key)
+        self.assertEqual(os.stat(address + '.key').st_mode & 0o777, 0o600)
+        server = StateServer(Connect(self.hasher), address, key)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            self.assertRaises(AuthenticationError, StateClient, address, b'guessed')
+            # the server is still serving the processes holding the key
+            replica = Connect(self.hasher, primary=StateClient(address, key))
+            replica.register_user(1, 'Harry', 'Potter', 'harry@aol.com', 'dumbledore')
+            replica.close()
+        finally:
+            server.close()
+
+    def test_replica_gone(self):
+        replica = self.replica()
+        replica.replica_timeout = 0.2
+        # the replica cannot apply changes while its databases are read
+        with replica.lock.read():
+            self.assertRaises(IOError, replica.create_business, 1, 10, 'Mortal Kombat', 'Earth', 'game', 'fight')
+        # nor once its stream has ended
+        with socket.fromfd(replica.primary.stream.fileno(), socket.AF_UNIX, socket.SOCK_STREAM) as stream:
+            stream.shutdown(socket.SHUT_RDWR)
+        replica.replica.join()
+        replica.replica_timeout = 30
+        start = time.monotonic()
+        self.assertRaises(IOError, replica.create_business, 1, 11, 'Leaky Cauldron', 'London', 'pub', 'butterbeer')
+        self.assertLess(time.monotonic() - start, 5)
+        replica.close()
+
+    def test_forked_replica_catches_up(self):
+        replica = self.replica()
+        replica.create_business(1, 10, 'Mortal Kombat', 'Earth', 'game', 'fight')
+        # as a preloading server does before forking its workers
+        replica.detach()
+        storage = replica.storage
+        self.primary.update_business(1, 10, name='Mortal Kombat1')
+
+        def fork(check):
+            pid = os.fork()
+            if pid == 0:
+                ok = False
+                try:
+                    replica.after_fork()
+                    self.wait_for(replica, self.primary.lsn)
+                    ok = check() and replica.get_business(10)['name'] == 'Mortal Kombat1'
+                finally:
+                    os._exit(0 if ok else 1)
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        # the changes made since the detach are streamed to the loaded databases
+        fork(lambda: replica.storage is storage)
+        # or, once the state process no longer has them, a new copy is sent
+        self.server.history.clear()
+        fork(lambda: replica.storage is not storage)
+        replica.close()
+
+class PasswordHasherTest(unittest.TestCase):
+    """Tests that rehash callbacks run in the rehash thread"""
+    def test_rehash_callbacks(self):
+        hasher = PasswordHasher(rounds=4, workers=1)
+        results = queue.Queue()
+
+        def failing(new_hash):
+            raise IOError('State process went away')
+        hasher.rehash('dumbledore', failing)
+        hasher.rehash('dumbledore', lambda new_hash: results.put((threading.current_thread().name, new_hash)))
+        name, new_hash = results.get(timeout=30)
+        # the failing callback did not stop the one after it
+        self.assertEqual(name, 'rehash')
+        self.assertTrue(hasher.check('dumbledore', new_hash))
+        hasher.pool.shutdown()
+
+class IdGeneratorTest(unittest.TestCase):
+    """Tests that generated ids are unique and increasing"""
+    def test_ids_increase(self):
+        now = [1600000000.0]
+        ids = IdGenerator(worker=3, clock=lambda: now[0])
+        made = [ids.next_id() for _ in range(5000)]
+        # the clock steps back
+        now[0] -= 10
+        made.extend(ids.next_id() for _ in range(10))
+        now[0] += 20
+        made.append(ids.next_id())
+        self.assertEqual(made, sorted(set(made)))
+        self.assertEqual(id_time(made[-1]), 1600000010.0)
+        other = IdGenerator(worker=4, clock=lambda: now[0])
+        self.assertNotEqual(other.next_id(), IdGenerator(worker=3, clock=lambda: now[0]).next_id())
+        self.assertRaises(ValueError, IdGenerator, 1024)
+
+    def test_leased_workers(self):
+        directory = tempfile.mkdtemp()
+        try:
+            lease = os.path.join(directory, 'state.sock.ids')
+            first, second = IdGenerator(lease=lease), IdGenerator(lease=lease)
+            self.assertNotEqual(first.worker, second.worker)
+            read, write = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                # a forked process leases a number of its own when it makes an id,
+                # and none for the generators it does not use
+                try:
+                    worker = first.next_id() >> SEQUENCE_BITS & MAX_WORKER
+                    os.write(write, b'%d %d %d' % (worker, lease_worker(lease), second.worker is None))
+                finally:
+                    os._exit(0)
+            os.close(write)
+            worker, spare, unused = map(int, os.read(read, 100).split())
+            os.close(read)
+            os.waitpid(pid, 0)
+            self.assertNotIn(worker << SEQUENCE_BITS, (first.worker, second.worker))
+            self.assertEqual(spare, worker + 1)
+            self.assertTrue(unused)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_ids_unique_across_threads(self):
+        ids = IdGenerator(worker=1)
+        made = []
+
+        def work():
+            made.extend([ids.next_id() for _ in range(10000)])
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(made)), 80000)
+
+class TokenDenylistTest(unittest.TestCase):
+    """Tests that revoked tokens are kept until they expire"""
+    def test_tokens_expire(self):
+        now = [1600000000.0]
+        denylist = TokenDenylist(resolution=10, slots=4, clock=lambda: now[0])
+        denylist.revoke('short', now[0] + 15)
+        # expires more than a full turn of the wheel ahead
+        denylist.revoke('long', now[0] + 100)
+        denylist.revoke('forever')
+        denylist.revoke('expired', now[0] - 1)
+        self.assertIn('short', denylist)
+        self.assertNotIn('expired', denylist)
+        self.assertEqual(len(denylist), 3)
+        now[0] += 30
+        self.assertEqual(denylist.sweep(), 1)
+        self.assertNotIn('short', denylist)
+        self.assertIn('long', denylist)
+        now[0] += 100
+        self.assertEqual(denylist.sweep(), 1)
+        self.assertEqual(list(denylist.expiries), ['forever'])
+
+class SortedIdsTest(unittest.TestCase):
+    """Tests the blocked list of business ids against a sorted list"""
+    def test_matches_sorted_list(self):
+        rng = random.Random(5)
+        ids = SortedIds()
+        expected = []
+        for step in range(10000):
+            item = rng.randrange(5000)
+            if item in expected and step % 3:
+                ids.remove(item)
+                expected.remove(item)
+            elif item not in expected:
+                ids.add(item)
+                expected.append(item)
+                expected.sort()
+            if step % 500 == 0:
+                self.assertEqual(list(ids), expected)
+                after = rng.randrange(5000)
+                self.assertEqual(ids.slice_after(after, 50), [i for i in expected if i > after][:50])
+        self.assertEqual(len(ids), len(expected))
+        self.assertEqual(ids.slice_after(None, 10), expected[:10])
+        self.assertEqual(ids.slice_after(5000), [])
+        self.assertTrue(all(len(block) <= 1000 for block in ids.blocks))
+
+class TopReviewedTest(unittest.TestCase):
+    """Tests the ranking of the most reviewed businesses against counting them"""
+    def test_matches_counting(self):
+        rng = random.Random(7)
+        top = TopReviewed(k=5)
+        counts = {}
+        for step in range(3000):
+            business_id = rng.randrange(40)
+            if step % 50 == 49 and counts:
+                counts.pop(business_id, None)
+                if top.remove(business_id):
+                    top.rebuild(counts.items())
+            else:
+                counts[business_id] = counts.get(business_id, 0) + 1
+                top.reviewed(business_id, counts[business_id])
+            expected = sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:5]
+            self.assertEqual(sorted(count for _, count in top.top()), sorted(count for _, count in expected))
+            for business_id, count in top.top():
+                self.assertEqual(counts[business_id], count)
+        self.assertLessEqual(len(top.heap), 2 * top.pool)
+        # deleting ranked businesses only rebuilds once the candidates run out
+        top = TopReviewed(k=2, pool=4)
+        top.rebuild([(business_id, business_id) for business_id in range(1, 11)])
+        self.assertEqual([top.remove(business_id) for business_id in (10, 9, 8)], [False, False, True])
+        top.rebuild([(business_id, business_id) for business_id in range(1, 8)])
+        self.assertEqual(top.top(), [(7, 7), (6, 6)])
+
+class TopCountsTest(unittest.TestCase):
+    """Tests the businesses counted per key against counting them"""
+    def test_matches_counting(self):
+        rng = random.Random(3)
+        top = TopCounts()
+        counts = {}
+        for step in range(5000):
+            key = 'key %d' % rng.randrange(30)
+            if rng.random() < 0.4 and counts.get(key):
+                top.remove(key)
+                counts[key] -= 1
+                if not counts[key]:
+                    del counts[key]
+            else:
+                top.add(key)
+                counts[key] = counts.get(key, 0) + 1
+            self.assertEqual(top.counts, counts)
+            found = top.top(5)
+            expected = sorted(counts.values(), reverse=True)[:5]
+            self.assertEqual([count for _, count in found], expected)
+            for key, count in found:
+                self.assertEqual(counts[key], count)
+
+class ChangeFeedTest(unittest.TestCase):
+    """Tests that the feed keeps the latest events and waking subscribers"""
+    def test_ring(self):
+        connect = Connect(PasswordHasher(rounds=4, workers=0), change_feed=ChangeFeed(size=3))
+        connect.create_businesses(1, [{'business_id': business_id, 'name': 'Business', 'location': 'Place',
+                                       'category': 'Category', 'description': 'Description'}
+                                      for business_id in (1, 2)])
+        events, seq = connect.get_changes(0)
+        # the events of a batch share its lsn
+        self.assertEqual([event[0] for event in events], [seq, seq])
+        woken = []
+        waiter = threading.Thread(target=lambda: woken.append(connect.wait_changes(seq, 5)))
+        waiter.start()
+        connect.add_review(1, 1, 'Review')
+        waiter.join()
+        self.assertIn(b'"type":"reviewed"', woken[0][0][0][1])
+        connect.delete_business(2)
+        # the batch's first event was dropped, so its lsn cannot be read from anymore
+        self.assertIsNone(connect.get_changes(0)[0])
+        self.assertIsNone(connect.get_changes(seq - 1)[0])
+        self.assertEqual(len(connect.get_changes(seq)[0]), 2)
+        self.assertEqual(connect.wait_changes(connect.lsn, 0.01), ([], connect.lsn))
+
+class GridIndexTest(unittest.TestCase):
+    """Tests nearby searches against measuring the distance to every business"""
+    def test_matches_scan(self):
+        rng = random.Random(3)
+        index = GridIndex(cell_size=0.5)
+        points = {}
+        # clusters around the antimeridian and a pole as well as a city
+        for business_id in range(3000):
+            latitude, longitude = rng.choice([(51.5, -0.1), (0.0, 179.9), (89.5, 30.0)])
+            latitude = max(-90.0, min(90.0, latitude + rng.uniform(-1, 1)))
+            longitude = (longitude + rng.uniform(-1, 1) + 180) % 360 - 180
+            points[business_id] = (latitude, longitude)
+            index.add(Business(business_id, 'Business', 'Place', 'Description', 'Category', 1, latitude, longitude))
+        for business_id in range(0, 3000, 7):
+            del points[business_id]
+            index.remove(business_id)
+        odd = set(business_id for business_id in points if business_id % 2)
+        for latitude, longitude, radius in [(51.5, -0.1, 20000), (0.0, -179.95, 50000), (89.9, -150.0, 100000),
+                                            (51.0, 0.5, 300000), (10.0, 10.0, 1000)]:
+            for include in (None, odd, set(list(odd)[:5])):
+                expected = sorted((distance(latitude, longitude, *point), business_id)
+                                  for business_id, point in points.items()
+                                  if include is None or business_id in include)
+                expected = [item for item in expected if item[0] <= radius][:10]
+                self.assertEqual(index.nearby(latitude, longitude, radius, 10, include), expected)
+        self.assertEqual(len(index), len(points))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,14 +1,28 @@
-import bcrypt, flask, json, flask_jwt_extended, unittest
+import bcrypt, flask, json, flask_jwt_extended, os, shutil, tempfile, time, unittest
 
-from app import app, views
+from app import app, create_app, views
+from app.hashing import PasswordHasher
+from app.storage import SQLiteStorage
+
+# cheap password hashing, shared by every test
+hasher = PasswordHasher(rounds=4)
 
 class ConnectViews(unittest.TestCase):
     """Tests the enpoints contains in views.py"""
+    def make_storage(self):
+        """Returns the storage backend under test, None for the default"""
+        return None
+
     def setUp(self):
+        # start every test with empty user and business databases, cheap
+        # password hashing and full rate limiting buckets
+        views.weconnect = views.Connect(hasher, storage=self.make_storage())
+        views.response_cache.attach(views.weconnect)
+        views.admission.clients.buckets.clear()
         self.weconnect_test = app.test_client(self)
 
     def tearDown(self):
-        self.weconnect_test
+        views.weconnect.close()
 
     def test_register_user(self):
         response = self.weconnect_test.post('/api/v1/auth/register', content_type='application/json',
@@ -16,6 +30,24 @@ class ConnectViews(unittest.TestCase):
                                                                email='harry@aol.com', password='dumbledore')))
         self.assertEqual(response.status_code, 200)
 
+    def test_register_conflicts(self):
+        user = dict(first_name='Harry', last_name='Potter', email='harry@aol.com', password='dumbledore')
+        self.weconnect_test.post('/api/v1/auth/register', content_type='application/json', data=json.dumps(user))
+        response = self.weconnect_test.post('/api/v1/auth/register', content_type='application/json',
+                                            data=json.dumps(user))
+        self.assertEqual(response.status_code, 409)
+        # an id taken by another user, as two workers sharing a worker number would make
+        taken = views.weconnect.register_user(7, 'Ron', 'Weasley', 'ron@aol.com', 'scabbers')['user_id']
+        next_id = views.ids.next_id
+        views.ids.next_id = lambda: taken
+        try:
+            response = self.weconnect_test.post('/api/v1/auth/register', content_type='application/json',
+                                                data=json.dumps(dict(user, email='hermione@aol.com')))
+        finally:
+            views.ids.next_id = next_id
+        self.assertEqual(response.status_code, 409)
+        self.assertIn('message', json.loads(response.data.decode()))
+
     def test_login_user(self):
         self.weconnect_test.post('/api/v1/auth/register', content_type='application/json',
                                  data=json.dumps(dict(first_name='Harry', last_name='Potter',
@@ -38,6 +70,20 @@ class ConnectViews(unittest.TestCase):
                                            headers={'Authorization': 'Bearer %s' % access_token})
         self.assertEqual(response.status_code, 200)
 
+    def test_logout(self):
+        self.weconnect_test.post('/api/v1/auth/register', content_type='application/json',
+                                 data=json.dumps(dict(first_name='Harry', last_name='Potter',
+                                                      email='harry@aol.com', password='dumbledore')))
+        login = self.weconnect_test.post('/api/v1/auth/login', content_type='application/json',
+                                         data=json.dumps(dict(email='harry@aol.com', password='dumbledore')))
+        headers = {'Authorization': 'Bearer %s' % json.loads(login.data.decode())['access_token']}
+        self.assertEqual(self.weconnect_test.get('/api/v1/businesses', headers=headers).status_code, 200)
+        response = self.weconnect_test.post('/api/auth/logout', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        # the token is refused once revoked
+        self.assertEqual(self.weconnect_test.get('/api/v1/businesses', headers=headers).status_code, 401)
+        self.assertEqual(self.weconnect_test.post('/api/v1/auth/logout', headers=headers).status_code, 401)
+
     def test_register_business(self):
         self.weconnect_test.post('/api/v1/auth/register', content_type='application/json',
                                  data=json.dumps(dict(first_name='Harry', last_name='Potter',
@@ -69,6 +115,7 @@ class ConnectViews(unittest.TestCase):
                                                         description='something', review=[])),
                                                         headers={'Authorization': 'Bearer %s' % access_token})
         biz_id = json.loads(business.get_data())['business']['business_id']
+        self.weconnect_test.get('/api/v1/businesses?limit=5', headers={'Authorization': 'Bearer %s' % access_token})
         response = self.weconnect_test.put('/api/v1/businesses/'+str(biz_id), content_type='application/json',
                                            data=json.dumps(dict(name='Mortal Kombat1', location='something_new',
                                                                 category='something_new', description='something_new')),
@@ -78,6 +125,468 @@ class ConnectViews(unittest.TestCase):
         self.assertIn(b'something_new', response.data)
         self.assertIn(b'user_id', response.data)
         self.assertTrue(response.status_code, 201)
+        # check that lists are not built from the encoding made before the update
+        response = self.weconnect_test.get('/api/v1/businesses?limit=5',
+                                           headers={'Authorization': 'Bearer %s' % access_token})
+        self.assertEqual(json.loads(response.data.decode())['businesses'][0]['name'], 'Mortal Kombat1')
+
+    def test_conditional_get(self):
+        self.weconnect_test.post('/api/v1/auth/register', content_type='application/json',
+                                 data=json.dumps(dict(first_name='Harry', last_name='Potter',
+                                                      email='harry@aol.com', password='dumbledore')))
+        login = self.weconnect_test.post('/api/v1/auth/login', content_type='application/json',
+                                         data=json.dumps(dict(email='harry@aol.com', password='dumbledore')))
+        resp = json.loads(login.data.decode())
+        headers = {'Authorization': 'Bearer %s' % resp['access_token']}
+        business = self.weconnect_test.post('/api/v1/businesses', content_type='application/json',
+                                            data=json.dumps(dict(name='Mortal Kombat', location='Earth',
+                                                                 category='something', description='something')),
+                                            headers=headers)
+        biz_id = json.loads(business.get_data())['business']['business_id']
+        for url in ['/api/v1/businesses', '/api/v1/businesses/%s' % biz_id]:
+            response = self.weconnect_test.get(url, headers=headers)
+            etag = response.headers['ETag']
+            response = self.weconnect_test.get(url, headers=dict(headers, **{'If-None-Match': etag}))
+            self.assertEqual(response.status_code, 304)
+        self.weconnect_test.put('/api/v1/businesses/%s' % biz_id, content_type='application/json',
+                                data=json.dumps(dict(name='Mortal Kombat1', location=None,
+                                                     category=None, description=None)),
+                                headers=headers)
+        for url in ['/api/v1/businesses', '/api/v1/businesses/%s' % biz_id]:
+            response = self.weconnect_test.get(url, headers=dict(headers, **{'If-None-Match': etag}))
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(b'Mortal Kombat1', response.data)
+
+    def test_cache_key_ignores_unknown_parameters(self):
+        self.weconnect_test.post('/api/v1/auth/register', content_type='application/json',
+                                 data=json.dumps(dict(first_name='Harry', last_name='Potter',
+                                                      email='harry@aol.com', password='dumbledore')))
+        login = self.weconnect_test.post('/api/v1/auth/login', content_type='application/json',
+                                         data=json.dumps(dict(email='harry@aol.com', password='dumbledore')))
+        resp = json.loads(login.data.decode())
+        headers = {'Authorization': 'Bearer %s' % resp['access_token']}
+        self.weconnect_test.post('/api/v1/businesses', content_type='application/json',
+                                 data=json.dumps(dict(name='Mortal Kombat', location='Earth',
+                                                      category='something', description='something')),
+                                 headers=headers)
+        for junk in range(5):
+            self.weconnect_test.get('/api/v1/businesses?junk=%d' % junk, headers=headers)
+            self.weconnect_test.get('/api/v1/businesses?limit=10&junk=%d' % junk, headers=headers)
+        self.assertEqual(views.response_cache.stats()['entries'], 1)
+
+    def test_delete_business(self):
+        self.weconnect_test.post('/api/v1/auth/register', content_type='application/json',
+                                 data=json.dumps(dict(first_name='Harry', last_name='Potter',
+                                                      email='harry@aol.com', password='dumbledore')))
+        login = self.weconnect_test.post('/api/v1/auth/login', content_type='application/json',
+                                         data=json.dumps(dict(email='harry@aol.com', password='dumbledore')))
+        resp = json.loads(login.data.decode())
+        access_token = resp['access_token']
+        headers = {'Authorization': 'Bearer %s' % access_token}
+        business = self.weconnect_test.post('/api/v1/businesses', content_type='application/json',
+                                            data=json.dumps(dict(name='Mortal Kombat', location='Earth',
+                                                                 category='something', description='something')),
+                                            headers=headers)
+        biz_id = json.loads(business.get_data())['business']['business_id']
+        response = self.weconnect_test.get('/api/v1/businesses/'+str(biz_id), headers=headers)
+        self.assertIn(b'Mortal Kombat', response.data)
+        response = self.weconnect_test.delete('/api/v1/businesses/'+str(biz_id), headers=headers)
+        self.assertEqual(response.status_code, 200)
+        response = self.weconnect_test.get('/api/v1/businesses/'+str(biz_id), headers=headers)
+        self.assertEqual(response.status_code, 404)
+
+    def test_get_businesses_paginated(self):
+        self.weconnect_test.post('/api/v1/auth/register', content_type='application/json',
+                                 data=json.dumps(dict(first_name='Harry', last_name='Potter',
+                                                      email='harry@aol.com', password='dumbledore')))
+        login = self.weconnect_test.post('/api/v1/auth/login', content_type='application/json',
+                                         data=json.dumps(dict(email='harry@aol.com', password='dumbledore')))
+        resp = json.loads(login.data.decode())
+        headers = {'Authorization': 'Bearer %s' % resp['access_token']}
+        for name in ['Gringotts', 'Ollivanders', 'Honeydukes']:
+            self.weconnect_test.post('/api/v1/businesses', content_type='application/json',
+                                     data=json.dumps(dict(name=name, location='Diagon Alley',
+                                                          category='shop', description='something')),
+                                     headers=headers)
+        seen = []
+        after = ''
+        while after is not None:
+            response = self.weconnect_test.get('/api/v1/businesses?limit=2&after=%s' % after, headers=headers)
+            page = json.loads(response.data.decode())
+            self.assertLessEqual(len(page['businesses']), 2)
+            seen.extend(business['business_id'] for business in page['businesses'])
+            after = page['next']
+        self.assertEqual(seen, sorted(seen))
+        response = self.weconnect_test.get('/api/v1/businesses?stream=1', headers=headers)
+        streamed = json.loads(response.data.decode())['businesses']
+        self.assertEqual([business['business_id'] for business in streamed], seen)
+
+    def test_batch_businesses(self):
+        self.weconnect_test.post('/api/v1/auth/register', content_type='application/json',
+                                 data=json.dumps(dict(first_name='Harry', last_name='Potter',
+                                                      email='harry@aol.com', password='dumbledore')))
+        login = self.weconnect_test.post('/api/v1/auth/login', content_type='application/json',
+                                         data=json.dumps(dict(email='harry@aol.com', password='dumbledore')))
+        resp = json.loads(login.data.decode())
+        headers = {'Authorization': 'Bearer %s' % resp['access_token']}
+        businesses = [dict(name='Gringotts', location='Diagon Alley', category='bank', description='something'),
+                      dict(name='Honeydukes', location='Hogsmeade', category='shop', description='something'),
+                      dict(name='Ollivanders', location='Diagon Alley')]
+        response = self.weconnect_test.post('/api/v1/businesses:batch', content_type='application/json',
+                                            data=json.dumps(dict(businesses=businesses)), headers=headers)
+        self.assertEqual(response.status_code, 200)
+        results = json.loads(response.data.decode())['results']
+        self.assertEqual([result['status'] for result in results], [201, 201, 400])
+        ids = [result['business']['business_id'] for result in results[:2]]
+        updates = [dict(business_id=ids[0], name='Gringotts Bank'),
+                   dict(business_id=ids[1], category=5),
+                   dict(business_id=0, name='Nowhere')]
+        response = self.weconnect_test.put('/api/v1/businesses:batch', content_type='application/json',
+                                           data=json.dumps(dict(businesses=updates)), headers=headers)
+        results = json.loads(response.data.decode())['results']
+        self.assertEqual([result['status'] for result in results], [200, 400, 404])
+        self.assertEqual(results[0]['business']['name'], 'Gringotts Bank')
+        response = self.weconnect_test.post('/api/v1/businesses:batch', content_type='application/json',
+                                            data=json.dumps(dict(businesses=[])), headers=headers)
+        self.assertEqual(response.status_code, 400)
+
+    def test_reviews(self):
+        self.weconnect_test.post('/api/v1/auth/register', content_type='application/json',
+                                 data=json.dumps(dict(first_name='Harry', last_name='Potter',
+                                                      email='harry@aol.com', password='dumbledore')))
+        login = self.weconnect_test.post('/api/v1/auth/login', content_type='application/json',
+                                         data=json.dumps(dict(email='harry@aol.com', password='dumbledore')))
+        resp = json.loads(login.data.decode())
+        headers = {'Authorization': 'Bearer %s' % resp['access_token']}
+        business = self.weconnect_test.post('/api/v1/businesses', content_type='application/json',
+                                            data=json.dumps(dict(name='Mortal Kombat', location='Earth',
+                                                                 category='something', description='something')),
+                                            headers=headers)
+        biz_id = json.loads(business.get_data())['business']['business_id']
+        self.weconnect_test.get('/api/v1/businesses/%s' % biz_id, headers=headers)
+        for text in ['Flawless victory', 'Finish him', 'Get over here']:
+            response = self.weconnect_test.post('/api/v1/businesses/%s/reviews' % biz_id,
+                                                content_type='application/json',
+                                                data=json.dumps(dict(review=text)), headers=headers)
+            self.assertEqual(response.status_code, 201)
+        response = self.weconnect_test.get('/api/v1/businesses/%s/reviews?limit=2' % biz_id, headers=headers)
+        page = json.loads(response.data.decode())
+        self.assertEqual([review['review'] for review in page['reviews']], ['Flawless victory', 'Finish him'])
+        self.assertEqual(page['count'], 3)
+        response = self.weconnect_test.get('/api/v1/businesses/%s' % biz_id, headers=headers)
+        self.assertEqual(json.loads(response.data.decode())['business']['review_count'], 3)
+        response = self.weconnect_test.get('/api/v1/businesses/%s/reviews?after=%s' % (biz_id, page['next']),
+                                           headers=headers)
+        page = json.loads(response.data.decode())
+        self.assertEqual([review['review'] for review in page['reviews']], ['Get over here'])
+        self.assertIsNone(page['next'])
+
+    def test_search_businesses(self):
+        self.weconnect_test.post('/api/v1/auth/register', content_type='application/json',
+                                 data=json.dumps(dict(first_name='Harry', last_name='Potter',
+                                                      email='harry@aol.com', password='dumbledore')))
+        login = self.weconnect_test.post('/api/v1/auth/login', content_type='application/json',
+                                         data=json.dumps(dict(email='harry@aol.com', password='dumbledore')))
+        resp = json.loads(login.data.decode())
+        headers = {'Authorization': 'Bearer %s' % resp['access_token']}
+        self.weconnect_test.post('/api/v1/businesses', content_type='application/json',
+                                 data=json.dumps(dict(name='Leaky Cauldron', location='London',
+                                                      category='pub', description='Butterbeer served here')),
+                                 headers=headers)
+        self.weconnect_test.post('/api/v1/businesses', content_type='application/json',
+                                 data=json.dumps(dict(name='Three Broomsticks', location='Hogsmeade',
+                                                      category='pub', description='Famous butterbeer')),
+                                 headers=headers)
+        response = self.weconnect_test.get('/api/v1/businesses?q=butterbeer&category=Pub', headers=headers)
+        results = json.loads(response.data.decode())
+        self.assertEqual(results['total'], 2)
+        response = self.weconnect_test.get('/api/v1/businesses?q=butterbeer&location=hogsmeade', headers=headers)
+        results = json.loads(response.data.decode())
+        self.assertEqual([business['name'] for business in results['businesses']], ['Three Broomsticks'])
+
+    def test_stats(self):
+        self.weconnect_test.post('/api/v1/auth/register', content_type='application/json',
+                                 data=json.dumps(dict(first_name='Harry', last_name='Potter',
+                                                      email='harry@aol.com', password='dumbledore')))
+        login = self.weconnect_test.post('/api/v1/auth/login', content_type='application/json',
+                                         data=json.dumps(dict(email='harry@aol.com', password='dumbledore')))
+        resp = json.loads(login.data.decode())
+        headers = {'Authorization': 'Bearer %s' % resp['access_token']}
+        biz_ids = []
+        for name, location in [('Leaky Cauldron', 'London'), ('Three Broomsticks', 'Hogsmeade'),
+                               ('Hogs Head', 'Hogsmeade')]:
+            business = self.weconnect_test.post('/api/v1/businesses', content_type='application/json',
+                                                data=json.dumps(dict(name=name, location=location,
+                                                                     category='pub', description='Butterbeer')),
+                                                headers=headers)
+            biz_ids.append(json.loads(business.get_data())['business']['business_id'])
+        self.weconnect_test.put('/api/v1/businesses/%s' % biz_ids[2], content_type='application/json',
+                                data=json.dumps(dict(name='Hogs Head', location='Hogsmeade', category='Inn',
+                                                     description='Butterbeer')), headers=headers)
+        for biz_id, count in zip(biz_ids, [1, 3, 2]):
+            for _ in range(count):
+                self.weconnect_test.post('/api/v1/businesses/%s/reviews' % biz_id, content_type='application/json',
+                                         data=json.dumps(dict(review='Lovely')), headers=headers)
+        response = self.weconnect_test.get('/api/v1/businesses/stats?limit=2', headers=headers)
+        stats = json.loads(response.data.decode())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(stats['businesses'], 3)
+        self.assertEqual(stats['reviews'], 6)
+        self.assertEqual(stats['categories'], {'pub': 2, 'inn': 1})
+        self.assertEqual(stats['locations'], {'london': 1, 'hogsmeade': 2})
+        self.assertEqual((stats['category_count'], stats['location_count']), (2, 2))
+        self.assertEqual([(business['name'], business['review_count']) for business in stats['most_reviewed']],
+                         [('Three Broomsticks', 3), ('Hogs Head', 2)])
+        # check that deleting a top business brings up the next one
+        self.weconnect_test.delete('/api/v1/businesses/%s' % biz_ids[1], headers=headers)
+        response = self.weconnect_test.get('/api/v1/businesses/stats', headers=headers)
+        stats = json.loads(response.data.decode())
+        self.assertEqual(stats['reviews'], 3)
+        self.assertEqual(stats['locations'], {'london': 1, 'hogsmeade': 1})
+        self.assertEqual([business['business_id'] for business in stats['most_reviewed']], [biz_ids[2], biz_ids[0]])
+        response = self.weconnect_test.get('/api/v1/businesses/stats?limit=11', headers=headers)
+        self.assertEqual(response.status_code, 400)
+
+    def test_nearby_businesses(self):
+        self.weconnect_test.post('/api/v1/auth/register', content_type='application/json',
+                                 data=json.dumps(dict(first_name='Harry', last_name='Potter',
+                                                      email='harry@aol.com', password='dumbledore')))
+        login = self.weconnect_test.post('/api/v1/auth/login', content_type='application/json',
+                                         data=json.dumps(dict(email='harry@aol.com', password='dumbledore')))
+        resp = json.loads(login.data.decode())
+        headers = {'Authorization': 'Bearer %s' % resp['access_token']}
+        biz_ids = []
+        for name, category, latitude, longitude in [('Leaky Cauldron', 'pub', 51.5101, -0.1300),
+                                                    ('Ollivanders', 'shop', 51.5105, -0.1290),
+                                                    ('Three Broomsticks', 'pub', 57.0, -4.0)]:
+            business = self.weconnect_test.post('/api/v1/businesses', content_type='application/json',
+                                                data=json.dumps(dict(name=name, location='Somewhere',
+                                                                     category=category, description='Magic',
+                                                                     latitude=latitude, longitude=longitude)),
+                                                headers=headers)
+            self.assertEqual(business.status_code, 201)
+            biz_ids.append(json.loads(business.get_data())['business']['business_id'])
+        response = self.weconnect_test.get('/api/v1/businesses/nearby?lat=51.5104&lon=-0.1292', headers=headers)
+        results = json.loads(response.data.decode())['businesses']
+        self.assertEqual([business['name'] for business in results], ['Ollivanders', 'Leaky Cauldron'])
+        self.assertLess(results[0]['distance'], results[1]['distance'])
+        response = self.weconnect_test.get('/api/v1/businesses/nearby?lat=51.5104&lon=-0.1292&category=Pub',
+                                           headers=headers)
+        self.assertEqual([business['name'] for business in json.loads(response.data.decode())['businesses']],
+                         ['Leaky Cauldron'])
+        # check that a moved business is found at its new place only
+        self.weconnect_test.put('/api/v1/businesses/%s' % biz_ids[2], content_type='application/json',
+                                data=json.dumps(dict(name='Three Broomsticks', location='Somewhere', category='pub',
+                                                     description='Magic', latitude=51.5110, longitude=-0.1310)),
+                                headers=headers)
+        self.weconnect_test.delete('/api/v1/businesses/%s' % biz_ids[1], headers=headers)
+        response = self.weconnect_test.get('/api/v1/businesses/nearby?lat=51.5104&lon=-0.1292&radius=1000&limit=5',
+                                           headers=headers)
+        self.assertEqual([business['business_id'] for business in json.loads(response.data.decode())['businesses']],
+                         [biz_ids[0], biz_ids[2]])
+        response = self.weconnect_test.get('/api/v1/businesses/nearby?lat=57.0&lon=-4.0', headers=headers)
+        self.assertEqual(json.loads(response.data.decode())['businesses'], [])
+        for query in ['lat=51.5', 'lat=91&lon=0', 'lat=51.5&lon=0&radius=0', 'lat=51.5&lon=0&limit=101']:
+            response = self.weconnect_test.get('/api/v1/businesses/nearby?' + query, headers=headers)
+            self.assertEqual(response.status_code, 400)
+        response = self.weconnect_test.post('/api/v1/businesses', content_type='application/json',
+                                            data=json.dumps(dict(name='Gringotts', location='London', category='bank',
+                                                                 description='Gold', latitude=51.5)),
+                                            headers=headers)
+        self.assertEqual(response.status_code, 400)
+
+    def test_changes(self):
+        self.weconnect_test.post('/api/v1/auth/register', content_type='application/json',
+                                 data=json.dumps(dict(first_name='Harry', last_name='Potter',
+                                                      email='harry@aol.com', password='dumbledore')))
+        login = self.weconnect_test.post('/api/v1/auth/login', content_type='application/json',
+                                         data=json.dumps(dict(email='harry@aol.com', password='dumbledore')))
+        resp = json.loads(login.data.decode())
+        headers = {'Authorization': 'Bearer %s' % resp['access_token']}
+        seq = json.loads(self.weconnect_test.get('/api/v1/businesses/changes', headers=headers).data.decode())['seq']
+        business = self.weconnect_test.post('/api/v1/businesses', content_type='application/json',
+                                            data=json.dumps(dict(name='Mortal Kombat', location='Earth',
+                                                                 category='something', description='something')),
+                                            headers=headers)
+        biz_id = json.loads(business.get_data())['business']['business_id']
+        self.weconnect_test.put('/api/v1/businesses/%s' % biz_id, content_type='application/json',
+                                data=json.dumps(dict(name='Mortal Kombat 2', location='Earth',
+                                                     category='something', description='something')),
+                                headers=headers)
+        self.weconnect_test.post('/api/v1/businesses/%s/reviews' % biz_id, content_type='application/json',
+                                 data=json.dumps(dict(review='Finish him')), headers=headers)
+        response = self.weconnect_test.get('/api/v1/businesses/changes?since=%d' % seq, headers=headers)
+        changes = json.loads(response.data.decode())
+        self.assertEqual([change['type'] for change in changes['changes']], ['created', 'updated', 'reviewed'])
+        self.assertEqual(changes['changes'][1]['business']['name'], 'Mortal Kombat 2')
+        self.assertEqual(changes['changes'][2]['review_count'], 1)
+        # check that polling again only returns the changes made since
+        self.weconnect_test.delete('/api/v1/businesses/%s' % biz_id, headers=headers)
+        response = self.weconnect_test.get('/api/v1/businesses/changes?since=%d' % changes['seq'], headers=headers)
+        deleted = json.loads(response.data.decode())
+        self.assertEqual([(change['type'], change['business_id']) for change in deleted['changes']],
+                         [('deleted', biz_id)])
+        response = self.weconnect_test.get('/api/v1/businesses/changes?since=%d' % (deleted['seq'] + 1),
+                                           headers=headers)
+        self.assertEqual(response.status_code, 410)
+
+        # the stream sends the events held, then new ones as they are made
+        response = self.weconnect_test.get('/api/v1/businesses/changes/stream?since=%d' % changes['seq'],
+                                           headers=headers, buffered=False)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        events = response.response
+        self.assertIn(b'data: {"seq":%d,"type":"deleted"' % deleted['seq'], next(events))
+        self.weconnect_test.post('/api/v1/businesses', content_type='application/json',
+                                 data=json.dumps(dict(name='Outworld', location='Earth',
+                                                      category='something', description='something')),
+                                 headers=headers)
+        self.assertIn(b'"type":"created"', next(events))
+        response.close()
+
+        # the stream ends when the token it was opened with expires
+        events = views.change_events(changes['seq'], 'jti', time.time() + 0.2, 60)
+        self.assertIn(b'"type":"deleted"', next(events))
+        started = time.time()
+        self.assertEqual(list(events)[-1], b'event: expired\ndata: {}\n\n')
+        self.assertLess(time.time() - started, 5)
+
+    def test_status(self):
+        response = self.weconnect_test.get('/api/v1/status')
+        status = json.loads(response.data.decode())
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('login', status['admission']['routes'])
+        self.assertIn('queued', status['admission']['routes']['login'])
+
+    def test_admission_rejections(self):
+        login = dict(email='harry@aol.com', password='dumbledore')
+        limiter = views.admission.routes['login']
+        settings = (limiter.max_queue, limiter.queue_timeout)
+        rejected, timed_out = limiter.rejected, limiter.timed_out
+        try:
+            # every slot is taken and nobody may wait
+            limiter.active, limiter.max_queue = limiter.max_concurrent, 0
+            response = self.weconnect_test.post('/api/v1/auth/login', content_type='application/json',
+                                                data=json.dumps(login))
+            self.assertEqual(response.status_code, 503)
+            self.assertIn('Retry-After', response.headers)
+            # or the wait runs out
+            limiter.max_queue, limiter.queue_timeout = 1, 0.05
+            response = self.weconnect_test.post('/api/v1/auth/login', content_type='application/json',
+                                                data=json.dumps(login))
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(limiter.stats()['rejected'], rejected + 1)
+            self.assertEqual(limiter.stats()['timed_out'], timed_out + 1)
+        finally:
+            limiter.active = 0
+            limiter.max_queue, limiter.queue_timeout = settings
+        # an empty bucket is refilled at AUTH_RATE tokens per second
+        views.admission.clients.buckets['127.0.0.1'] = (0, time.monotonic())
+        response = self.weconnect_test.post('/api/v1/auth/login', content_type='application/json',
+                                            data=json.dumps(login))
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '1')
+
+    def test_admission_behind_proxy(self):
+        login = dict(email='harry@aol.com', password='dumbledore')
+        views.admission.clients.buckets['10.0.0.1'] = (0, time.monotonic())
+        views.admission.trusted_proxies = 1
+        try:
+            response = self.weconnect_test.post('/api/v1/auth/login', content_type='application/json',
+                                                data=json.dumps(login),
+                                                headers={'X-Forwarded-For': '10.0.0.2, 10.0.0.1'})
+            self.assertEqual(response.status_code, 429)
+            # another client behind the same proxy has its own bucket
+            response = self.weconnect_test.post('/api/v1/auth/login', content_type='application/json',
+                                                data=json.dumps(login), headers={'X-Forwarded-For': '10.0.0.3'})
+            self.assertEqual(response.status_code, 404)
+        finally:
+            views.admission.trusted_proxies = 0
+
+    def test_metrics(self):
+        self.weconnect_test.post('/api/v1/auth/register', content_type='application/json',
+                                 data=json.dumps(dict(first_name='Harry', last_name='Potter',
+                                                      email='harry@aol.com', password='dumbledore')))
+        login = self.weconnect_test.post('/api/v1/auth/login', content_type='application/json',
+                                         data=json.dumps(dict(email='harry@aol.com', password='dumbledore')))
+        resp = json.loads(login.data.decode())
+        headers = {'Authorization': 'Bearer %s' % resp['access_token']}
+        self.weconnect_test.get('/api/v1/businesses/1', headers=headers)
+        response = self.weconnect_test.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        text = response.data.decode()
+        self.assertIn('weconnect_http_request_duration_seconds_count{method="GET",'
+                      'route="/api/v1/businesses/<businessId>",status="404"}', text)
+        self.assertIn('weconnect_connect_call_duration_seconds_count{method="get_business"}', text)
+        self.assertIn('weconnect_bcrypt_duration_seconds_sum{op="check"}', text)
+        self.assertIn('weconnect_http_request_bytes_total{method="POST",route="/api/v1/auth/login"}', text)
+        # the profiler is off unless the configuration turns it on
+        response = self.weconnect_test.post('/api/v1/profiler', content_type='application/json',
+                                            data=json.dumps(dict(running=True)), headers=headers)
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.weconnect_test.get('/api/v1/profiler', headers=headers).status_code, 404)
+        app.config['PROFILER_ENABLED'] = True
+        try:
+            response = self.weconnect_test.post('/api/v1/profiler', content_type='application/json',
+                                                data=json.dumps(dict(running=True, interval=1e-9)), headers=headers)
+            self.assertEqual(response.status_code, 400)
+            response = self.weconnect_test.post('/api/v1/profiler', content_type='application/json',
+                                                data=json.dumps(dict(running=True, interval=0.001)), headers=headers)
+            self.assertTrue(json.loads(response.data.decode())['running'])
+            response = self.weconnect_test.post('/api/v1/profiler', content_type='application/json',
+                                                data=json.dumps(dict(running=False)), headers=headers)
+            self.assertFalse(json.loads(response.data.decode())['running'])
+            response = self.weconnect_test.get('/api/v1/profiler', headers=headers)
+            self.assertEqual(response.status_code, 200)
+        finally:
+            app.config['PROFILER_ENABLED'] = False
+
+class ConnectViewsSQLite(ConnectViews):
+    """Runs the endpoint tests against the SQLite storage backend"""
+    def make_storage(self):
+        self.directory = tempfile.mkdtemp()
+        return SQLiteStorage(os.path.join(self.directory, 'weconnect.db'))
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.directory)
+
+class CreateApp(unittest.TestCase):
+    """Tests building applications from a configuration"""
+    def setUp(self):
+        views.weconnect = views.Connect(hasher)
+        views.response_cache.attach(views.weconnect)
+
+    def tearDown(self):
+        views.weconnect.close()
+
+    def test_one_app_per_process(self):
+        # a second application would swap the databases of the first
+        self.assertRaises(ValueError, create_app, {'BCRYPT_WORKERS': 0})
+
+    def test_shared_sqlite(self):
+        # the state process streams databases held in memory
+        connect, views.weconnect = views.weconnect, None
+        try:
+            self.assertRaises(ValueError, create_app, {'SHARED_SOCKET': '/tmp/weconnect.sock',
+                                                       'STORAGE': 'sqlite', 'BCRYPT_WORKERS': 0})
+            self.assertIsNone(views.weconnect)
+        finally:
+            views.weconnect = connect
+
+    def test_shared_jwt_secret(self):
+        # another process with the same key, issuing a token
+        other = flask.Flask('other')
+        other.config['JWT_SECRET_KEY'] = 'shared secret'
+        flask_jwt_extended.JWTManager(other)
+        with other.test_request_context():
+            headers = {'Authorization': 'Bearer %s' % flask_jwt_extended.create_access_token(identity=1)}
+        self.assertNotEqual(app.test_client().get('/api/v1/businesses', headers=headers).status_code, 200)
+        key = app.config['JWT_SECRET_KEY']
+        app.config['JWT_SECRET_KEY'] = 'shared secret'
+        try:
+            self.assertEqual(app.test_client().get('/api/v1/businesses', headers=headers).status_code, 200)
+        finally:
+            app.config['JWT_SECRET_KEY'] = key
 
 if __name__ == '__main__':
     unittest.main()